@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+airtable_client.py
+
+One shared Airtable client per process.
+
+Every function used to build its own Api (and with it a requests session),
+so each call paid for a new TLS connection, and the Metadata API was read
+with a bare requests.get. This module hands out:
+
+- get_api(): one pyairtable Api whose session keeps connections alive and
+  pools up to POOL_SIZE of them (enough for the concurrent push workers
+  in airtable_push.py), keeping pyairtable's retry strategy;
+- table(name): Table objects on that Api, created once per name;
+- base_schema(): the base's tables and fields from the Metadata API;
+- area_record_id(name): the Areas record id for an area name.
+
+The schema and the area map are cached on disk (CACHE_PATH, JSON, per base)
+for SCHEMA_TTL and AREAS_TTL. An area name missing from a cached map
+reloads the map once, so a new area is found without waiting for the TTL.
+
+Every HTTP response on the shared session is counted, and every cache hit
+counts as a saved call; report() summarizes both for the run.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import Counter
+from urllib.parse import unquote
+
+from pyairtable import Api
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("airtable_client")
+
+AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
+BASE_ID = os.getenv("AIRTABLE_BASE_ID")
+CACHE_PATH = os.getenv("AIRTABLE_CACHE_PATH", "airtable_cache.json")
+
+AIRTABLE_URL = "https://api.airtable.com"
+AREAS_TABLE = "Areas"
+POOL_SIZE = 16
+SCHEMA_TTL = 24 * 3600
+AREAS_TTL = 3600
+
+_api = None
+_tables = {}
+_area_map = None  # (fetched this run, {name: record_id})
+_lock = threading.Lock()
+
+
+class CallStats:
+    """Airtable requests made and saved (cache hits) in this process."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.saved = Counter()
+        self._lock = threading.Lock()
+
+    def count_call(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+
+    def count_saved(self, kind):
+        with self._lock:
+            self.saved[kind] += 1
+
+    def as_dict(self):
+        return {'api_calls': sum(self.calls.values()), 'api_calls_saved': sum(self.saved.values()),
+                'calls': dict(self.calls), 'saved': dict(self.saved)}
+
+    def report(self):
+        calls = ", ".join(f"{kind} {count}" for kind, count in self.calls.most_common()) or "none"
+        saved = ", ".join(f"{kind} {count}" for kind, count in self.saved.most_common()) or "none"
+        return (f"Airtable API calls: {sum(self.calls.values())} ({calls}); "
+                f"saved by caching: {sum(self.saved.values())} ({saved})")
+
+
+stats = CallStats()
+
+
+def _count_response(response, *args, **kwargs):
+    """requests response hook: counts the call by kind (metadata or table name)."""
+    path = unquote(response.request.path_url.split("?")[0]).strip("/").split("/")
+    kind = "metadata" if path[1:2] == ["meta"] else (path[2] if len(path) > 2 else "other")
+    stats.count_call(f"{response.request.method} {kind}")
+
+
+def get_api():
+    """The process's shared Api (created on first use)."""
+    global _api
+    with _lock:
+        if _api is None:
+            api = Api(AIRTABLE_API_KEY)
+            # Larger keep-alive pool on the same retry strategy
+            retries = api.session.get_adapter(AIRTABLE_URL).max_retries
+            api.session.mount(AIRTABLE_URL, HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retries))
+            api.session.hooks["response"].append(_count_response)
+            _api = api
+        return _api
+
+
+def table(name, base_id=None):
+    """Table of the shared Api (default base: AIRTABLE_BASE_ID)."""
+    key = (base_id or BASE_ID, name)
+    if key not in _tables:
+        _tables[key] = get_api().table(*key)
+    return _tables[key]
+
+
+# -------------------------------
+# Disk cache
+# -------------------------------
+def _load_cache():
+    try:
+        with open(CACHE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _cached(name, ttl):
+    """The cached value of this base, or None if missing or older than ttl seconds."""
+    entry = _load_cache().get(BASE_ID or "", {}).get(name)
+    if entry and time.time() - entry.get("fetched_at", 0) < ttl:
+        return entry["value"]
+    return None
+
+
+def _store(name, value):
+    cache = _load_cache()
+    cache.setdefault(BASE_ID or "", {})[name] = {"fetched_at": time.time(), "value": value}
+    temp_path = f"{CACHE_PATH}.tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(temp_path, CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"Could not write the Airtable cache {CACHE_PATH}: {e}")
+
+
+# -------------------------------
+# Cached lookups
+# -------------------------------
+def base_schema(refresh=False):
+    """Metadata API response for the base ({'tables': [...]}), cached for SCHEMA_TTL."""
+    if not refresh:
+        schema = _cached("schema", SCHEMA_TTL)
+        if schema is not None:
+            stats.count_saved("metadata")
+            return schema
+    schema = get_api().request("GET", f"{AIRTABLE_URL}/v0/meta/bases/{BASE_ID}/tables")
+    _store("schema", schema)
+    return schema
+
+
+def _fetch_area_map():
+    names = {}
+    for page in table(AREAS_TABLE).iterate(page_size=100, fields=["Name"]):
+        for record in page:
+            name = record.get("fields", {}).get("Name")
+            if name:
+                names.setdefault(name, record["id"])
+    _store("areas", names)
+    return names
+
+
+def area_record_ids(refresh=False):
+    """{area name: Areas record id}, cached for AREAS_TTL."""
+    global _area_map
+    if not refresh:
+        if _area_map is None:
+            cached = _cached("areas", AREAS_TTL)
+            if cached is not None:
+                _area_map = (False, cached)
+        if _area_map is not None:
+            return _area_map[1]
+    _area_map = (True, _fetch_area_map())
+    return _area_map[1]
+
+
+def area_record_id(area_name):
+    """Record id of the area in the Areas table, or None."""
+    before = _area_map
+    names = area_record_ids()
+    if area_name not in names and not _area_map[0]:
+        # Cached before the area existed
+        names = area_record_ids(refresh=True)
+    elif _area_map is before or not _area_map[0]:
+        # Answered without a request
+        stats.count_saved("area lookup")
+    return names.get(area_name)
+
+
+def report():
+    return stats.report()
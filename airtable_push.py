@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+airtable_push.py
+
+Concurrent, rate-limited push of record updates to Airtable.
+
+sync_changes.py used to send one batch_update after another, so a sync of a
+few thousand buildings spent most of its time waiting on serial HTTP round
+trips. push_updates() keeps several batches in flight instead:
+
+- a token bucket limits requests to Airtable's per-base limit (5 requests
+  per second), shared by all workers;
+- `concurrency` workers take batches of up to 10 records (Airtable's
+  maximum per request) from a queue and run the blocking pyairtable call in
+  a thread;
+- 429 and 5xx responses, and errors without a response (timeouts, dropped
+  connections), are retried with exponential backoff and jitter by putting
+  the batch back on the queue. A 429 also drains the bucket, because
+  Airtable rejects all requests to the base for 30 seconds after one;
+- any other error response (422 for an invalid value, for example) splits
+  the batch into single records and re-queues them, so one bad record does
+  not take nine good ones down with it. Records that still fail are
+  returned.
+
+A batch whose retries are used up is not split (its records would each get
+max_attempts more requests during an outage): all its records are
+returned as failed, as are those of a batch whose send() raised anything
+other than a requests error (a bug, not Airtable).
+
+The returned PushStats holds per-batch latency and throughput.
+"""
+import time
+import random
+import asyncio
+import logging
+
+import requests
+
+logger = logging.getLogger("airtable_push")
+
+AIRTABLE_REQUESTS_PER_SECOND = 5
+AIRTABLE_MAX_RECORDS_PER_REQUEST = 10
+# Airtable blocks a base for 30 seconds after a 429
+RATE_LIMIT_PENALTY = 30.0
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+class TokenBucket:
+    """
+    asyncio token bucket: `rate` tokens per second, at most `capacity`
+    stored. acquire() waits until a token is available. The default capacity
+    of 1 spaces requests evenly, so no one-second window sees more than
+    `rate` of them.
+    """
+
+    def __init__(self, rate=AIRTABLE_REQUESTS_PER_SECOND, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        """Hands out no tokens for `seconds` (after a 429)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class PushStats:
+    """Counters and per-batch latencies of one push_updates() call."""
+
+    def __init__(self):
+        self.batches = 0
+        self.records = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.splits = 0
+        self.failed = []
+        self.latencies = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def records_per_second(self):
+        return self.records / self.elapsed if self.elapsed else 0.0
+
+    def latency_percentile(self, fraction):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def as_dict(self):
+        return {
+            'batches': self.batches,
+            'pushed': self.records,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'failed': len(self.failed),
+            'seconds': round(self.elapsed, 2),
+            'records_per_second': round(self.records_per_second(), 1),
+            'latency_p50_ms': round(self.latency_percentile(0.5) * 1000),
+            'latency_p95_ms': round(self.latency_percentile(0.95) * 1000),
+        }
+
+    def report(self):
+        return (f"Pushed {self.records} records in {self.batches} batches in {self.elapsed:.1f}s "
+                f"({self.records_per_second():.1f} records/s); batch latency p50 "
+                f"{self.latency_percentile(0.5) * 1000:.0f} ms, p95 {self.latency_percentile(0.95) * 1000:.0f} ms, "
+                f"max {max(self.latencies, default=0) * 1000:.0f} ms; {self.retries} retries "
+                f"({self.rate_limited} rate limited), {len(self.failed)} failed records")
+
+
+def status_code(error):
+    """HTTP status of a pyairtable/requests error, or None if there was no response."""
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_retryable(error):
+    """429, 5xx, and requests errors without a response (timeouts, dropped connections)."""
+    status = status_code(error)
+    if status is None:
+        return isinstance(error, requests.RequestException)
+    return status == 429 or status >= 500
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for the given (1-based) attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+def make_batches(updates, batch_size=AIRTABLE_MAX_RECORDS_PER_REQUEST):
+    batch_size = max(1, min(batch_size, AIRTABLE_MAX_RECORDS_PER_REQUEST))
+    return [updates[start:start + batch_size] for start in range(0, len(updates), batch_size)]
+
+
+async def push_updates(table, updates, batch_size=AIRTABLE_MAX_RECORDS_PER_REQUEST, concurrency=4,
+                       rate=AIRTABLE_REQUESTS_PER_SECOND, max_attempts=MAX_ATTEMPTS, send=None):
+    """
+    Pushes [{'id': record_id, 'fields': {...}}] updates to an Airtable table
+    and returns PushStats; records that could not be written are in
+    stats.failed as (update, error) pairs.
+
+    send(batch) performs one request (default: table.batch_update) and is
+    run in a worker thread.
+    """
+    send = send or table.batch_update
+    bucket = TokenBucket(rate)
+    stats = PushStats()
+    queue = asyncio.Queue()
+    pending_retries = set()
+    for batch in make_batches(updates, batch_size):
+        queue.put_nowait((batch, 1))
+
+    async def retry_later(batch, attempt):
+        await asyncio.sleep(backoff_delay(attempt))
+        queue.put_nowait((batch, attempt + 1))
+        queue.task_done()
+
+    async def worker():
+        while True:
+            batch, attempt = await queue.get()
+            await bucket.acquire()
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(send, batch)
+            except Exception as e:
+                status = status_code(e)
+                if is_retryable(e) and attempt < max_attempts:
+                    stats.retries += 1
+                    if status == 429:
+                        stats.rate_limited += 1
+                        bucket.block(RATE_LIMIT_PENALTY)
+                    logger.warning(f"Batch of {len(batch)} failed (attempt {attempt}, status {status}): {e}; re-queued")
+                    # Re-queued in the background, so this worker keeps serving other batches
+                    task = asyncio.create_task(retry_later(batch, attempt))
+                    pending_retries.add(task)
+                    task.add_done_callback(pending_retries.discard)
+                    continue
+                if status is not None and not is_retryable(e) and len(batch) > 1:
+                    stats.splits += 1
+                    logger.warning(f"Batch of {len(batch)} failed (status {status}): {e}; retrying records one by one")
+                    for update in batch:
+                        queue.put_nowait(([update], 1))
+                else:
+                    logger.error(f"Batch of {len(batch)} (first record {batch[0].get('id')}) failed after "
+                                 f"{attempt} attempts: {e}")
+                    stats.failed.extend((update, e) for update in batch)
+                queue.task_done()
+                continue
+            stats.latencies.append(time.perf_counter() - started)
+            stats.batches += 1
+            stats.records += len(batch)
+            logger.debug(f"Pushed batch of {len(batch)} in {stats.latencies[-1] * 1000:.0f} ms")
+            queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    stats.elapsed = time.perf_counter() - stats.started
+    logger.info(stats.report())
+    return stats
+
+
+def push_updates_sync(table, updates, **kwargs):
+    """push_updates() for synchronous callers."""
+    return asyncio.run(push_updates(table, updates, **kwargs))
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+airtable_snapshot.py
+
+Streaming refresh of the buildings table (the local Airtable snapshot).
+
+refresh_area() reads an area's building records from the Objects table
+page by page (100 records per request) and upserts every page with one
+executemany as soon as it arrives, so memory stays flat and a refresh that
+is interrupted keeps the pages it already wrote. Each request:
+
+- asks only for the fields the snapshot stores (SNAPSHOT_FIELDS),
+- filters on the server with filterByFormula: Type is Building, the record
+  links to the area, and, after the first refresh, it was modified after
+  the previous refresh.
+
+snapshot_refreshes (migration 17) remembers per area when the last refresh
+started. The next refresh asks only for records modified since then (minus
+CLOCK_SKEW, since the timestamp comes from the local clock), so its cost
+grows with the number of changed records. Records deleted in Airtable are
+only noticed by a full refresh (full=True), which refetches everything
+and removes the area's buildings it did not see.
+
+refresh_areas() refreshes several areas concurrently (up to `concurrency`
+at a time) for dozens of areas. Their page requests share one token
+bucket (airtable_push.TokenBucket, Airtable's 5 requests per second per
+base); each area is fetched completely and then written in one
+transaction, with per-area fetch and write times in its stats.
+
+The upsert only moves buildings.last_updated when a value changed, which is
+what the incremental Airtable sync keys on (see sync_state.py).
+"""
+import time
+import asyncio
+import sqlite3
+import logging
+from datetime import datetime, timedelta, timezone
+
+import airtable_client
+from airtable_push import TokenBucket, AIRTABLE_REQUESTS_PER_SECOND
+from normalize import strip_exploration_prefix, parse_exploration_timestamp, extract_fol_id
+
+logger = logging.getLogger("airtable_snapshot")
+
+OBJECTS_TABLE = "Objects"
+PAGE_SIZE = 100  # Airtable's maximum
+CLOCK_SKEW = timedelta(minutes=5)
+
+# Airtable fields the snapshot stores (field projection)
+SNAPSHOT_FIELDS = [
+    "Name", "Area", "Type", "Extra field 1", "Extra field 2", "Extra field 3", "First name", "Last name",
+    "Phone 1", "Phone 2", "Email", "HOMES", "OFFICES", "NVT",
+]
+
+BUILDING_COLUMNS = [
+    "record_id", "area_record_id", "building_name", "extra_field_1", "extra_field_2", "extra_field_3",
+    "first_name", "last_name", "phone_1", "phone_2", "email", "homes", "offices", "nvt",
+    "exploration_date", "exploration_at",
+]
+
+# Columns whose change moves last_updated (exploration_date/_at derive from extra_field_3)
+_CHANGE_COLUMNS = BUILDING_COLUMNS[1:14]
+
+BUILDING_UPSERT_SQL = f"""
+    INSERT INTO buildings ({', '.join(BUILDING_COLUMNS)})
+    VALUES ({', '.join('?' for _ in BUILDING_COLUMNS)})
+    ON CONFLICT(record_id) DO UPDATE SET
+        {', '.join(f'{column}=excluded.{column}' for column in BUILDING_COLUMNS[1:])},
+        last_updated=CURRENT_TIMESTAMP
+    -- last_updated only moves when a value changed (the sync's watermark, see sync_state.py)
+    WHERE {' OR '.join(f'buildings.{column} IS NOT excluded.{column}' for column in _CHANGE_COLUMNS)}
+"""
+
+
+def formula_string(value):
+    """A value as an Airtable formula string literal."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def building_formula(area_name, modified_after=None):
+    """filterByFormula for the area's buildings, optionally only those modified after a datetime."""
+    # ARRAYJOIN of a linked field gives the linked records' names; the commas make "Area 1" not match "Area 10"
+    conditions = [
+        '{Type}="Building"',
+        f"FIND({formula_string(',' + area_name + ',')}, \",\" & ARRAYJOIN({{Area}}, \",\") & \",\")",
+    ]
+    if modified_after is not None:
+        stamp = modified_after.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        conditions.append(f"IS_AFTER(LAST_MODIFIED_TIME(), {formula_string(stamp)})")
+    return f"AND({', '.join(conditions)})"
+
+
+def _int_or_zero(value):
+    try:
+        return int(value or 0)
+    except (ValueError, TypeError):
+        return 0
+
+
+def building_row(record, area_record_id):
+    """BUILDING_UPSERT_SQL parameters for an Objects record, or None if it has no name."""
+    fields = record.get("fields", {})
+    if not record.get("id") or not fields.get("Name"):
+        return None
+    extra_field_3 = fields.get("Extra field 3")
+    return (
+        record["id"], area_record_id, fields.get("Name"), extract_fol_id(fields.get("Extra field 1")),
+        fields.get("Extra field 2"), extra_field_3, fields.get("First name"), fields.get("Last name"),
+        fields.get("Phone 1"), fields.get("Phone 2"), fields.get("Email"),
+        _int_or_zero(fields.get("HOMES")), _int_or_zero(fields.get("OFFICES")), fields.get("NVT"),
+        strip_exploration_prefix(extra_field_3), parse_exploration_timestamp(extra_field_3),
+    )
+
+
+def last_refresh(conn, area_name):
+    """(area_record_id, started_at as datetime) of the area's last refresh, or None."""
+    row = conn.execute("SELECT area_record_id, started_at FROM snapshot_refreshes WHERE area = ?", (area_name,)).fetchone()
+    if not row or not row[1]:
+        return None
+    return row[0], datetime.fromisoformat(row[1])
+
+
+def _start_refresh(conn, area_name, full):
+    """(area_record_id, modified_after) of the area's next refresh; modified_after None means full. None if unknown."""
+    previous = None if full else last_refresh(conn, area_name)
+    if previous:
+        return previous[0], previous[1] - CLOCK_SKEW
+    area_record_id = airtable_client.area_record_id(area_name)
+    if not area_record_id:
+        logger.warning(f"No area record found for area name: {area_name}")
+        return None
+    return area_record_id, None
+
+
+def _new_stats(modified_after):
+    return {'mode': 'full' if modified_after is None else 'incremental',
+            'pages': 0, 'fetched': 0, 'changed': 0, 'skipped': 0, 'removed': 0}
+
+
+def _page_rows(page, area_record_id, stats):
+    """BUILDING_UPSERT_SQL parameters for the area's buildings in a page."""
+    rows = []
+    for record in page:
+        # The formula matches by area name; the link decides
+        if area_record_id not in record.get("fields", {}).get("Area", []):
+            stats['skipped'] += 1
+            continue
+        row = building_row(record, area_record_id)
+        if row is None:
+            stats['skipped'] += 1
+            continue
+        rows.append(row)
+    stats['pages'] += 1
+    stats['fetched'] += len(page)
+    return rows
+
+
+def _begin_seen(conn):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS snapshot_seen (record_id TEXT PRIMARY KEY) WITHOUT ROWID")
+    conn.execute("DELETE FROM temp.snapshot_seen")
+
+
+def _upsert_rows(conn, rows, full):
+    """Upserts buildings rows; returns the number that changed."""
+    before = conn.total_changes
+    conn.executemany(BUILDING_UPSERT_SQL, rows)
+    changed = conn.total_changes - before
+    if full:
+        conn.executemany("INSERT OR IGNORE INTO temp.snapshot_seen (record_id) VALUES (?)", ((row[0],) for row in rows))
+    return changed
+
+
+def _finish_refresh(conn, area_name, area_record_id, modified_after, started_at, stats):
+    """Removes what a full refresh did not see and records the refresh in snapshot_refreshes (not committed)."""
+    if modified_after is None:
+        # A full refresh sees every record of the area; the rest were deleted in Airtable
+        stats['removed'] = conn.execute("""
+            DELETE FROM buildings WHERE area_record_id = ? AND record_id NOT IN (SELECT record_id FROM temp.snapshot_seen)
+        """, (area_record_id,)).rowcount
+    conn.execute("""
+        INSERT INTO snapshot_refreshes (area, area_record_id, started_at, full_refresh_at, records)
+        VALUES (?, ?, ?, CASE WHEN ? THEN ? END, ?)
+        ON CONFLICT(area) DO UPDATE SET
+            area_record_id = excluded.area_record_id,
+            started_at = excluded.started_at,
+            full_refresh_at = COALESCE(excluded.full_refresh_at, snapshot_refreshes.full_refresh_at),
+            records = excluded.records,
+            updated_at = CURRENT_TIMESTAMP
+    """, (area_name, area_record_id, started_at.isoformat(), modified_after is None, started_at.isoformat(),
+          stats['fetched']))
+
+
+def _log_refresh(area_name, stats):
+    logger.info(f"Refreshed {area_name} ({stats['mode']}): {stats['fetched']} records in {stats['pages']} pages, "
+                f"{stats['changed']} changed, {stats['removed']} removed, {stats['skipped']} skipped, {stats['seconds']}s")
+
+
+def _iterate_buildings(area_name, modified_after):
+    return airtable_client.table(OBJECTS_TABLE).iterate(
+        page_size=PAGE_SIZE, fields=SNAPSHOT_FIELDS, formula=building_formula(area_name, modified_after))
+
+
+def refresh_area(area_name, db_path="extraction.db", full=False):
+    """
+    Refreshes the buildings of an area from Airtable: only records modified
+    since the last refresh, or all of them with full=True (or on the first
+    refresh). Every page is committed as it arrives. Returns stats, or None
+    if the area does not exist.
+    """
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        target = _start_refresh(conn, area_name, full)
+        if target is None:
+            return None
+        area_record_id, modified_after = target
+        stats = _new_stats(modified_after)
+        if modified_after is None:
+            _begin_seen(conn)
+        for page in _iterate_buildings(area_name, modified_after):
+            changed = _upsert_rows(conn, _page_rows(page, area_record_id, stats), modified_after is None)
+            conn.commit()
+            stats['changed'] += changed
+            logger.debug(f"Page {stats['pages']}: {len(page)} records, {changed} changed")
+        _finish_refresh(conn, area_name, area_record_id, modified_after, started_at, stats)
+        conn.commit()
+    finally:
+        conn.close()
+
+    stats['seconds'] = round(time.perf_counter() - started, 2)
+    _log_refresh(area_name, stats)
+    return stats
+
+
+# -------------------------------
+# Several areas at once
+# -------------------------------
+async def _fetch_area(area_name, modified_after, bucket):
+    """All pages of the area's buildings; every request waits for a token of the shared bucket."""
+    pages = iter(_iterate_buildings(area_name, modified_after))
+    fetched = []
+    while True:
+        await bucket.acquire()
+        page = await asyncio.to_thread(next, pages, None)
+        if page is None:
+            return fetched
+        fetched.append(page)
+
+
+async def _refresh_areas(area_names, db_path, full, concurrency, rate):
+    conn = sqlite3.connect(db_path)
+    bucket = TokenBucket(rate)
+    slots = asyncio.Semaphore(max(1, concurrency))
+    # Resolved up front: at most one read of the Areas table, answered from the cache otherwise
+    targets = {area_name: _start_refresh(conn, area_name, full) for area_name in area_names}
+    results = {area_name: None for area_name in area_names}
+
+    async def refresh(area_name, area_record_id, modified_after):
+        async with slots:
+            started_at = datetime.now(timezone.utc)
+            started = time.perf_counter()
+            stats = _new_stats(modified_after)
+            try:
+                pages = await _fetch_area(area_name, modified_after, bucket)
+            except Exception as e:
+                logger.error(f"Refreshing {area_name} failed: {e}")
+                return
+            stats['fetch_seconds'] = round(time.perf_counter() - started, 2)
+
+            # One transaction per area, written without yielding to the other areas
+            write_started = time.perf_counter()
+            if modified_after is None:
+                _begin_seen(conn)
+            for page in pages:
+                stats['changed'] += _upsert_rows(conn, _page_rows(page, area_record_id, stats), modified_after is None)
+            _finish_refresh(conn, area_name, area_record_id, modified_after, started_at, stats)
+            conn.commit()
+            stats['write_seconds'] = round(time.perf_counter() - write_started, 2)
+            stats['seconds'] = round(time.perf_counter() - started, 2)
+            _log_refresh(area_name, stats)
+            results[area_name] = stats
+
+    try:
+        await asyncio.gather(*(refresh(area_name, *target) for area_name, target in targets.items() if target))
+    finally:
+        conn.close()
+    return results
+
+
+def refresh_areas(area_names, db_path="extraction.db", full=False, concurrency=4, rate=AIRTABLE_REQUESTS_PER_SECOND):
+    """
+    Refreshes several areas, up to `concurrency` at a time. All page
+    requests share one token bucket of `rate` requests per second; every
+    area is fetched completely and then written in one transaction.
+    Returns {area name: stats, or None if the area does not exist or its
+    fetch failed}.
+    """
+    started = time.perf_counter()
+    results = asyncio.run(_refresh_areas(list(dict.fromkeys(area_names)), db_path, full, concurrency, rate))
+    logger.info(f"Refreshed {sum(1 for stats in results.values() if stats)} of {len(results)} areas "
+                f"in {time.perf_counter() - started:.1f}s")
+    return results
+
+
+def summary_rows(results):
+    """Table rows (area, mode, pages, fetched, changed, removed, skipped, fetch s, write s, total s) of refresh_areas() results."""
+    return [(area_name, stats['mode'], stats['pages'], stats['fetched'], stats['changed'], stats['removed'],
+             stats['skipped'], stats['fetch_seconds'], stats['write_seconds'], stats['seconds'])
+            if stats else (area_name, 'failed or unknown', '', '', '', '', '', '', '', '')
+            for area_name, stats in results.items()]
+
+
+SUMMARY_HEADERS = ["area", "mode", "pages", "fetched", "changed", "removed", "skipped", "fetch s", "write s", "total s"]
+
+
+if __name__ == "__main__":
+    import argparse
+    from tabulate import tabulate
+    from migrations import migrate
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Refresh the local buildings snapshot from Airtable')
+    parser.add_argument('area', nargs='*', help='Area name(s) to refresh; none: show the last refreshes')
+    parser.add_argument('--all', action='store_true', help='Refresh every area of the Areas table')
+    parser.add_argument('--concurrency', type=int, default=4, help='Areas fetched at the same time (default: 4)')
+    parser.add_argument('--rate', type=float, default=AIRTABLE_REQUESTS_PER_SECOND,
+                        help=f'Requests per second across all areas (default: {AIRTABLE_REQUESTS_PER_SECOND})')
+    parser.add_argument('--full', action='store_true', help='Refetch all records, not only those modified since the last refresh')
+    parser.add_argument('--db-path', default='extraction.db', help='Path to the SQLite database')
+    parser.add_argument('--verbose', action='store_true', help='Log every page')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+    migrate(args.db_path)
+    areas = list(airtable_client.area_record_ids()) if args.all else args.area
+    if len(areas) == 1:
+        refresh_area(areas[0], args.db_path, full=args.full)
+        logging.info(airtable_client.report())
+    elif areas:
+        results = refresh_areas(areas, args.db_path, full=args.full, concurrency=args.concurrency, rate=args.rate)
+        print(tabulate(summary_rows(results), headers=SUMMARY_HEADERS, tablefmt="pretty"))
+        logging.info(airtable_client.report())
+    else:
+        conn = sqlite3.connect(args.db_path)
+        rows = conn.execute("""
+            SELECT area, area_record_id, started_at, full_refresh_at, records FROM snapshot_refreshes ORDER BY area
+        """).fetchall()
+        conn.close()
+        print(tabulate(rows, headers=["area", "area_record_id", "last refresh", "last full refresh", "records"],
+                       tablefmt="pretty"))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+backup.py
+
+Online snapshots of extraction.db (and its area shards) while the scrapers
+keep writing.
+
+Snapshots are taken with SQLite's backup API, a few hundred pages per step
+with a short sleep in between. The source connection holds one read
+transaction for the whole copy. In WAL mode that pins a consistent snapshot
+without blocking the writer, and the copy never has to restart because of
+commits made in the meantime.
+
+Each snapshot is written to a temporary file and renamed into place, with a
+.sha256 file next to it:
+
+    backups/<database>/<database>-YYYYmmdd-HHMMSS.db
+    backups/<database>/<database>-YYYYmmdd-HHMMSS.db.sha256
+
+Rotation keeps the newest `keep_last` snapshots plus the newest snapshot of
+each of the last `keep_daily` days. Before a restore overwrites a database,
+the snapshot is verified: checksum, PRAGMA integrity_check and the schema
+version.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import sqlite3
+import logging
+from datetime import datetime
+from pathlib import Path
+
+from migrations import current_version
+
+BACKUP_DIR = Path("backups")
+PAGES_PER_STEP = 256
+STEP_SLEEP = 0.05
+KEEP_LAST = 5
+KEEP_DAILY = 7
+TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+
+logger = logging.getLogger("backup")
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_dir(db_path, backup_dir=BACKUP_DIR):
+    return Path(backup_dir) / Path(db_path).stem
+
+
+def list_snapshots(db_path, backup_dir=BACKUP_DIR):
+    """Snapshots of db_path, newest first, as (datetime, path) tuples."""
+    stem = Path(db_path).stem
+    snapshots = []
+    for path in snapshot_dir(db_path, backup_dir).glob(f"{stem}-*.db"):
+        try:
+            taken = datetime.strptime(path.stem[len(stem) + 1:], TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+        snapshots.append((taken, path))
+    return sorted(snapshots, reverse=True)
+
+
+def _copy(source_path, destination_path, pages=PAGES_PER_STEP, sleep=STEP_SLEEP):
+    """Copies a database through the backup API. Returns the number of steps taken."""
+    steps = 0
+
+    def progress(status, remaining, total):
+        nonlocal steps
+        steps += 1
+
+    source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True, isolation_level=None)
+    destination = sqlite3.connect(destination_path)
+    try:
+        source.execute("PRAGMA busy_timeout = 10000")
+        # Pin one read snapshot for the whole copy (see module docstring)
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(destination, pages=pages, progress=progress, sleep=sleep)
+        source.execute("COMMIT")
+    finally:
+        destination.close()
+        source.close()
+    return steps
+
+
+def backup_database(db_path="extraction.db", backup_dir=BACKUP_DIR, pages=PAGES_PER_STEP, sleep=STEP_SLEEP):
+    """
+    Takes one online snapshot of db_path and returns its path. Copies `pages`
+    pages per step and sleeps `sleep` seconds between steps.
+    """
+    target_dir = snapshot_dir(db_path, backup_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    stem = Path(db_path).stem
+    target = target_dir / f"{stem}-{datetime.now().strftime(TIMESTAMP_FORMAT)}.db"
+    if target.exists():
+        raise FileExistsError(f"{target} already exists (one snapshot per second)")
+    partial = target.with_suffix(".db.partial")
+
+    started = time.perf_counter()
+    steps = _copy(db_path, partial, pages, sleep)
+    conn = sqlite3.connect(partial)
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+    os.replace(partial, target)
+    Path(f"{target}.sha256").write_text(f"{_file_sha256(target)}  {target.name}\n")
+    elapsed = time.perf_counter() - started
+    logger.info(f"Snapshot of {db_path} -> {target} ({target.stat().st_size / 2**20:.1f} MiB, "
+                f"{steps} steps, {elapsed:.1f}s)")
+    return target
+
+
+def rotate_snapshots(db_path="extraction.db", backup_dir=BACKUP_DIR, keep_last=KEEP_LAST, keep_daily=KEEP_DAILY):
+    """Deletes snapshots outside the rotation policy. Returns the deleted paths."""
+    snapshots = list_snapshots(db_path, backup_dir)
+    keep = {path for _, path in snapshots[:keep_last]}
+    days = []
+    for taken, path in snapshots:
+        day = taken.date()
+        if day not in days:
+            days.append(day)
+            if len(days) <= keep_daily:
+                keep.add(path)
+    deleted = []
+    for _, path in snapshots:
+        if path not in keep:
+            path.unlink()
+            Path(f"{path}.sha256").unlink(missing_ok=True)
+            deleted.append(path)
+            logger.info(f"Rotated out {path}")
+    return deleted
+
+
+def backup_all(db_path="extraction.db", backup_dir=BACKUP_DIR, keep_last=KEEP_LAST, keep_daily=KEEP_DAILY,
+               pages=PAGES_PER_STEP, sleep=STEP_SLEEP):
+    """Snapshots db_path and every registered area shard, then rotates. Returns the new snapshot paths."""
+    from shards import ShardRouter
+
+    databases = [db_path] + ShardRouter(db_path).paths()
+    snapshots = []
+    for database in databases:
+        snapshots.append(backup_database(database, backup_dir, pages, sleep))
+        rotate_snapshots(database, backup_dir, keep_last, keep_daily)
+    return snapshots
+
+
+async def periodic_backups(db_path="extraction.db", interval=1800, backup_dir=BACKUP_DIR,
+                           keep_last=KEEP_LAST, keep_daily=KEEP_DAILY):
+    """
+    Snapshots db_path (and its shards) every `interval` seconds until
+    cancelled. Runs the copy in a worker thread so the event loop and the
+    DB writer task keep running.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(backup_all, db_path, backup_dir, keep_last, keep_daily)
+        except Exception as e:
+            logger.error(f"Periodic backup of {db_path} failed: {e}")
+
+
+def verify_snapshot(snapshot):
+    """Returns (ok, message) after checking checksum, integrity and schema version of a snapshot."""
+    snapshot = Path(snapshot)
+    if not snapshot.exists():
+        return False, f"{snapshot} does not exist"
+    checksum_file = Path(f"{snapshot}.sha256")
+    if checksum_file.exists():
+        expected = checksum_file.read_text().split()[0]
+        if _file_sha256(snapshot) != expected:
+            return False, "checksum mismatch"
+    else:
+        logger.warning(f"No checksum file for {snapshot}")
+    conn = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != "ok":
+            return False, f"integrity_check: {result}"
+        version = current_version(conn)
+        if not version:
+            return False, "no schema_version table"
+    except sqlite3.DatabaseError as e:
+        return False, str(e)
+    finally:
+        conn.close()
+    return True, f"ok (schema version {version})"
+
+
+def restore_snapshot(snapshot, db_path="extraction.db"):
+    """
+    Verifies snapshot and copies it over db_path through the backup API, so
+    WAL and shared-memory files stay consistent. The current database is
+    first copied to <db_path>.pre-restore-<timestamp>, outside the rotation.
+    Stop the scrapers before restoring.
+    """
+    ok, message = verify_snapshot(snapshot)
+    if not ok:
+        raise ValueError(f"Snapshot {snapshot} failed verification: {message}")
+    if Path(db_path).exists():
+        safety = f"{db_path}.pre-restore-{datetime.now().strftime(TIMESTAMP_FORMAT)}"
+        _copy(db_path, safety, pages=-1, sleep=0)
+        logger.info(f"Saved current {db_path} as {safety}")
+    _copy(snapshot, db_path, pages=-1, sleep=0)
+    logger.info(f"Restored {db_path} from {snapshot}")
+
+
+if __name__ == "__main__":
+    import argparse
+    from tabulate import tabulate
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Online backups of extraction.db')
+    parser.add_argument('--db-path', default='extraction.db', help='Path to the SQLite database')
+    parser.add_argument('--backup-dir', default=str(BACKUP_DIR), help='Directory holding the snapshots')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    backup_parser = subparsers.add_parser('backup', help='Take a snapshot (of the database and its shards)')
+    backup_parser.add_argument('--every', type=int, help='Keep running and take a snapshot every N seconds')
+    backup_parser.add_argument('--keep-last', type=int, default=KEEP_LAST, help='Newest snapshots to keep')
+    backup_parser.add_argument('--keep-daily', type=int, default=KEEP_DAILY, help='Days with one kept snapshot each')
+    backup_parser.add_argument('--pages', type=int, default=PAGES_PER_STEP, help='Pages copied per step')
+    backup_parser.add_argument('--sleep', type=float, default=STEP_SLEEP, help='Seconds to sleep between steps')
+
+    subparsers.add_parser('list', help='List snapshots')
+
+    verify_parser = subparsers.add_parser('verify', help='Verify snapshots (default: all)')
+    verify_parser.add_argument('snapshot', nargs='?', help='Snapshot file')
+
+    restore_parser = subparsers.add_parser('restore', help='Verify a snapshot and restore it')
+    restore_parser.add_argument('snapshot', nargs='?', help='Snapshot file (default: newest valid one)')
+
+    args = parser.parse_args()
+
+    if args.command == 'backup':
+        while True:
+            backup_all(args.db_path, args.backup_dir, args.keep_last, args.keep_daily, args.pages, args.sleep)
+            if not args.every:
+                break
+            time.sleep(args.every)
+    elif args.command == 'list':
+        rows = [(taken, path, f"{path.stat().st_size / 2**20:.1f} MiB")
+                for taken, path in list_snapshots(args.db_path, args.backup_dir)]
+        print(tabulate(rows, headers=["taken", "path", "size"], tablefmt="pretty"))
+    elif args.command == 'verify':
+        snapshots = [Path(args.snapshot)] if args.snapshot else [p for _, p in list_snapshots(args.db_path, args.backup_dir)]
+        failed = 0
+        for snapshot in snapshots:
+            ok, message = verify_snapshot(snapshot)
+            failed += not ok
+            print(f"{snapshot}: {message}")
+        if failed:
+            raise SystemExit(1)
+    elif args.command == 'restore':
+        snapshot = args.snapshot
+        if snapshot is None:
+            # Newest snapshot that passes verification
+            for _, path in list_snapshots(args.db_path, args.backup_dir):
+                ok, message = verify_snapshot(path)
+                if ok:
+                    snapshot = path
+                    break
+                logger.warning(f"Skipping {path}: {message}")
+            if snapshot is None:
+                raise SystemExit("No valid snapshot found")
+        restore_snapshot(snapshot, args.db_path)
@@ -3,7 +3,9 @@
 check_missing_records.py
 
 This script checks for records in the buildings table that have data in the first_name column
-but don't have a corresponding entry in the property_data table.
+but don't have a corresponding entry in the property_data table, or whose property is
+tombstoned (it was crawled before but has dropped out of the portal's search results).
+The crawl_status column tells the two apart: "never crawled" or "gone".
 
 Relationship:
 - buildings.extra_field_1 → property_data.fol_id
@@ -15,6 +17,8 @@ import csv
 from datetime import datetime
 from tabulate import tabulate
 from dotenv import load_dotenv
+from migrations import migrate
+from shards import federated_connection
 
 # Load environment variables
 load_dotenv()
@@ -47,30 +51,35 @@ def check_missing_records(db_path="extraction.db", report_path=None):
     if not report_path:
         report_path = f'missing_records_report_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
     
-    conn = sqlite3.connect(db_path)
+    conn = federated_connection(db_path)  # property_data spans all area shards
     conn.row_factory = sqlite3.Row  # This allows accessing columns by name
     
     logger.info("Checking for missing records...")
     
     try:
-        # Query to find buildings records with first_name that don't have a match in property_data
+        # Query to find buildings records with first_name that don't have a live match in property_data
         cursor = conn.execute("""
-            SELECT b.*
+            SELECT b.*,
+                   CASE WHEN p.fol_id IS NULL THEN 'never crawled' ELSE 'gone' END AS crawl_status,
+                   p.tombstoned_at
             FROM buildings b
             LEFT JOIN property_data p ON b.extra_field_1 = p.fol_id
             WHERE b.first_name IS NOT NULL 
               AND b.first_name != ''
-              AND p.fol_id IS NULL
+              AND (p.fol_id IS NULL OR p.tombstoned_at IS NOT NULL)
         """)
         
         missing_records = [dict(row) for row in cursor.fetchall()]
+        gone = sum(1 for record in missing_records if record['crawl_status'] == 'gone')
         
-        logger.info(f"Found {len(missing_records)} buildings with first_name data but no matching property_data record")
+        logger.info(f"Found {len(missing_records)} buildings with first_name data but no live property_data record "
+                    f"({len(missing_records) - gone} never crawled, {gone} gone from the portal)")
         
         # Display a summary table of the missing records
         if missing_records:
             # Define which columns to display in the summary table
-            summary_columns = ['record_id', 'building_name', 'extra_field_1', 'first_name', 'last_name', 'email', 'phone_1']
+            summary_columns = ['record_id', 'building_name', 'extra_field_1', 'first_name', 'last_name', 'email', 'phone_1',
+                               'crawl_status', 'tombstoned_at']
             summary_data = []
             
             for record in missing_records:
@@ -126,7 +135,7 @@ def generate_detailed_report(missing_records, csv_path=None, html_path=None):
     detail_columns = [
         'record_id', 'area_record_id', 'building_name', 'extra_field_1',
         'first_name', 'last_name', 'email', 'phone_1', 'phone_2',
-        'homes', 'offices', 'nvt', 'last_updated'
+        'homes', 'offices', 'nvt', 'last_updated', 'crawl_status', 'tombstoned_at'
     ]
     
     for record in missing_records:
@@ -161,7 +170,7 @@ def generate_detailed_report(missing_records, csv_path=None, html_path=None):
         "<body>",
         f"    <h1>Missing Records Report</h1>",
         f"    <div class='summary'>",
-        f"        <p>This report shows {len(missing_records)} buildings with contact data but no corresponding property record.</p>",
+        f"        <p>This report shows {len(missing_records)} buildings with contact data but no live property record (never crawled, or gone from the portal).</p>",
         f"        <p class='timestamp'>Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>",
         f"    </div>",
         "    <table>",
@@ -208,6 +217,8 @@ if __name__ == "__main__":
         logging.getLogger().setLevel(logging.DEBUG)
     
     try:
+        migrate(args.db_path)
+        
         # Run the main check
         missing_records = check_missing_records(
             db_path=args.db_path,
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+checkpoints.py
+
+Resumable crawl cursors.
+
+main() splits an area's result pages into ranges and gives each range to a
+session. Every range has a cursor in crawl_cursors (migration 13):
+
+    (area, start_page) -> end_page, session_id, run_id, page, ri, completed
+
+run_id is the run that started the crawl, i.e. its generation; a resumed
+crawl keeps it (see property_history.tombstone_unseen).
+
+page and ri (the data-ri of the result row) point at the last property whose
+row is committed. The DB writer stores the cursor in the same transaction as
+that row, so the two can never disagree: after a crash or a kill the cursor
+names exactly the last property that is on disk.
+
+On the next start, if the area has ranges that are not completed, main()
+resumes them instead of starting over: each session opens the cursor's page
+and skips every row up to and including its data-ri, so no detail page or
+protocol download that was already captured is visited again. Once all
+ranges are completed the next crawl starts from page 1.
+
+The cursors live in the database that holds the area's property_data (the
+shard, with sharding enabled), since they are written by its writer.
+"""
+import sqlite3
+import logging
+
+logger = logging.getLogger("checkpoints")
+
+CURSOR_UPSERT_SQL = """
+    INSERT INTO crawl_cursors (area, start_page, end_page, session_id, run_id, page, ri, completed)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(area, start_page) DO UPDATE SET
+        end_page = excluded.end_page,
+        session_id = excluded.session_id,
+        run_id = excluded.run_id,
+        page = excluded.page,
+        ri = excluded.ri,
+        completed = excluded.completed,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+
+def row_index(ri):
+    """data-ri attribute as an int, or None if it is missing or not a number."""
+    try:
+        return int(ri)
+    except (TypeError, ValueError):
+        return None
+
+
+class CrawlCursor:
+    """
+    Position of one page range of a crawl. page/ri are the last committed
+    row (ri None: nothing committed on page yet).
+    """
+    __slots__ = ("area", "start_page", "end_page", "session_id", "run_id", "page", "ri", "completed")
+
+    def __init__(self, area, start_page, end_page, session_id=None, run_id=None, page=None, ri=None, completed=False):
+        self.area = area
+        self.start_page = start_page
+        self.end_page = end_page
+        self.session_id = session_id
+        self.run_id = run_id
+        self.page = start_page if page is None else page
+        self.ri = ri
+        self.completed = bool(completed)
+
+    def advance(self, page, ri):
+        self.page = page
+        self.ri = row_index(ri)
+
+    def complete(self):
+        self.page = self.end_page
+        self.completed = True
+
+    def params(self):
+        """CURSOR_UPSERT_SQL parameters for the current position (a snapshot)."""
+        return (self.area, self.start_page, self.end_page, self.session_id, self.run_id,
+                self.page, self.ri, int(self.completed))
+
+    def __repr__(self):
+        state = "completed" if self.completed else f"page {self.page}, data-ri {self.ri}"
+        return f"CrawlCursor({self.area!r}, pages {self.start_page}-{self.end_page}, {state})"
+
+
+def load_cursors(db_path, area):
+    """The area's cursors, ordered by start_page."""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("""
+            SELECT area, start_page, end_page, session_id, run_id, page, ri, completed
+            FROM crawl_cursors WHERE area = ? ORDER BY start_page
+        """, (area,)).fetchall()
+    finally:
+        conn.close()
+    return [CrawlCursor(*row) for row in rows]
+
+
+def reset_cursors(db_path, area):
+    """Deletes the area's cursors, so the next crawl starts from page 1."""
+    conn = sqlite3.connect(db_path)
+    try:
+        deleted = conn.execute("DELETE FROM crawl_cursors WHERE area = ?", (area,)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return deleted
+
+
+def plan_ranges(db_path, area, total_pages, num_ranges, run_id):
+    """
+    Cursors for this crawl: the area's unfinished cursors if the previous
+    crawl was interrupted, otherwise num_ranges fresh ranges over total_pages
+    started by run_id. Returns (cursors, resumed).
+    """
+    pending = [cursor for cursor in load_cursors(db_path, area) if not cursor.completed]
+    if pending:
+        return pending, True
+
+    pages_per_range = total_pages // num_ranges
+    cursors = []
+    for i in range(num_ranges):
+        start_page = i * pages_per_range + 1
+        end_page = total_pages if i == num_ranges - 1 else (i + 1) * pages_per_range
+        cursors.append(CrawlCursor(area, start_page, end_page, run_id=run_id))
+    # Stored up front, so a range that never started is still resumed after a crash
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("DELETE FROM crawl_cursors WHERE area = ?", (area,))
+        conn.executemany(CURSOR_UPSERT_SQL, [cursor.params() for cursor in cursors])
+        conn.commit()
+    finally:
+        conn.close()
+    return cursors, False
+
+
+if __name__ == "__main__":
+    import argparse
+    from tabulate import tabulate
+    from migrations import migrate
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Inspect or reset crawl cursors')
+    parser.add_argument('--db-path', default='extraction.db', help='Database holding the area (its shard, if sharded)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    show_parser = subparsers.add_parser('show', help='Show the cursors of an area (default: all areas)')
+    show_parser.add_argument('--area', help='Area name')
+    reset_parser = subparsers.add_parser('reset', help='Forget the cursors of an area; the next crawl starts over')
+    reset_parser.add_argument('area', help='Area name')
+    args = parser.parse_args()
+
+    migrate(args.db_path)
+    if args.command == 'show':
+        conn = sqlite3.connect(args.db_path)
+        where, params = ("WHERE area = ?", (args.area,)) if args.area else ("", ())
+        rows = conn.execute(f"""
+            SELECT area, start_page || '-' || end_page, session_id, run_id, page, ri,
+                   CASE WHEN completed THEN 'yes' ELSE 'no' END, updated_at
+            FROM crawl_cursors {where} ORDER BY area, start_page
+        """, params).fetchall()
+        conn.close()
+        print(tabulate(rows, headers=["area", "pages", "session", "run", "page", "data-ri", "completed", "updated_at"],
+                       tablefmt="pretty"))
+    else:
+        logger.info(f"Deleted {reset_cursors(args.db_path, args.area)} cursors for {args.area}")
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+db_writer.py
+
+Single long-lived writer for extraction.db.
+
+All scraping sessions hand their rows to one PropertyDataWriter through an
+asyncio queue. The writer owns one persistent WAL-mode connection, sets up the
+schema migrations once at start-up and upserts whatever has queued up with one
+executemany per flush, inside a single transaction. Lookups go through a
+separate ReadPool of read-only connections so they never wait on the writer.
+
+In the same transaction as the upsert the writer appends a property_history
+version for every row whose data_hash changed (see property_history.py).
+It also links each row to its owner in the owners dimension, interning
+owners in memory so only new owners are inserted (see owners.py), and stores
+the crawl cursors submitted with the rows (see checkpoints.py). After the
+commit, the FoL-IDs whose data_hash changed are offered to an optional
+change listener (the streaming Airtable sync, see sync_stream.py).
+"""
+import asyncio
+import json
+import logging
+import time
+
+import aiosqlite
+
+from migrations import ensure_migrated
+from property_history import HISTORY_FIELDS, HISTORY_INSERT_SQL, field_deltas
+from record_hash import hash_record, changed_fields
+from normalize import normalized_property_values
+from property_record import PROPERTY_RECORD_FIELDS, as_record
+from owners import (OwnerInterner, OWNER_INSERT_SQL, LINK_UPSERT_SQL, LINK_DELETE_SQL, LINKED_OWNERS_SQL,
+                    ORPHAN_DELETE_SQL, replaced_owners)
+from checkpoints import CURSOR_UPSERT_SQL
+
+DB_PATH = "extraction.db"
+
+# Applied to every connection. WAL lets readers run while the writer commits;
+# synchronous=NORMAL is durable across application crashes in WAL mode.
+CONNECTION_PRAGMAS = [
+    "PRAGMA busy_timeout = 10000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+]
+
+# Fields of a row produced by extract_search_results()
+LIST_ROW_FIELDS = list(PROPERTY_RECORD_FIELDS)
+
+# Order of the values produced by upsert_params()
+UPSERT_COLUMNS = [
+    "fol_id", "session_id", "page", "street", "house_number", "house_appendix",
+    "owner_name", "owner_email", "owner_mobile", "owner_landline", "status",
+    "exploration", "exploration_pdf", "au", "bu", "nvt_area", "data_hash", "field_digests",
+    "au_count", "bu_count", "exploration_at", "owner_email_norm", "owner_mobile_norm", "owner_landline_norm",
+    "area", "seen_generation",
+]
+
+PROPERTY_UPSERT_SQL = """
+    INSERT INTO property_data
+    (fol_id, session_id, page, street, house_number, house_appendix, owner_name, owner_email, owner_mobile, owner_landline, status, exploration, exploration_pdf, au, bu, nvt_area, data_hash, field_digests,
+     au_count, bu_count, exploration_at, owner_email_norm, owner_mobile_norm, owner_landline_norm, area, seen_generation, changed_flag)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, 0), 0)
+    ON CONFLICT(fol_id) DO UPDATE SET
+        street = excluded.street,
+        house_number = excluded.house_number,
+        house_appendix = excluded.house_appendix,
+        owner_name = excluded.owner_name,
+        owner_email = excluded.owner_email,
+        owner_mobile = excluded.owner_mobile,
+        owner_landline = excluded.owner_landline,
+        status = excluded.status,
+        exploration = excluded.exploration,
+        exploration_pdf = excluded.exploration_pdf,
+        au = excluded.au,
+        bu = excluded.bu,
+        nvt_area = excluded.nvt_area,
+        data_hash = CASE WHEN property_data.data_hash <> excluded.data_hash THEN excluded.data_hash ELSE property_data.data_hash END,
+        field_digests = excluded.field_digests,
+        au_count = excluded.au_count,
+        bu_count = excluded.bu_count,
+        exploration_at = excluded.exploration_at,
+        owner_email_norm = excluded.owner_email_norm,
+        owner_mobile_norm = excluded.owner_mobile_norm,
+        owner_landline_norm = excluded.owner_landline_norm,
+        area = COALESCE(excluded.area, property_data.area),
+        seen_generation = MAX(property_data.seen_generation, excluded.seen_generation),
+        tombstoned_at = NULL,
+        tombstoned_run = NULL,
+        changed_flag = CASE WHEN property_data.data_hash <> excluded.data_hash THEN 1 ELSE 0 END,
+        last_updated = CURRENT_TIMESTAMP
+"""
+
+
+# Positions in the upsert parameters of the values OwnerInterner.resolve() needs
+OWNER_PARAM_POSITIONS = [UPSERT_COLUMNS.index(column) for column in (
+    "fol_id", "owner_name", "owner_email", "owner_mobile", "owner_landline",
+    "owner_email_norm", "owner_mobile_norm", "owner_landline_norm",
+)]
+
+
+def upsert_params(session_id, page_number, row, area=None, generation=None):
+    """
+    Builds the PROPERTY_UPSERT_SQL parameters for one extracted row (a
+    PropertyRecord, or a positional list row), including the normalized columns.
+    area is the crawl area; None keeps the stored one. generation is the crawl
+    generation that saw the row (see property_history.tombstone_unseen).
+    """
+    record = as_record(row)
+    data_hash, digests = hash_record(record)
+    return (record.fol_id, session_id, page_number, record.street, record.house_number, record.house_appendix,
+            record.owner_name, record.owner_email, record.owner_mobile, record.owner_landline,
+            record.status, record.exploration, record.exploration_pdf, record.au, record.bu, record.nvt_area,
+            data_hash, digests, *normalized_property_values(record), area, generation)
+
+
+async def apply_pragmas(db):
+    for pragma in CONNECTION_PRAGMAS:
+        await db.execute(pragma)
+
+
+class PropertyDataWriter:
+    """
+    Owns the only write connection to extraction.db for a run.
+
+    Sessions call submit(); the writer task collects everything queued at that
+    moment (up to max_batch_rows) and commits it in one transaction. submit()
+    returns a future that resolves once the rows are committed, so callers can
+    wait for durability when they need it. If a PriorStateCache is given it is
+    updated in place after every commit; a change_listener's offer() gets the
+    FoL-IDs whose data_hash changed and must not block.
+    """
+
+    def __init__(self, db_path=DB_PATH, max_batch_rows=500, queue_size=64, prior_state=None, run_id=None, area=None,
+                 generation=None, change_listener=None):
+        self.db_path = db_path
+        self.area = area
+        self.generation = generation
+        self.prior_state = prior_state
+        self.change_listener = change_listener
+        self.run_id = run_id
+        self.max_batch_rows = max_batch_rows
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.db = None
+        self.owners = None
+        self._task = None
+        self.stats = {'rows': 0, 'flushes': 0, 'flush_seconds': 0.0, 'errors': 0, 'history_versions': 0, 'new_owners': 0,
+                      'removed_owners': 0}
+
+    async def start(self):
+        await asyncio.to_thread(ensure_migrated, self.db_path)
+        self.db = await aiosqlite.connect(self.db_path, isolation_level=None)
+        await self.db.execute("PRAGMA journal_mode = WAL")
+        await apply_pragmas(self.db)
+        self.owners = await OwnerInterner.load_async(self.db)
+        self._task = asyncio.create_task(self._run())
+        logging.info(f"DB writer started on {self.db_path}")
+        return self
+
+    async def submit(self, session_id, page_number, rows, cursor=None):
+        """
+        Queues extracted rows for writing. cursor (CrawlCursor.params()) is
+        committed in the same transaction as the rows. Returns a future
+        resolved after commit.
+        """
+        future = asyncio.get_running_loop().create_future()
+        params = [upsert_params(session_id, page_number, row, self.area, self.generation) for row in rows]
+        await self.queue.put((params, cursor, future))
+        return future
+
+    async def _run(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            batch = [item]
+            row_count = len(item[0])
+            stop = False
+            while row_count < self.max_batch_rows and not self.queue.empty():
+                next_item = self.queue.get_nowait()
+                if next_item is None:
+                    stop = True
+                    break
+                batch.append(next_item)
+                row_count += len(next_item[0])
+            await self._flush(batch)
+            for _ in range(len(batch) + (1 if stop else 0)):
+                self.queue.task_done()
+            if stop:
+                break
+
+    async def _flush(self, batch):
+        params = [p for item_params, _, _ in batch for p in item_params]
+        cursors = [cursor for _, cursor, _ in batch if cursor is not None]
+        started = time.perf_counter()
+        try:
+            await self.db.execute("BEGIN IMMEDIATE")
+            history = await self._history_rows(params)
+            await self.db.executemany(PROPERTY_UPSERT_SQL, params)
+            if history:
+                await self.db.executemany(HISTORY_INSERT_SQL, history)
+            new_owners, removed_owners = await self._link_owners(params)
+            if cursors:
+                await self.db.executemany(CURSOR_UPSERT_SQL, cursors)
+            await self.db.execute("COMMIT")
+        except Exception as e:
+            self.stats['errors'] += 1
+            logging.error(f"DB writer failed to flush {len(params)} rows: {e}")
+            try:
+                await self.db.execute("ROLLBACK")
+            except Exception:
+                pass
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        elapsed = time.perf_counter() - started
+        # Only now are the new owner ids durable
+        self.owners.register(new_owners)
+        self.stats['new_owners'] += len(new_owners)
+        self.stats['removed_owners'] += removed_owners
+        if self.prior_state is not None:
+            self.prior_state.update_from_params(params)
+        if self.change_listener is not None and history:
+            # One history version per row whose data_hash changed
+            self.change_listener.offer([row[0] for row in history])
+        self.stats['rows'] += len(params)
+        self.stats['history_versions'] += len(history)
+        self.stats['flushes'] += 1
+        self.stats['flush_seconds'] += elapsed
+        logging.debug(f"DB writer committed {len(params)} rows in {elapsed * 1000:.1f} ms")
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(len(params))
+
+    async def _fetch_by_fol_id(self, sql, fol_ids):
+        rows = []
+        for start in range(0, len(fol_ids), 500):
+            chunk = fol_ids[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            async with self.db.execute(sql.format(placeholders=placeholders), chunk) as cursor:
+                rows.extend(await cursor.fetchall())
+        return rows
+
+    async def _history_rows(self, params):
+        """
+        HISTORY_INSERT_SQL parameters for the rows in params whose data_hash
+        differs from the stored one. Runs inside the flush transaction.
+        """
+        fol_ids = list({p[0] for p in params})
+        previous = {row[0]: (row[1], row[2]) for row in await self._fetch_by_fol_id(
+            "SELECT fol_id, data_hash, field_digests FROM property_data WHERE fol_id IN ({placeholders})", fol_ids)}
+
+        # Which fields changed comes from the digest vectors; only the old
+        # values of those fields are loaded afterwards for the deltas.
+        changed = []
+        for p in params:
+            values = dict(zip(UPSERT_COLUMNS, p))
+            old = previous.get(p[0])
+            if old is not None and old[0] == values["data_hash"]:
+                continue
+            fields = changed_fields(old[1] if old else None, values["field_digests"], old[0] if old else None, values["data_hash"])
+            changed.append((p[0], values, fields, old is not None))
+            previous[p[0]] = (values["data_hash"], values["field_digests"])
+        if not changed:
+            return []
+
+        old_values = {}
+        existing = list({fol_id for fol_id, _, _, had_row in changed if had_row})
+        if existing:
+            for row in await self._fetch_by_fol_id(
+                    f"SELECT fol_id, {', '.join(HISTORY_FIELDS)} FROM property_data WHERE fol_id IN ({{placeholders}})",
+                    existing):
+                old_values[row[0]] = dict(zip(HISTORY_FIELDS, row[1:]))
+
+        versions = dict(await self._fetch_by_fol_id(
+            "SELECT fol_id, MAX(version) FROM property_history WHERE fol_id IN ({placeholders}) GROUP BY fol_id",
+            list({fol_id for fol_id, _, _, _ in changed})))
+        history = []
+        for fol_id, values, fields, _ in changed:
+            deltas = field_deltas(old_values.get(fol_id), values, fields)
+            old_values[fol_id] = values
+            versions[fol_id] = (versions.get(fol_id) or 0) + 1
+            history.append((fol_id, versions[fol_id], self.run_id, values["data_hash"],
+                            json.dumps(deltas, ensure_ascii=False)))
+        return history
+
+    async def _link_owners(self, params):
+        """
+        Links the rows in params to their owners, inserting owners the interner
+        has not seen and deleting owners left without properties. Runs inside
+        the flush transaction; returns the {identity: owner_id} pairs to
+        register after commit and the number of owners deleted.
+        """
+        links, unlinked, new = self.owners.resolve([tuple(p[i] for i in OWNER_PARAM_POSITIONS) for p in params])
+        previous = dict(await self._fetch_by_fol_id(LINKED_OWNERS_SQL, [fol_id for fol_id, _ in links] + unlinked))
+        assigned = {}
+        for identity, values in new.items():
+            async with self.db.execute(OWNER_INSERT_SQL, values) as cursor:
+                assigned[identity] = (await cursor.fetchone())[0]
+        ids = self.owners.ids
+        linked = {fol_id: ids[identity] if identity in ids else assigned[identity] for fol_id, identity in links}
+        await self.db.executemany(LINK_UPSERT_SQL, linked.items())
+        if unlinked:
+            await self.db.executemany(LINK_DELETE_SQL, [(fol_id,) for fol_id in unlinked])
+        removed = 0
+        for owner_id in replaced_owners(previous, linked):
+            async with self.db.execute(ORPHAN_DELETE_SQL, (owner_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                # Forgotten right away: a rollback only leaves the interner missing an existing identity
+                self.owners.forget([row[0]])
+                removed += 1
+        return assigned, removed
+
+    async def close(self):
+        """Drains the queue, stops the writer task and closes the connection."""
+        if self._task is not None:
+            await self.queue.put(None)
+            await self._task
+            self._task = None
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+        logging.info(f"DB writer closed: {self.stats['rows']} rows in {self.stats['flushes']} flushes "
+                     f"({self.stats['flush_seconds']:.2f}s), {self.stats['history_versions']} history versions, "
+                     f"{self.stats['new_owners']} new owners, {self.stats['removed_owners']} removed owners, "
+                     f"{self.stats['errors']} errors")
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+class ReadPool:
+    """Small pool of read-only connections for lookups while the writer is busy."""
+
+    def __init__(self, db_path=DB_PATH, size=4):
+        self.db_path = db_path
+        self.size = size
+        self._pool = asyncio.Queue()
+        self._connections = []
+
+    async def start(self):
+        for _ in range(self.size):
+            db = await aiosqlite.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            await apply_pragmas(db)
+            self._connections.append(db)
+            self._pool.put_nowait(db)
+        return self
+
+    def connection(self):
+        return _PooledConnection(self._pool)
+
+    async def fetchone(self, sql, params=()):
+        async with self.connection() as db:
+            async with db.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        async with self.connection() as db:
+            async with db.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def close(self):
+        for db in self._connections:
+            await db.close()
+        self._connections.clear()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+class _PooledConnection:
+    def __init__(self, pool):
+        self._pool = pool
+        self._db = None
+
+    async def __aenter__(self):
+        self._db = await self._pool.get()
+        return self._db
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._pool.put_nowait(self._db)
+        self._db = None
@@ -0,0 +1,820 @@
+#!/usr/bin/env python3
+"""
+migrations.py
+
+Versioned schema migrations for extraction.db.
+
+Every schema change is an ordered, numbered migration. migrate() applies the
+ones the database has not seen yet, records them in schema_version and is
+called once at start-up by the scraper and the sync tools, so the write paths
+never inspect the schema themselves.
+
+Migrations run inside one BEGIN EXCLUSIVE transaction, so two processes
+starting at the same time cannot apply the same migration twice: the second
+one waits for the lock, re-reads schema_version and finds nothing to do.
+
+To change the schema, append a new (version, description, function) entry to
+MIGRATIONS. Never edit or reorder a migration that has already shipped.
+
+A migration must do the same on a fresh database years from now, so it
+never calls into the modules that keep evolving (record_hash, normalize,
+owners, search, planning). The hashing, normalization and generated SQL a
+shipped migration needs are frozen below as copies of the code it shipped
+with. A later change to that logic gets a new migration, not an edit here.
+"""
+import re
+import zlib
+import sqlite3
+import hashlib
+import logging
+from array import array
+from datetime import datetime
+
+logger = logging.getLogger("migrations")
+
+PROPERTY_DATA_COLUMNS = {
+    "session_id": "INTEGER",
+    "page": "INTEGER",
+    "street": "TEXT",
+    "house_number": "TEXT",
+    "house_appendix": "TEXT",
+    "owner_name": "TEXT",
+    "owner_email": "TEXT",
+    "owner_mobile": "TEXT",
+    "owner_landline": "TEXT",
+    "status": "TEXT",
+    "exploration": "TEXT",
+    "exploration_pdf": "TEXT",
+    "au": "TEXT",
+    "bu": "TEXT",
+    "nvt_area": "TEXT",
+    "data_hash": "TEXT",
+    "changed_flag": "INTEGER DEFAULT 0",
+}
+
+BUILDINGS_COLUMNS = {
+    "area_record_id": "TEXT",
+    "building_name": "TEXT",
+    "extra_field_1": "TEXT",
+    "extra_field_2": "TEXT",
+    "extra_field_3": "TEXT",
+    "first_name": "TEXT",
+    "last_name": "TEXT",
+    "phone_1": "TEXT",
+    "phone_2": "TEXT",
+    "email": "TEXT",
+    "homes": "INTEGER",
+    "offices": "INTEGER",
+    "nvt": "TEXT",
+}
+
+# Databases already migrated by this process (see ensure_migrated)
+_migrated_paths = set()
+
+
+def _table_columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _table_exists(conn, table):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+    return row is not None
+
+
+def _create_or_extend(conn, table, key_definition, columns):
+    """
+    Creates table with all columns, or adds the ones missing from a table that
+    was created by an older, unversioned release.
+    """
+    if not _table_exists(conn, table):
+        definitions = [key_definition] + [f"{name} {column_type}" for name, column_type in columns.items()]
+        definitions.append("last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+        conn.execute(f"CREATE TABLE {table} ({', '.join(definitions)})")
+        return
+    existing = _table_columns(conn, table)
+    for name, column_type in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+            logger.info(f"Added missing column {name} to {table}")
+    if "last_updated" not in existing:
+        # ALTER TABLE cannot add a CURRENT_TIMESTAMP default
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN last_updated TIMESTAMP")
+
+
+# -------------------------------
+# Frozen helpers (as shipped with the migrations that use them)
+# -------------------------------
+# Migration 7: record_hash.hash_record
+_V7_HASHED_FIELDS = [
+    "street", "house_number", "house_appendix",
+    "owner_name", "owner_email", "owner_mobile", "owner_landline",
+    "exploration", "au", "bu", "nvt_area",
+]
+_V7_ROW_HASHER = hashlib.blake2b(digest_size=16, key=b"extraction.db/property_data", person=b"property_row")
+_V7_FIELD_SEEDS = [zlib.crc32(field.encode("utf-8")) for field in _V7_HASHED_FIELDS]
+
+
+def _v7_hash_record(values):
+    """(data_hash hex, field_digests bytes) for a {field: value} mapping."""
+    texts = ["" if value is None else value if isinstance(value, str) else str(value)
+             for value in map(values.get, _V7_HASHED_FIELDS)]
+    joined = "\x00".join(texts).encode("utf-8")
+    hasher = _V7_ROW_HASHER.copy()
+    hasher.update(joined)
+    parts = joined.split(b"\x00")
+    if len(parts) != len(_V7_HASHED_FIELDS):
+        parts = [text.encode("utf-8") for text in texts]
+    return hasher.hexdigest(), array("I", map(zlib.crc32, parts, _V7_FIELD_SEEDS)).tobytes()
+
+
+# Migration 8: normalize.py
+_V8_EXPLORATION_PREFIX = re.compile(r"^\s*Exploration done:\s*")
+_V8_EXPLORATION_FORMATS = [
+    "%m/%d/%Y %I:%M%p", "%m/%d/%Y %I:%M %p", "%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y",
+    "%m/%d/%Y %H:%M", "%m/%d/%Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d",
+]
+
+
+def _v8_unit_count(value):
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return int(float(text.replace(",", ".")))
+        except ValueError:
+            return None
+
+
+def _v8_strip_exploration_prefix(value):
+    if not value:
+        return value
+    return _V8_EXPLORATION_PREFIX.sub("", str(value)).strip()
+
+
+def _v8_exploration_timestamp(value):
+    text = _v8_strip_exploration_prefix(value)
+    if not text:
+        return None
+    for fmt in _V8_EXPLORATION_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def _v8_email(value):
+    if not value:
+        return None
+    return str(value).strip().lower() or None
+
+
+def _v8_phone(value):
+    if not value:
+        return None
+    text = str(value).strip().replace("(0)", "")
+    digits = re.sub(r"\D", "", text)
+    if not digits:
+        return None
+    if text.startswith("+"):
+        return f"+{digits}"
+    if digits.startswith("00"):
+        return f"+{digits[2:]}"
+    if digits.startswith("0"):
+        return f"+49{digits[1:]}"
+    return f"+49{digits}"
+
+
+# Migration 10: owners.link_owners
+_V10_OWNER_INSERT_SQL = """
+    INSERT INTO owners (identity, name, name_key, email, mobile, landline, email_norm, mobile_norm, landline_norm)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(identity) DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+    RETURNING owner_id
+"""
+
+
+def _v10_link_owners(conn):
+    """Interns the owner of every property_data row and links it. Returns the number of owners."""
+    owner_ids = {}
+    links = []
+    for fol_id, name, email, mobile, landline, email_norm, mobile_norm, landline_norm in conn.execute("""
+        SELECT fol_id, owner_name, owner_email, owner_mobile, owner_landline,
+               owner_email_norm, owner_mobile_norm, owner_landline_norm
+        FROM property_data
+    """).fetchall():
+        key = " ".join(str(name).casefold().split()) if name else ""
+        parts = (key, email_norm or "", mobile_norm or "", landline_norm or "")
+        if not any(parts):
+            continue
+        identity = "\x1f".join(parts)
+        if identity not in owner_ids:
+            owner_ids[identity] = conn.execute(_V10_OWNER_INSERT_SQL, (
+                identity, name, key, email, mobile, landline, email_norm, mobile_norm, landline_norm)).fetchone()[0]
+        links.append((fol_id, owner_ids[identity]))
+    conn.executemany("""
+        INSERT INTO property_owners (fol_id, owner_id) VALUES (?, ?)
+        ON CONFLICT(fol_id) DO UPDATE SET owner_id = excluded.owner_id, linked_at = CURRENT_TIMESTAMP
+        WHERE property_owners.owner_id <> excluded.owner_id
+    """, links)
+    return len(owner_ids)
+
+
+# Migration 11: search.create_search_index
+_V11_SEARCH_COLUMNS = "fol_id, street, house, owner, contact, nvt_area"
+_V11_SEARCH_VALUES_SQL = """
+    {row}.fol_id,
+    {row}.street,
+    TRIM(COALESCE({row}.house_number, '') || ' ' || COALESCE({row}.house_number, '') || COALESCE({row}.house_appendix, '')),
+    {row}.owner_name,
+    TRIM(COALESCE({row}.owner_email, '') || ' ' || COALESCE({row}.owner_mobile, '') || ' ' || COALESCE({row}.owner_landline, '')
+         || ' ' || COALESCE({row}.owner_mobile_norm, '') || ' ' || COALESCE({row}.owner_landline_norm, '')),
+    {row}.nvt_area
+"""
+_V11_INDEXED_SOURCE_COLUMNS = [
+    "fol_id", "street", "house_number", "house_appendix", "owner_name", "owner_email",
+    "owner_mobile", "owner_landline", "owner_mobile_norm", "owner_landline_norm", "nvt_area",
+]
+
+
+# Migrations 12 and 14: planning.create_planning_tables (14 adds the tombstone filter)
+_V12_BOX_TYPES = [
+    (1, "Box: G-AP OneBox XS (1WE), 10er Pack | Material Nr.:47122083"),
+    (3, "Box: GI-AP OneBox  1 - 3 WE | Material Nr.:47100635"),
+    (8, "Box: GI-AP OneBox  4 - 8 WE | Material Nr.:47100636"),
+    (12, "Box: GI-AP OneBox  9 -12 WE | Material Nr.:47100637"),
+    (20, "Box: GI-AP OneBox 13 - 20 WE | Material Nr.:47100638"),
+    (32, "Box: GI-AP OneBox 21 - 32 WE | Material Nr.:47100639"),
+]
+_V12_OVERSIZE_BOX = "No OneBox (> 32 WE)"
+_V12_SCOPES = {'nvt': 'nvt_area', 'area': 'area'}
+_V12_COUNTED_COLUMNS = [
+    "nvt_area", "area", "au_count", "bu_count", "owner_name", "owner_email",
+    "owner_mobile", "owner_landline", "exploration",
+]
+_V12_SUMMARY_COLUMNS = ["properties", "au_total", "bu_total", "with_owner", "with_exploration"]
+
+
+def _v12_units_sql(row):
+    return f"(COALESCE({row}.au_count, 0) + COALESCE({row}.bu_count, 0))"
+
+
+def _v12_box_type_sql(row):
+    units = _v12_units_sql(row)
+    whens = " ".join(f"WHEN {units} <= {max_units} THEN '{description}'" for max_units, description in _V12_BOX_TYPES)
+    return f"CASE {whens} ELSE '{_V12_OVERSIZE_BOX}' END"
+
+
+def _v12_summary_values_sql(row):
+    return [
+        "1",
+        f"COALESCE({row}.au_count, 0)",
+        f"COALESCE({row}.bu_count, 0)",
+        f"(COALESCE({row}.owner_name, '') || COALESCE({row}.owner_email, '') || "
+        f"COALESCE({row}.owner_mobile, '') || COALESCE({row}.owner_landline, '') <> '')",
+        f"(COALESCE({row}.exploration, '') <> '')",
+    ]
+
+
+def _v12_delta_sql(row, sign, tombstones):
+    live = f"{row}.tombstoned_at IS NULL" if tombstones else "1"
+    statements = []
+    for scope, column in _V12_SCOPES.items():
+        key = f"COALESCE({row}.{column}, '')"
+        values = ", ".join(f"{sign}{value}" for value in _v12_summary_values_sql(row))
+        updates = ", ".join(f"{name} = {name} + excluded.{name}" for name in _V12_SUMMARY_COLUMNS)
+        statements.append(f"""
+            INSERT INTO planning_summary (scope, key, {', '.join(_V12_SUMMARY_COLUMNS)})
+            SELECT '{scope}', {key}, {values} WHERE {live}
+            ON CONFLICT(scope, key) DO UPDATE SET {updates};""")
+        statements.append(f"""
+            INSERT INTO planning_boxes (scope, key, box_type, boxes)
+            SELECT '{scope}', {key}, {_v12_box_type_sql(row)}, {sign}1 WHERE {live} AND {_v12_units_sql(row)} > 0
+            ON CONFLICT(scope, key, box_type) DO UPDATE SET boxes = boxes + excluded.boxes;""")
+    return "".join(statements)
+
+
+def _v12_planning_tables(conn, tombstones):
+    """Creates the planning summaries, (re)creates their triggers and fills them."""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS planning_summary (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            {', '.join(f'{name} INTEGER NOT NULL DEFAULT 0' for name in _V12_SUMMARY_COLUMNS)},
+            PRIMARY KEY (scope, key)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS planning_boxes (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            box_type TEXT NOT NULL,
+            boxes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, key, box_type)
+        ) WITHOUT ROWID
+    """)
+    counted = _V12_COUNTED_COLUMNS + (["tombstoned_at"] if tombstones else [])
+    changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in counted)
+    for trigger in ("planning_insert", "planning_update", "planning_delete"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute(f"""
+        CREATE TRIGGER planning_insert AFTER INSERT ON property_data BEGIN
+            {_v12_delta_sql('NEW', '+', tombstones)}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER planning_update AFTER UPDATE ON property_data
+        WHEN {changed} BEGIN
+            {_v12_delta_sql('OLD', '-', tombstones)}
+            {_v12_delta_sql('NEW', '+', tombstones)}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER planning_delete AFTER DELETE ON property_data BEGIN
+            {_v12_delta_sql('OLD', '-', tombstones)}
+        END
+    """)
+    conn.execute("DELETE FROM planning_summary")
+    conn.execute("DELETE FROM planning_boxes")
+    live = "property_data.tombstoned_at IS NULL" if tombstones else "1"
+    for scope, column in _V12_SCOPES.items():
+        sums = ", ".join(f"SUM({value})" for value in _v12_summary_values_sql("property_data"))
+        conn.execute(f"""
+            INSERT INTO planning_summary (scope, key, {', '.join(_V12_SUMMARY_COLUMNS)})
+            SELECT '{scope}', COALESCE({column}, ''), {sums} FROM property_data WHERE {live} GROUP BY 2
+        """)
+        conn.execute(f"""
+            INSERT INTO planning_boxes (scope, key, box_type, boxes)
+            SELECT '{scope}', COALESCE({column}, ''), {_v12_box_type_sql('property_data')}, COUNT(*)
+            FROM property_data WHERE {live} AND {_v12_units_sql('property_data')} > 0 GROUP BY 2, 3
+        """)
+
+
+# -------------------------------
+# Migrations
+# -------------------------------
+def _001_property_data(conn):
+    _create_or_extend(conn, "property_data", "fol_id TEXT PRIMARY KEY", PROPERTY_DATA_COLUMNS)
+
+
+def _002_buildings(conn):
+    _create_or_extend(conn, "buildings", "record_id TEXT PRIMARY KEY", BUILDINGS_COLUMNS)
+
+
+def _003_airtable_sync(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS airtable_sync (
+            fol_id TEXT PRIMARY KEY,
+            airtable_record_id TEXT,
+            area TEXT,
+            building TEXT,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _004_retire_multi_session_tables(conn):
+    # Left behind by old/multi_session_extractor.py. Renamed, not dropped,
+    # so nothing is lost if someone still needs them.
+    for table in ("properties", "sessions"):
+        if _table_exists(conn, table) and not _table_exists(conn, f"legacy_{table}"):
+            conn.execute(f"ALTER TABLE {table} RENAME TO legacy_{table}")
+            logger.info(f"Renamed legacy table {table} to legacy_{table}")
+
+
+def _005_buildings_fol_id_index(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_buildings_extra_field_1 ON buildings(extra_field_1)")
+
+
+def _006_property_history(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS crawl_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            area TEXT,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS property_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fol_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            run_id INTEGER,
+            data_hash TEXT,
+            changes TEXT,
+            recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_property_history_fol_version ON property_history(fol_id, version)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_history_run ON property_history(run_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_history_recorded ON property_history(recorded_at)")
+
+
+def _007_field_digests(conn):
+    # Re-hash existing rows with the field-aware hasher so the switch from the
+    # positional SHA-256 does not show up as a change on every property.
+    if "field_digests" not in _table_columns(conn, "property_data"):
+        conn.execute("ALTER TABLE property_data ADD COLUMN field_digests BLOB")
+    rows = conn.execute(f"SELECT fol_id, {', '.join(_V7_HASHED_FIELDS)} FROM property_data").fetchall()
+    updates = []
+    for row in rows:
+        data_hash, digests = _v7_hash_record(dict(zip(_V7_HASHED_FIELDS, row[1:])))
+        updates.append((data_hash, digests, row[0]))
+    conn.executemany("UPDATE property_data SET data_hash = ?, field_digests = ? WHERE fol_id = ?", updates)
+    logger.info(f"Re-hashed {len(updates)} property_data rows")
+
+
+def _008_normalized_columns(conn):
+    existing = _table_columns(conn, "property_data")
+    for column, column_type in [("au_count", "INTEGER"), ("bu_count", "INTEGER"), ("exploration_at", "TEXT"),
+                                ("owner_email_norm", "TEXT"), ("owner_mobile_norm", "TEXT"),
+                                ("owner_landline_norm", "TEXT")]:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE property_data ADD COLUMN {column} {column_type}")
+    rows = conn.execute("SELECT fol_id, au, bu, exploration, owner_email, owner_mobile, owner_landline FROM property_data")
+    conn.executemany("""
+        UPDATE property_data SET au_count = ?, bu_count = ?, exploration_at = ?,
+            owner_email_norm = ?, owner_mobile_norm = ?, owner_landline_norm = ?
+        WHERE fol_id = ?
+    """, [(_v8_unit_count(au), _v8_unit_count(bu), _v8_exploration_timestamp(exploration), _v8_email(email),
+           _v8_phone(mobile), _v8_phone(landline), fol_id)
+          for fol_id, au, bu, exploration, email, mobile, landline in rows.fetchall()])
+
+    existing = _table_columns(conn, "buildings")
+    for column in ("exploration_date", "exploration_at"):
+        if column not in existing:
+            conn.execute(f"ALTER TABLE buildings ADD COLUMN {column} TEXT")
+    rows = conn.execute("SELECT record_id, extra_field_3 FROM buildings").fetchall()
+    conn.executemany("UPDATE buildings SET exploration_date = ?, exploration_at = ? WHERE record_id = ?", [
+        (_v8_strip_exploration_prefix(value), _v8_exploration_timestamp(value), record_id) for record_id, value in rows
+    ])
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_data_exploration_at ON property_data(exploration_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_data_email_norm ON property_data(owner_email_norm)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_data_mobile_norm ON property_data(owner_mobile_norm)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_data_landline_norm ON property_data(owner_landline_norm)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_data_nvt_area ON property_data(nvt_area)")
+
+
+def _009_shard_catalog(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shards (
+            area TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _010_owners(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS owners (
+            owner_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            identity TEXT NOT NULL UNIQUE,
+            name TEXT,
+            name_key TEXT,
+            email TEXT,
+            mobile TEXT,
+            landline TEXT,
+            email_norm TEXT,
+            mobile_norm TEXT,
+            landline_norm TEXT,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS property_owners (
+            fol_id TEXT PRIMARY KEY,
+            owner_id INTEGER NOT NULL REFERENCES owners(owner_id),
+            linked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_owners_name_key ON owners(name_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_owners_email_norm ON owners(email_norm)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_owners_mobile_norm ON owners(mobile_norm)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_owners_landline_norm ON owners(landline_norm)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_owners_owner ON property_owners(owner_id)")
+    logger.info(f"Linked property_data to {_v10_link_owners(conn)} owners")
+
+
+def _011_property_search(conn):
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS property_search USING fts5(
+            {_V11_SEARCH_COLUMNS},
+            tokenize = "unicode61 remove_diacritics 2",
+            prefix = '2 3'
+        )
+    """)
+    changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in _V11_INDEXED_SOURCE_COLUMNS)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS property_search_insert AFTER INSERT ON property_data BEGIN
+            INSERT INTO property_search (rowid, {_V11_SEARCH_COLUMNS})
+            VALUES (NEW.rowid, {_V11_SEARCH_VALUES_SQL.format(row='NEW')});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS property_search_update AFTER UPDATE ON property_data
+        WHEN {changed} BEGIN
+            DELETE FROM property_search WHERE rowid = OLD.rowid;
+            INSERT INTO property_search (rowid, {_V11_SEARCH_COLUMNS})
+            VALUES (NEW.rowid, {_V11_SEARCH_VALUES_SQL.format(row='NEW')});
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS property_search_delete AFTER DELETE ON property_data BEGIN
+            DELETE FROM property_search WHERE rowid = OLD.rowid;
+        END
+    """)
+    conn.execute("DELETE FROM property_search")
+    conn.execute(f"""
+        INSERT INTO property_search (rowid, {_V11_SEARCH_COLUMNS})
+        SELECT rowid, {_V11_SEARCH_VALUES_SQL.format(row='property_data')} FROM property_data
+    """)
+    conn.execute("INSERT INTO property_search (property_search) VALUES ('optimize')")
+
+
+def _012_planning_aggregates(conn):
+    # Crawl area of each property, taken from the run that first recorded it
+    if "area" not in _table_columns(conn, "property_data"):
+        conn.execute("ALTER TABLE property_data ADD COLUMN area TEXT")
+    conn.execute("""
+        UPDATE property_data SET area = (
+            SELECT r.area FROM property_history h JOIN crawl_runs r ON r.run_id = h.run_id
+            WHERE h.fol_id = property_data.fol_id AND h.version = 1
+        )
+        WHERE area IS NULL
+    """)
+    _v12_planning_tables(conn, tombstones=False)
+
+
+def _013_crawl_cursors(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS crawl_cursors (
+            area TEXT NOT NULL,
+            start_page INTEGER NOT NULL,
+            end_page INTEGER NOT NULL,
+            session_id INTEGER,
+            run_id INTEGER,
+            page INTEGER NOT NULL,
+            ri INTEGER,
+            completed INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (area, start_page)
+        )
+    """)
+
+
+
+def _014_tombstones(conn):
+    existing = _table_columns(conn, "property_data")
+    for column, column_type in [("seen_generation", "INTEGER NOT NULL DEFAULT 0"), ("tombstoned_at", "TIMESTAMP"),
+                                ("tombstoned_run", "INTEGER")]:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE property_data ADD COLUMN {column} {column_type}")
+    if "generation" not in _table_columns(conn, "crawl_runs"):
+        conn.execute("ALTER TABLE crawl_runs ADD COLUMN generation INTEGER")
+    conn.execute("UPDATE crawl_runs SET generation = run_id WHERE generation IS NULL")
+    # Live rows of an area by generation: the set difference at the end of a crawl
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_property_data_area_generation
+        ON property_data(area, seen_generation) WHERE tombstoned_at IS NULL
+    """)
+    # Recreate the planning triggers so tombstoned rows are not counted
+    _v12_planning_tables(conn, tombstones=True)
+
+
+
+def _015_sync_state(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            fol_id TEXT PRIMARY KEY,
+            record_id TEXT,
+            data_hash TEXT,
+            snapshot_digest TEXT,
+            synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sync_run TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sync_state_pending ON sync_state(fol_id) WHERE data_hash IS NULL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_watermarks (
+            source TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_property_data_last_updated ON property_data(last_updated)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_buildings_last_updated ON buildings(last_updated)")
+
+
+
+def _016_sync_plans(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_plans (
+            plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            mode TEXT,
+            compared INTEGER,
+            records INTEGER,
+            deferred INTEGER,
+            status TEXT DEFAULT 'planned',
+            applied_at TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_plan_records (
+            plan_id INTEGER NOT NULL,
+            fol_id TEXT NOT NULL,
+            record_id TEXT NOT NULL,
+            data_hash TEXT,
+            status TEXT DEFAULT 'planned',
+            error TEXT,
+            PRIMARY KEY (plan_id, fol_id)
+        ) WITHOUT ROWID
+    """)
+    # base_value/new_value are untyped, so Airtable numbers and text keep their type
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_plan_changes (
+            plan_id INTEGER NOT NULL,
+            fol_id TEXT NOT NULL,
+            field TEXT NOT NULL,
+            base_value,
+            new_value,
+            PRIMARY KEY (plan_id, fol_id, field)
+        ) WITHOUT ROWID
+    """)
+
+
+def _017_snapshot_refreshes(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot_refreshes (
+            area TEXT PRIMARY KEY,
+            area_record_id TEXT,
+            started_at TEXT,
+            full_refresh_at TEXT,
+            records INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+
+def _018_airtable_outbox(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS airtable_outbox (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_id TEXT NOT NULL,
+            fol_id TEXT,
+            plan_id INTEGER,
+            fields TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            acked_at TIMESTAMP
+        )
+    """)
+    # The drain reads pending entries grouped by record, oldest first
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_airtable_outbox_pending ON airtable_outbox(record_id, entry_id)
+        WHERE status = 'pending'
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_airtable_outbox_plan ON airtable_outbox(plan_id, fol_id)")
+
+
+def _019_shared_shard_files(conn):
+    # Several areas may share a shard file, so path is no longer unique
+    conn.execute("""
+        CREATE TABLE shards_new (
+            area TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("INSERT INTO shards_new (area, path, created_at) SELECT area, path, created_at FROM shards")
+    conn.execute("DROP TABLE shards")
+    conn.execute("ALTER TABLE shards_new RENAME TO shards")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shards_path ON shards(path)")
+
+
+def _020_orphaned_owners(conn):
+    # Owners left behind by relinked or unlinked properties; the writer now deletes them itself
+    deleted = conn.execute("""
+        DELETE FROM owners
+        WHERE NOT EXISTS (SELECT 1 FROM property_owners l WHERE l.owner_id = owners.owner_id)
+    """).rowcount
+    logger.info(f"Deleted {deleted} owners without properties")
+
+
+MIGRATIONS = [
+    (1, "property_data table", _001_property_data),
+    (2, "buildings table", _002_buildings),
+    (3, "airtable_sync table", _003_airtable_sync),
+    (4, "retire multi-session extractor tables", _004_retire_multi_session_tables),
+    (5, "index buildings by FoL-ID", _005_buildings_fol_id_index),
+    (6, "crawl_runs and property_history tables", _006_property_history),
+    (7, "field digest vectors for property_data", _007_field_digests),
+    (8, "typed, normalized columns", _008_normalized_columns),
+    (9, "per-area shard catalog", _009_shard_catalog),
+    (10, "owners dimension and property_owners links", _010_owners),
+    (11, "full-text search index over property_data", _011_property_search),
+    (12, "crawl area column and planning aggregates", _012_planning_aggregates),
+    (13, "resumable crawl cursors", _013_crawl_cursors),
+    (14, "crawl generations and tombstones", _014_tombstones),
+    (15, "synced-state digests and sync watermarks", _015_sync_state),
+    (16, "persisted Airtable sync plans", _016_sync_plans),
+    (17, "incremental Airtable snapshot refreshes", _017_snapshot_refreshes),
+    (18, "durable outbox for Airtable updates", _018_airtable_outbox),
+    (19, "shard files shared by several areas", _019_shared_shard_files),
+    (20, "delete owners without properties", _020_orphaned_owners),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    """Highest applied migration, 0 for a database that has never been migrated."""
+    if not _table_exists(conn, "schema_version"):
+        return 0
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(db_path="extraction.db", timeout=60.0):
+    """
+    Applies all pending migrations to db_path. Safe to call from several
+    processes at once. Returns the schema version after migrating.
+    """
+    conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+    try:
+        if current_version(conn) >= LATEST_VERSION:
+            return LATEST_VERSION
+        conn.execute("BEGIN EXCLUSIVE")
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            version = current_version(conn)
+            for migration_version, description, apply in MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                logger.info(f"Applying migration {migration_version}: {description}")
+                apply(conn)
+                conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                             (migration_version, description))
+                version = migration_version
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return version
+    finally:
+        conn.close()
+
+
+def ensure_migrated(db_path="extraction.db"):
+    """migrate() at most once per process and database path."""
+    if db_path not in _migrated_paths:
+        migrate(db_path)
+        _migrated_paths.add(db_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Apply or inspect extraction.db schema migrations')
+    parser.add_argument('command', nargs='?', default='migrate', choices=['migrate', 'status'])
+    parser.add_argument('--db-path', default='extraction.db', help='Path to the SQLite database')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        version = migrate(args.db_path)
+        logger.info(f"{args.db_path} is at schema version {version}")
+    else:
+        conn = sqlite3.connect(args.db_path)
+        version = current_version(conn)
+        applied = []
+        if version:
+            applied = conn.execute("SELECT version, description, applied_at FROM schema_version ORDER BY version").fetchall()
+        conn.close()
+        for row in applied:
+            print(f"  {row[0]:>3}  {row[1]}  ({row[2]})")
+        pending = [m for m in MIGRATIONS if m[0] > version]
+        for migration_version, description, _ in pending:
+            print(f"  {migration_version:>3}  {description}  (pending)")
+        print(f"Schema version {version}, latest {LATEST_VERSION}, {len(pending)} pending")
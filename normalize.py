@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+normalize.py
+
+Normalization of raw portal/Airtable values, applied once at write time.
+
+The raw text stays in its original column; the normalized value goes into a
+typed, indexed column next to it (see migration 8 in migrations.py):
+
+    au                -> au_count (INTEGER)
+    bu                -> bu_count (INTEGER)
+    exploration       -> exploration_at (ISO-8601 TEXT)
+    owner_email       -> owner_email_norm
+    owner_mobile      -> owner_mobile_norm
+    owner_landline    -> owner_landline_norm
+
+buildings gets exploration_date (the date with the "Exploration done:" prefix
+removed) and exploration_at, so the sync no longer runs a regex per record.
+"""
+import re
+from datetime import datetime
+
+EXPLORATION_PREFIX = re.compile(r"^\s*Exploration done:\s*")
+
+# Formats seen in the portal and in Airtable's "Exploration done: ..." values
+EXPLORATION_FORMATS = [
+    "%m/%d/%Y %I:%M%p",
+    "%m/%d/%Y %I:%M %p",
+    "%d.%m.%Y %H:%M:%S",
+    "%d.%m.%Y %H:%M",
+    "%d.%m.%Y",
+    "%m/%d/%Y %H:%M",
+    "%m/%d/%Y",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d",
+]
+
+DEFAULT_COUNTRY_CODE = "49"
+
+# Columns added to property_data and the raw column they are derived from
+PROPERTY_NORMALIZED_COLUMNS = [
+    "au_count", "bu_count", "exploration_at",
+    "owner_email_norm", "owner_mobile_norm", "owner_landline_norm",
+]
+
+
+def parse_unit_count(value):
+    """'12' -> 12. Empty or non-numeric values give None."""
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return int(float(text.replace(",", ".")))
+        except ValueError:
+            return None
+
+
+def strip_exploration_prefix(value):
+    """'Exploration done: 6/1/2024 01:01AM' -> '6/1/2024 01:01AM'."""
+    if not value:
+        return value
+    return EXPLORATION_PREFIX.sub("", str(value)).strip()
+
+
+def parse_exploration_timestamp(value):
+    """
+    Parses a raw exploration date (with or without the "Exploration done:"
+    prefix) into an ISO-8601 string ('2024-06-01T01:01:00'). Returns None if
+    the value is empty or in an unknown format.
+    """
+    text = strip_exploration_prefix(value)
+    if not text:
+        return None
+    for fmt in EXPLORATION_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def extract_fol_id(text):
+    """
+    Extracts and returns the numeric part from a string like 'FoL-ID: 1000004314821'.
+    If no match is found, returns the original text.
+    """
+    if text:
+        match = re.search(r"FoL-ID:\s*(\d+)", text)
+        if match:
+            return match.group(1)
+    return text
+
+
+def canonical_email(value):
+    """Trimmed, lower-cased email; None if empty."""
+    if not value:
+        return None
+    email = str(value).strip().lower()
+    return email or None
+
+
+def canonical_phone(value, country_code=DEFAULT_COUNTRY_CODE):
+    """
+    German phone numbers in E.164 form: '0151 234-567' -> '+49151234567',
+    '0049 30 123' -> '+4930123', '+49 (0) 30 123' -> '+4930123'.
+    Returns None if the value has no digits.
+    """
+    if not value:
+        return None
+    text = str(value).strip()
+    text = text.replace("(0)", "")
+    has_plus = text.startswith("+")
+    digits = re.sub(r"\D", "", text)
+    if not digits:
+        return None
+    if has_plus:
+        return f"+{digits}"
+    if digits.startswith("00"):
+        return f"+{digits[2:]}"
+    if digits.startswith("0"):
+        return f"+{country_code}{digits[1:]}"
+    return f"+{country_code}{digits}"
+
+
+def normalized_property_values(values):
+    """Normalized column values for a {field: raw value} mapping, in PROPERTY_NORMALIZED_COLUMNS order."""
+    return (
+        parse_unit_count(values.get("au")),
+        parse_unit_count(values.get("bu")),
+        parse_exploration_timestamp(values.get("exploration")),
+        canonical_email(values.get("owner_email")),
+        canonical_phone(values.get("owner_mobile")),
+        canonical_phone(values.get("owner_landline")),
+    )
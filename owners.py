@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+owners.py
+
+Owner dimension for property_data.
+
+The decision maker of a property is stored once in owners, keyed by a
+normalized identity (case-folded name plus canonical email, mobile and
+landline from normalize.py), and linked to properties through
+property_owners(fol_id -> owner_id). One landlord with dozens of buildings
+is then one owners row. "All properties of this owner" is an indexed join
+instead of a LIKE scan over property_data.
+
+The raw owner columns on property_data are kept, so the sync and the reports
+are unaffected. The dimension therefore adds storage rather than saving it;
+`python owners.py stats` measures both with dbstat.
+
+With EXTRACTION_SHARDS=1 every shard file has its own owners and
+property_owners, with their own owner ids. The CLI runs each lookup against
+the main database and every shard file and merges the results by owner
+identity.
+
+During a crawl the DB writer interns owners through an OwnerInterner
+(identity -> owner_id map loaded once at start-up). Only identities it has not
+seen yet reach the owners table, inside the same transaction as the upsert.
+An owner whose last property is relinked to another identity, or loses its
+owner, is deleted in that transaction too, so owners holds no owner
+without properties.
+"""
+import sqlite3
+import logging
+import time
+
+from normalize import canonical_email, canonical_phone
+
+logger = logging.getLogger("owners")
+
+IDENTITY_SEPARATOR = "\x1f"
+
+OWNER_INSERT_SQL = """
+    INSERT INTO owners (identity, name, name_key, email, mobile, landline, email_norm, mobile_norm, landline_norm)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(identity) DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+    RETURNING owner_id
+"""
+
+LINK_UPSERT_SQL = """
+    INSERT INTO property_owners (fol_id, owner_id) VALUES (?, ?)
+    ON CONFLICT(fol_id) DO UPDATE SET owner_id = excluded.owner_id, linked_at = CURRENT_TIMESTAMP
+    WHERE property_owners.owner_id <> excluded.owner_id
+"""
+
+LINK_DELETE_SQL = "DELETE FROM property_owners WHERE fol_id = ?"
+
+LINKED_OWNERS_SQL = "SELECT fol_id, owner_id FROM property_owners WHERE fol_id IN ({placeholders})"
+
+ORPHAN_DELETE_SQL = """
+    DELETE FROM owners
+    WHERE owner_id = ? AND NOT EXISTS (SELECT 1 FROM property_owners l WHERE l.owner_id = owners.owner_id)
+    RETURNING identity
+"""
+
+
+def name_key(name):
+    """Case-folded name with collapsed whitespace, used for identity and name lookups."""
+    return " ".join(str(name).casefold().split()) if name else ""
+
+
+def owner_identity(name, email_norm, mobile_norm, landline_norm):
+    """Normalized identity of an owner, or None if all fields are empty."""
+    parts = (name_key(name), email_norm or "", mobile_norm or "", landline_norm or "")
+    if not any(parts):
+        return None
+    return IDENTITY_SEPARATOR.join(parts)
+
+
+class OwnerInterner:
+    """
+    In-memory identity -> owner_id map for one database.
+
+    resolve() splits a batch of owner tuples into rows to link and identities
+    that still need an owners row; register() adds the ids assigned by the
+    database once the transaction has committed.
+    """
+    __slots__ = ("ids", "hits", "misses")
+
+    def __init__(self, ids=None):
+        self.ids = ids or {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, conn):
+        """Loads the map from a sqlite3 connection."""
+        return cls({identity: owner_id for identity, owner_id in conn.execute("SELECT identity, owner_id FROM owners")})
+
+    @classmethod
+    async def load_async(cls, db):
+        """Loads the map from an aiosqlite connection."""
+        async with db.execute("SELECT identity, owner_id FROM owners") as cursor:
+            return cls({identity: owner_id for identity, owner_id in await cursor.fetchall()})
+
+    def resolve(self, owners):
+        """
+        owners: (fol_id, name, email, mobile, landline, email_norm, mobile_norm,
+        landline_norm) tuples. Returns (links, unlinked, new) where links are
+        (fol_id, identity) pairs, unlinked the FoL-IDs without an owner and new
+        {identity: OWNER_INSERT_SQL parameters} for identities not in the map.
+        """
+        links, unlinked, new = [], [], {}
+        for fol_id, name, email, mobile, landline, email_norm, mobile_norm, landline_norm in owners:
+            identity = owner_identity(name, email_norm, mobile_norm, landline_norm)
+            if identity is None:
+                unlinked.append(fol_id)
+                continue
+            if identity in self.ids:
+                self.hits += 1
+            elif identity not in new:
+                self.misses += 1
+                new[identity] = (identity, name, name_key(name), email, mobile, landline,
+                                 email_norm, mobile_norm, landline_norm)
+            links.append((fol_id, identity))
+        return links, unlinked, new
+
+    def register(self, assigned):
+        self.ids.update(assigned)
+
+    def forget(self, identities):
+        """Drops deleted owners; an identity seen again gets a new owners row."""
+        for identity in identities:
+            self.ids.pop(identity, None)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def replaced_owners(previous, linked):
+    """Owner ids of previous {fol_id: owner_id} links that linked {fol_id: owner_id} no longer points to."""
+    return {owner_id for fol_id, owner_id in previous.items() if linked.get(fol_id) != owner_id}
+
+
+def link_owners(conn, owners, interner=None):
+    """
+    Synchronous interning for sqlite3 connections (scripts; migration 10
+    keeps a frozen copy). Runs inside the caller's transaction. Returns the interner.
+    """
+    interner = interner or OwnerInterner.load(conn)
+    links, unlinked, new = interner.resolve(owners)
+    fol_ids = [fol_id for fol_id, _ in links] + unlinked
+    previous = {}
+    for start in range(0, len(fol_ids), 500):
+        chunk = fol_ids[start:start + 500]
+        previous.update(conn.execute(LINKED_OWNERS_SQL.format(placeholders=", ".join("?" for _ in chunk)), chunk))
+    assigned = {identity: conn.execute(OWNER_INSERT_SQL, values).fetchone()[0] for identity, values in new.items()}
+    interner.register(assigned)
+    linked = {fol_id: interner.ids[identity] for fol_id, identity in links}
+    conn.executemany(LINK_UPSERT_SQL, linked.items())
+    conn.executemany(LINK_DELETE_SQL, [(fol_id,) for fol_id in unlinked])
+    for owner_id in replaced_owners(previous, linked):
+        row = conn.execute(ORPHAN_DELETE_SQL, (owner_id,)).fetchone()
+        if row is not None:
+            interner.forget([row[0]])
+    return interner
+
+
+# -------------------------------
+# Lookups
+# -------------------------------
+def find_owners(conn, name=None, email=None, phone=None, limit=50):
+    """
+    Owners matching a name prefix, an email or a phone number (mobile or
+    landline, any common spelling). All three use indexes.
+    """
+    clauses, params = [], []
+    if name:
+        key = name_key(name)
+        clauses.append("name_key >= ? AND name_key < ?")
+        params += [key, key + "\uffff"]
+    if email:
+        clauses.append("email_norm = ?")
+        params.append(canonical_email(email))
+    if phone:
+        number = canonical_phone(phone)
+        clauses.append("owner_id IN (SELECT owner_id FROM owners WHERE mobile_norm = ? "
+                       "UNION SELECT owner_id FROM owners WHERE landline_norm = ?)")
+        params += [number, number]
+    if not clauses:
+        return []
+    return conn.execute(f"""
+        SELECT o.owner_id, o.name, o.email, o.mobile, o.landline,
+               (SELECT COUNT(*) FROM property_owners l WHERE l.owner_id = o.owner_id) AS properties
+        FROM owners o
+        WHERE {' AND '.join(clauses)}
+        ORDER BY properties DESC, o.name
+        LIMIT ?
+    """, params + [limit]).fetchall()
+
+
+def properties_for_owner(conn, owner_id):
+    """(fol_id, street, house_number, house_appendix, nvt_area) of every property linked to owner_id."""
+    return conn.execute("""
+        SELECT p.fol_id, p.street, p.house_number, p.house_appendix, p.nvt_area
+        FROM property_owners l JOIN property_data p ON p.fol_id = l.fol_id
+        WHERE l.owner_id = ?
+        ORDER BY p.street, p.house_number
+    """, (owner_id,)).fetchall()
+
+
+def lookup_databases(db_path="extraction.db"):
+    """The main database plus every shard file; each holds its own owners and links."""
+    from shards import ShardRouter
+
+    return [db_path] + ShardRouter(db_path).paths()
+
+
+def find_owners_across(db_paths, name=None, email=None, phone=None, limit=50):
+    """
+    find_owners() over several databases. The same owner found in several
+    files is merged: [(name, email, mobile, landline, properties,
+    [(db_path, owner_id)])], most properties first.
+    """
+    merged = {}
+    for db_path in db_paths:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = find_owners(conn, name, email, phone, limit)
+        finally:
+            conn.close()
+        for owner_id, owner_name, owner_email, mobile, landline, properties in rows:
+            identity = owner_identity(owner_name, canonical_email(owner_email), canonical_phone(mobile),
+                                      canonical_phone(landline))
+            entry = merged.setdefault(identity, [owner_name, owner_email, mobile, landline, 0, []])
+            entry[4] += properties
+            entry[5].append((db_path, owner_id))
+    ranked = sorted(merged.values(), key=lambda entry: (-entry[4], entry[0] or ""))
+    return [tuple(entry) for entry in ranked[:limit]]
+
+
+def properties_across(owners):
+    """properties_for_owner() rows, prefixed with the owner name, for find_owners_across() results."""
+    rows = []
+    for owner_name, *_, locations in owners:
+        for db_path, owner_id in locations:
+            conn = sqlite3.connect(db_path)
+            try:
+                rows += [(owner_name, *row) for row in properties_for_owner(conn, owner_id)]
+            finally:
+                conn.close()
+    return rows
+
+
+def owner_of(conn, fol_id):
+    return conn.execute("""
+        SELECT o.owner_id, o.name, o.email, o.mobile, o.landline
+        FROM property_owners l JOIN owners o ON o.owner_id = l.owner_id
+        WHERE l.fol_id = ?
+    """, (fol_id,)).fetchone()
+
+
+# -------------------------------
+# Measurements
+# -------------------------------
+# Owner data stored on every property_data row
+FLAT_OWNER_COLUMNS = [
+    "owner_name", "owner_email", "owner_mobile", "owner_landline",
+    "owner_email_norm", "owner_mobile_norm", "owner_landline_norm",
+]
+
+
+def _stored_bytes(conn, schema, names):
+    """On-disk bytes (pages times page size, from dbstat) of the given tables and indexes."""
+    if not names:
+        return 0
+    return conn.execute(f"SELECT COALESCE(SUM(pgsize), 0) FROM dbstat(?) WHERE name IN ({', '.join('?' for _ in names)})",
+                        (schema, *names)).fetchone()[0]
+
+
+def storage_stats(conn):
+    """
+    Measured on-disk bytes of the owner data. flat_bytes is what the owner
+    columns and their indexes add to property_data: the table is copied into
+    a temporary database with and without them and the pages are compared.
+    dimension_bytes are the pages of owners, property_owners and their
+    indexes. Both are stored, so the dimension adds to the flat columns.
+    """
+    properties = conn.execute(f"""
+        SELECT COUNT(*) FROM property_data
+        WHERE {' || '.join(f"COALESCE({column}, '')" for column in FLAT_OWNER_COLUMNS[:4])} <> ''
+    """).fetchone()[0]
+    owners = conn.execute("SELECT COUNT(*) FROM owners").fetchone()[0]
+    dimension = _stored_bytes(conn, "main", [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE tbl_name IN ('owners', 'property_owners')")])
+    owner_indexes = [row[0] for row in conn.execute(f"""
+        SELECT DISTINCT m.name FROM sqlite_master m, pragma_index_info(m.name) i
+        WHERE m.type = 'index' AND m.tbl_name = 'property_data'
+          AND i.name IN ({', '.join('?' for _ in FLAT_OWNER_COLUMNS)})
+    """, FLAT_OWNER_COLUMNS)]
+
+    columns = [row[1] for row in conn.execute("PRAGMA main.table_info(property_data)")]
+    without_owner = [column for column in columns if column not in FLAT_OWNER_COLUMNS]
+    conn.execute("ATTACH DATABASE '' AS probe")
+    try:
+        conn.execute("CREATE TABLE probe.with_owner AS SELECT * FROM main.property_data")
+        conn.execute(f"CREATE TABLE probe.without_owner AS SELECT {', '.join(without_owner)} FROM main.property_data")
+        flat = (_stored_bytes(conn, "probe", ["with_owner"]) - _stored_bytes(conn, "probe", ["without_owner"])
+                + _stored_bytes(conn, "main", owner_indexes))
+    finally:
+        conn.execute("DETACH DATABASE probe")
+    return {
+        'properties_with_owner': properties,
+        'owners': owners,
+        'flat_bytes': flat,
+        'dimension_bytes': dimension,
+    }
+
+
+def lookup_benchmark(conn, repeat=20):
+    """
+    Times finding all properties of randomly picked owners: LIKE scan over
+    property_data against the indexed owner lookup. Returns {name: seconds
+    per lookup}.
+    """
+    samples = conn.execute("SELECT owner_id, name, email_norm FROM owners ORDER BY RANDOM() LIMIT ?",
+                           (repeat,)).fetchall()
+    if not samples:
+        return {}
+    results = {}
+    started = time.perf_counter()
+    for _, name, _ in samples:
+        conn.execute("""
+            SELECT fol_id, street, house_number, house_appendix, nvt_area FROM property_data
+            WHERE owner_name LIKE ? ORDER BY street, house_number
+        """, (f"%{name}%",)).fetchall()
+    results['LIKE scan by name'] = (time.perf_counter() - started) / len(samples)
+
+    started = time.perf_counter()
+    for _, name, _ in samples:
+        for owner_id, *_ in find_owners(conn, name=name):
+            properties_for_owner(conn, owner_id)
+    results['indexed by name'] = (time.perf_counter() - started) / len(samples)
+
+    started = time.perf_counter()
+    for _, _, email in samples:
+        if email:
+            for owner_id, *_ in find_owners(conn, email=email):
+                properties_for_owner(conn, owner_id)
+    results['indexed by email'] = (time.perf_counter() - started) / len(samples)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    from tabulate import tabulate
+    from migrations import migrate
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Owner lookups')
+    parser.add_argument('--db-path', default='extraction.db', help='Path to the SQLite database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for command, help_text in (('find', 'Find owners by name prefix, email or phone'),
+                               ('properties', 'List the properties of the owners found by name, email or phone')):
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument('--name', help='Name (prefix, case-insensitive)')
+        command_parser.add_argument('--email', help='Email address')
+        command_parser.add_argument('--phone', help='Mobile or landline number')
+
+    subparsers.add_parser('stats', help='Storage and lookup measurements')
+
+    args = parser.parse_args()
+    migrate(args.db_path)
+    # Owners, links and properties live in the shard files with EXTRACTION_SHARDS=1
+    databases = lookup_databases(args.db_path)
+
+    if args.command == 'find':
+        rows = [row[:5] for row in find_owners_across(databases, args.name, args.email, args.phone)]
+        print(tabulate(rows, headers=["name", "email", "mobile", "landline", "properties"], tablefmt="pretty"))
+    elif args.command == 'properties':
+        rows = properties_across(find_owners_across(databases, args.name, args.email, args.phone))
+        print(tabulate(rows, headers=["owner", "fol_id", "street", "house_number", "appendix", "nvt_area"],
+                       tablefmt="pretty"))
+    elif args.command == 'stats':
+        totals = {'properties_with_owner': 0, 'owners': 0, 'flat_bytes': 0, 'dimension_bytes': 0}
+        for db_path in databases:
+            conn = sqlite3.connect(db_path)
+            for key, value in storage_stats(conn).items():
+                totals[key] += value
+            for name, seconds in lookup_benchmark(conn).items():
+                print(f"{db_path}: {name:<20} {seconds * 1000:8.3f} ms per owner")
+            conn.close()
+        print(f"{totals['properties_with_owner']:,} properties with an owner, {totals['owners']:,} owner rows")
+        print(f"Flat owner columns and indexes on property_data: {totals['flat_bytes'] / 1024:,.1f} KiB")
+        print(f"Owner dimension (owners, property_owners, indexes): {totals['dimension_bytes'] / 1024:,.1f} KiB "
+              f"in addition, since the flat columns are still written")
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+planning.py
+
+Box and coverage planning aggregates per NVT area and per crawl area.
+
+Two summary tables (migration 12) hold what used to be recomputed in
+spreadsheets:
+
+    planning_summary(scope, key, properties, au_total, bu_total,
+                     with_owner, with_exploration)
+    planning_boxes(scope, key, box_type, boxes)
+
+scope is 'nvt' (key = property_data.nvt_area) or 'area' (key =
+property_data.area, the crawl area that wrote the row). box_type is the
+OneBox material from BOX_TYPE_MAPPING for AU + BU of a property, or
+OVERSIZE_BOX above 32 units.
+
+Triggers on property_data subtract the old row and add the new one on every
+insert, delete and update that touches a counted column, so the summaries
+are always current and a lookup is a primary-key read, independent of the
+number of properties. Tombstoned properties (gone from the portal, see
+property_history.tombstone_unseen) are not counted. `python planning.py check` compares them with a full
+recomputation; `rebuild` recomputes them.
+"""
+import sqlite3
+import logging
+import time
+
+logger = logging.getLogger("planning")
+
+# Box type mapping based on the number of units (WE)
+BOX_TYPE_MAPPING = [
+    (1, "Box: G-AP OneBox XS (1WE), 10er Pack | Material Nr.:47122083"),
+    (3, "Box: GI-AP OneBox  1 - 3 WE | Material Nr.:47100635"),
+    (8, "Box: GI-AP OneBox  4 - 8 WE | Material Nr.:47100636"),
+    (12, "Box: GI-AP OneBox  9 -12 WE | Material Nr.:47100637"),
+    (20, "Box: GI-AP OneBox 13 - 20 WE | Material Nr.:47100638"),
+    (32, "Box: GI-AP OneBox 21 - 32 WE | Material Nr.:47100639"),
+    (float('inf'), None)  # For any value above 32
+]
+
+# planning_boxes.box_type for properties too large for a OneBox
+OVERSIZE_BOX = "No OneBox (> 32 WE)"
+
+SCOPES = {'nvt': 'nvt_area', 'area': 'area'}
+
+# property_data columns the aggregates are computed from
+COUNTED_COLUMNS = [
+    "nvt_area", "area", "au_count", "bu_count", "owner_name", "owner_email",
+    "owner_mobile", "owner_landline", "exploration",
+]
+
+# Added by migration 14; older schemas (migrations 12 and 13) count every row
+TOMBSTONE_COLUMN = "tombstoned_at"
+
+SUMMARY_COLUMNS = ["properties", "au_total", "bu_total", "with_owner", "with_exploration"]
+
+
+def get_box_type_for_units(total_units):
+    """
+    Determine the appropriate box type based on the total number of units (au + bu).
+    Returns the full box description string for the given number of units.
+    """
+    if total_units is None or total_units == 0:
+        return None
+
+    # Convert to int to ensure proper comparison
+    try:
+        total_units = int(total_units)
+    except (ValueError, TypeError):
+        logger.warning(f"Invalid unit count for box type calculation: {total_units}")
+        return None
+
+    # Find the appropriate box type based on the total units
+    for max_units, box_description in BOX_TYPE_MAPPING:
+        if total_units <= max_units:
+            return box_description
+
+    # Should never reach here due to the float('inf') entry, but just in case
+    return None
+
+
+# -------------------------------
+# SQL expressions over one property_data row ({row} = NEW, OLD or property_data)
+# -------------------------------
+def _has_tombstones(conn):
+    return TOMBSTONE_COLUMN in [row[1] for row in conn.execute("PRAGMA table_info(property_data)")]
+
+
+def _live_sql(row, tombstones):
+    """Condition for rows that are counted."""
+    return f"{row}.{TOMBSTONE_COLUMN} IS NULL" if tombstones else "1"
+
+
+def _units_sql(row):
+    return f"(COALESCE({row}.au_count, 0) + COALESCE({row}.bu_count, 0))"
+
+
+def _box_type_sql(row):
+    """CASE expression giving get_box_type_for_units() of a row with units > 0."""
+    units = _units_sql(row)
+    whens = " ".join(f"WHEN {units} <= {max_units} THEN '{description.replace(chr(39), chr(39) * 2)}'"
+                     for max_units, description in BOX_TYPE_MAPPING if description)
+    return f"CASE {whens} ELSE '{OVERSIZE_BOX}' END"
+
+
+def _summary_values_sql(row):
+    """properties, au_total, bu_total, with_owner, with_exploration contributions of one row."""
+    return [
+        "1",
+        f"COALESCE({row}.au_count, 0)",
+        f"COALESCE({row}.bu_count, 0)",
+        f"(COALESCE({row}.owner_name, '') || COALESCE({row}.owner_email, '') || "
+        f"COALESCE({row}.owner_mobile, '') || COALESCE({row}.owner_landline, '') <> '')",
+        f"(COALESCE({row}.exploration, '') <> '')",
+    ]
+
+
+def _delta_sql(row, sign, tombstones):
+    """Statements adding (sign '+') or removing (sign '-') one row's contribution to both scopes."""
+    live = _live_sql(row, tombstones)
+    statements = []
+    for scope, column in SCOPES.items():
+        key = f"COALESCE({row}.{column}, '')"
+        values = ", ".join(f"{sign}{value}" for value in _summary_values_sql(row))
+        updates = ", ".join(f"{name} = {name} + excluded.{name}" for name in SUMMARY_COLUMNS)
+        statements.append(f"""
+            INSERT INTO planning_summary (scope, key, {', '.join(SUMMARY_COLUMNS)})
+            SELECT '{scope}', {key}, {values} WHERE {live}
+            ON CONFLICT(scope, key) DO UPDATE SET {updates};""")
+        statements.append(f"""
+            INSERT INTO planning_boxes (scope, key, box_type, boxes)
+            SELECT '{scope}', {key}, {_box_type_sql(row)}, {sign}1 WHERE {live} AND {_units_sql(row)} > 0
+            ON CONFLICT(scope, key, box_type) DO UPDATE SET boxes = boxes + excluded.boxes;""")
+    return "".join(statements)
+
+
+def _aggregate_sql(scope, tombstones):
+    """Full recomputation of one scope: (summary SELECT, boxes SELECT) over property_data."""
+    column = SCOPES[scope]
+    live = _live_sql("property_data", tombstones)
+    summary = f"""
+        SELECT '{scope}', COALESCE({column}, ''), {', '.join(f'SUM({value})' for value in _summary_values_sql('property_data'))}
+        FROM property_data WHERE {live} GROUP BY 2"""
+    boxes = f"""
+        SELECT '{scope}', COALESCE({column}, ''), {_box_type_sql('property_data')}, COUNT(*)
+        FROM property_data WHERE {live} AND {_units_sql('property_data')} > 0 GROUP BY 2, 3"""
+    return summary, boxes
+
+
+def create_planning_tables(conn):
+    """
+    Creates the summary tables, (re)creates their triggers and fills them.
+    Used by `rebuild`, since the triggers embed BOX_TYPE_MAPPING. Migrations
+    12 and 14 keep a frozen copy; a change here needs a new migration.
+    """
+    tombstones = _has_tombstones(conn)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS planning_summary (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            {', '.join(f'{name} INTEGER NOT NULL DEFAULT 0' for name in SUMMARY_COLUMNS)},
+            PRIMARY KEY (scope, key)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS planning_boxes (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            box_type TEXT NOT NULL,
+            boxes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, key, box_type)
+        ) WITHOUT ROWID
+    """)
+    counted = COUNTED_COLUMNS + ([TOMBSTONE_COLUMN] if tombstones else [])
+    changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in counted)
+    for trigger in ("planning_insert", "planning_update", "planning_delete"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute(f"""
+        CREATE TRIGGER planning_insert AFTER INSERT ON property_data BEGIN
+            {_delta_sql('NEW', '+', tombstones)}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER planning_update AFTER UPDATE ON property_data
+        WHEN {changed} BEGIN
+            {_delta_sql('OLD', '-', tombstones)}
+            {_delta_sql('NEW', '+', tombstones)}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER planning_delete AFTER DELETE ON property_data BEGIN
+            {_delta_sql('OLD', '-', tombstones)}
+        END
+    """)
+    rebuild_planning(conn)
+
+
+def rebuild_planning(conn):
+    """Recomputes both summary tables from property_data. Returns the number of summary rows."""
+    conn.execute("DELETE FROM planning_summary")
+    conn.execute("DELETE FROM planning_boxes")
+    tombstones = _has_tombstones(conn)
+    for scope in SCOPES:
+        summary, boxes = _aggregate_sql(scope, tombstones)
+        conn.execute(f"INSERT INTO planning_summary (scope, key, {', '.join(SUMMARY_COLUMNS)}) {summary}")
+        conn.execute(f"INSERT INTO planning_boxes (scope, key, box_type, boxes) {boxes}")
+    return conn.execute("SELECT COUNT(*) FROM planning_summary").fetchone()[0]
+
+
+def check_planning(conn):
+    """
+    Differences between the maintained summaries and a full recomputation, as
+    (table, stored row, recomputed row) tuples. Empty when they agree.
+    """
+    differences = []
+    tombstones = _has_tombstones(conn)
+    for table, position in (("planning_summary", 0), ("planning_boxes", 1)):
+        key_length = 2 if table == "planning_summary" else 3
+        value_filter = "properties <> 0" if table == "planning_summary" else "boxes <> 0"
+        stored = {row[:key_length]: row for row in conn.execute(f"SELECT * FROM {table} WHERE {value_filter}")}
+        recomputed = {}
+        for scope in SCOPES:
+            for row in conn.execute(_aggregate_sql(scope, tombstones)[position]):
+                recomputed[row[:key_length]] = tuple(row)
+        for key in sorted(set(stored) | set(recomputed)):
+            if stored.get(key) != recomputed.get(key):
+                differences.append((table, stored.get(key), recomputed.get(key)))
+    return differences
+
+
+# -------------------------------
+# Lookups
+# -------------------------------
+def planning_databases(db_path="extraction.db"):
+    """The main database plus every existing shard file; each keeps its own summaries."""
+    from shards import ShardRouter
+
+    return [db_path] + ShardRouter(db_path).paths()
+
+
+def summaries(db_paths, scope, key=None):
+    """
+    {key: {summary column: value, 'boxes': {box_type: count}}} for one scope,
+    summed over db_paths. With key only that NVT area or area is read.
+    """
+    results = {}
+    where, params = ("scope = ?", [scope]) if key is None else ("scope = ? AND key = ?", [scope, key])
+    for db_path in db_paths:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            for row in conn.execute(f"SELECT key, {', '.join(SUMMARY_COLUMNS)} FROM planning_summary "
+                                    f"WHERE {where} AND properties <> 0", params):
+                entry = results.setdefault(row[0], dict.fromkeys(SUMMARY_COLUMNS, 0) | {'boxes': {}})
+                for name, value in zip(SUMMARY_COLUMNS, row[1:]):
+                    entry[name] += value
+            for summary_key, box_type, boxes in conn.execute(
+                    f"SELECT key, box_type, boxes FROM planning_boxes WHERE {where} AND boxes <> 0", params):
+                entry = results.setdefault(summary_key, dict.fromkeys(SUMMARY_COLUMNS, 0) | {'boxes': {}})
+                entry['boxes'][box_type] = entry['boxes'].get(box_type, 0) + boxes
+        finally:
+            conn.close()
+    return results
+
+
+def box_label(box_type):
+    """'Box: GI-AP OneBox  4 - 8 WE | Material Nr.:47100636' -> 'OneBox 4-8 WE (47100636)'."""
+    if box_type == OVERSIZE_BOX:
+        return box_type
+    name, _, material = box_type.partition("| Material Nr.:")
+    name = " ".join(name.replace("Box:", "").replace("G-AP", "").replace("GI-AP", "").split())
+    name = name.replace(" - ", "-").replace(" -", "-").replace(", 10er Pack", "")
+    return f"{name} ({material.strip()})"
+
+
+def summary_rows(results):
+    """Table rows (key, properties, AU, BU, owner %, exploration %, boxes...) for tabulate."""
+    box_types = [description for _, description in BOX_TYPE_MAPPING if description] + [OVERSIZE_BOX]
+    rows = []
+    for key in sorted(results):
+        entry = results[key]
+        properties = entry['properties']
+        rows.append([
+            key or "(none)", properties, entry['au_total'], entry['bu_total'],
+            f"{entry['with_owner'] / properties * 100:.0f}%" if properties else "-",
+            f"{entry['with_exploration'] / properties * 100:.0f}%" if properties else "-",
+            *(entry['boxes'].get(box_type, 0) for box_type in box_types),
+        ])
+    headers = ["key", "properties", "AU", "BU", "owner", "exploration"] + [box_label(b) for b in box_types]
+    return rows, headers
+
+
+if __name__ == "__main__":
+    import argparse
+    from tabulate import tabulate
+    from migrations import migrate
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Box and coverage planning per NVT area and area')
+    parser.add_argument('--db-path', default='extraction.db', help='Path to the main SQLite database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    nvt_parser = subparsers.add_parser('nvt', help='Summary per NVT area')
+    nvt_parser.add_argument('key', nargs='?', help='Only this NVT area')
+    area_parser = subparsers.add_parser('area', help='Summary per crawl area')
+    area_parser.add_argument('key', nargs='?', help='Only this area')
+    subparsers.add_parser('check', help='Compare the summaries with a full recomputation')
+    subparsers.add_parser('rebuild', help='Recompute the summaries from property_data')
+
+    args = parser.parse_args()
+    migrate(args.db_path)
+    databases = planning_databases(args.db_path)
+
+    if args.command in SCOPES:
+        started = time.perf_counter()
+        results = summaries(databases, args.command, args.key)
+        elapsed = time.perf_counter() - started
+        rows, headers = summary_rows(results)
+        print(tabulate(rows, headers=headers, tablefmt="pretty"))
+        logger.info(f"{len(rows)} rows from {len(databases)} database(s) in {elapsed * 1000:.1f} ms")
+    else:
+        failed = 0
+        for db_path in databases:
+            migrate(db_path)
+            conn = sqlite3.connect(db_path)
+            if args.command == 'rebuild':
+                started = time.perf_counter()
+                create_planning_tables(conn)
+                count = conn.execute("SELECT COUNT(*) FROM planning_summary").fetchone()[0]
+                conn.commit()
+                logger.info(f"{db_path}: rebuilt {count} summary rows in {time.perf_counter() - started:.1f}s")
+            else:
+                differences = check_planning(conn)
+                failed += bool(differences)
+                for table, stored, recomputed in differences[:20]:
+                    logger.warning(f"{db_path}: {table} stored {stored} != recomputed {recomputed}")
+                logger.info(f"{db_path}: {'OK' if not differences else f'{len(differences)} differences'}")
+            conn.close()
+        if failed:
+            raise SystemExit(1)
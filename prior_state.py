@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+prior_state.py
+
+In-memory index of what the previous crawls stored for each property.
+
+Loaded once at the start of a run and shared by all sessions, it answers the
+download-skip check in process_property (exploration date and PDF reference)
+without touching the database. The writer updates it in place after each
+commit, so later lookups in the same run see the rows just written.
+"""
+import sys
+import hashlib
+import sqlite3
+import logging
+
+from db_writer import UPSERT_COLUMNS
+
+# Columns of a list (search result) row that make up the list fingerprint.
+LIST_FINGERPRINT_COLUMNS = ["street", "house_number", "house_appendix", "au", "bu", "nvt_area"]
+
+
+def list_fingerprint(values):
+    """8-byte fingerprint of the search-result columns of a property, as an int."""
+    joined = "\x1f".join("" if v is None else str(v) for v in values)
+    return int.from_bytes(hashlib.blake2b(joined.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# Positions of the cached columns in db_writer.upsert_params tuples
+STATE_PARAM_POSITIONS = [UPSERT_COLUMNS.index(column) for column in (
+    "fol_id", "exploration", "exploration_pdf", "data_hash",
+)]
+FINGERPRINT_PARAM_POSITIONS = [UPSERT_COLUMNS.index(column) for column in LIST_FINGERPRINT_COLUMNS]
+
+
+def _compact_hash(hex_hash):
+    # 32 raw bytes instead of a 64-character str
+    if not hex_hash:
+        return None
+    try:
+        return bytes.fromhex(hex_hash)
+    except ValueError:
+        return hex_hash.encode("utf-8")
+
+
+def _fol_key(fol_id):
+    # FoL-IDs are numeric; ints are smaller than str keys and hash faster
+    try:
+        return int(fol_id)
+    except (TypeError, ValueError):
+        return fol_id
+
+
+class PriorStateCache:
+    """
+    fol_id -> (exploration, exploration_pdf, data_hash, list_fingerprint)
+
+    Exploration dates and PDF folders repeat a lot, so strings are interned.
+    All sessions run on one event loop, so no locking is needed.
+    """
+
+    __slots__ = ("_entries", "lookups", "hits")
+
+    def __init__(self):
+        self._entries = {}
+        self.lookups = 0
+        self.hits = 0
+
+    @classmethod
+    def load(cls, db_path="extraction.db", nvt_areas=None, area=None):
+        """
+        Loads prior state from property_data, optionally restricted to the given
+        NVT areas and/or one crawl area (rows stored before the crawl area was
+        recorded are kept). A missing database or table just gives an empty cache.
+        """
+        cache = cls()
+        sql = (f"SELECT fol_id, exploration, exploration_pdf, data_hash, "
+               f"{', '.join(LIST_FINGERPRINT_COLUMNS)} FROM property_data")
+        where = []
+        params = ()
+        if nvt_areas:
+            where.append(f"nvt_area IN ({', '.join('?' for _ in nvt_areas)})")
+            params += tuple(nvt_areas)
+        if area is not None:
+            where.append("(area = ? OR area IS NULL)")
+            params += (area,)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        try:
+            conn = sqlite3.connect(db_path)
+            try:
+                for row in conn.execute(sql, params):
+                    cache._put(row[0], row[1], row[2], row[3], list_fingerprint(row[4:]))
+            finally:
+                conn.close()
+        except sqlite3.OperationalError as e:
+            logging.info(f"No prior state loaded from {db_path}: {e}")
+        logging.info(f"Prior state cache loaded {len(cache)} properties ({cache.memory_footprint() / 1024:.0f} KiB)")
+        return cache
+
+    def _put(self, fol_id, exploration, exploration_pdf, data_hash, fingerprint):
+        self._entries[_fol_key(fol_id)] = (
+            sys.intern(exploration) if exploration else "",
+            sys.intern(exploration_pdf) if exploration_pdf else "",
+            _compact_hash(data_hash),
+            fingerprint,
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, fol_id):
+        return _fol_key(fol_id) in self._entries
+
+    def get(self, fol_id):
+        """Returns (exploration, exploration_pdf, data_hash bytes, list_fingerprint) or None. Counts toward the hit rate."""
+        self.lookups += 1
+        entry = self._entries.get(_fol_key(fol_id))
+        if entry is not None:
+            self.hits += 1
+        return entry
+
+    def update_from_params(self, params):
+        """Applies committed db_writer.upsert_params tuples to the cache."""
+        for p in params:
+            self._put(*(p[i] for i in STATE_PARAM_POSITIONS),
+                      list_fingerprint([p[i] for i in FINGERPRINT_PARAM_POSITIONS]))
+
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def memory_footprint(self):
+        """Approximate bytes held by the index (dict, keys, entry tuples and unshared values)."""
+        total = sys.getsizeof(self._entries)
+        seen = set()
+        for key, entry in self._entries.items():
+            total += sys.getsizeof(key) + sys.getsizeof(entry)
+            for value in entry:
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+        return total
+
+    def report(self):
+        return (f"Prior state cache: {len(self)} entries, "
+                f"{self.memory_footprint() / 1024:.0f} KiB, "
+                f"{self.hits}/{self.lookups} hits ({self.hit_rate():.1%})")
@@ -6,7 +6,6 @@ import time
 import urllib.parse
 import hmac
 import hashlib
-import json
 import struct
 from tabulate import tabulate
 import aiosqlite
@@ -17,6 +16,16 @@ from typing import Optional
 from dotenv import load_dotenv
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from protocol_archive import ARCHIVE_DIR, ProtocolArchive, archive_enabled, archive_downloaded_protocol, protocol_exists
+from db_writer import PropertyDataWriter, ReadPool
+from migrations import ensure_migrated
+from prior_state import PriorStateCache
+from property_history import start_run, finish_run, set_run_generation, tombstone_unseen
+from property_record import OwnerInfo, PropertyDetail, PropertyRecord
+from shards import ShardRouter, sharding_enabled
+from sync_stream import AirtableStreamer, streaming_enabled
+from backup import periodic_backups
+from checkpoints import CrawlCursor, plan_ranges, row_index
 
 load_dotenv()
 
@@ -25,26 +34,6 @@ console = Console()
 # -------------------------------
 # Utility Functions
 # -------------------------------
-def calculate_hash(property_data):
-    """
-    Calculate a SHA256 hash for the given property data.
-    property_data: tuple or list of values representing key fields.
-    Excludes both the status message (index 8) and PDF file path (index 10) from hash calculation,
-    but includes exploration date (index 9) and the additional AU, BU, NVT area columns.
-    """
-    # Create a copy of the property data to avoid modifying the original
-    hash_data = list(property_data)
-    
-    # If we have enough elements, exclude status message and PDF file path from hash
-    if len(hash_data) > 8:
-        hash_data[8] = ""  # Exclude status message from hash
-    if len(hash_data) > 10:
-        hash_data[10] = ""  # Exclude PDF file path from hash
-    
-    # Convert to JSON and calculate hash
-    data_str = json.dumps(hash_data, sort_keys=True)
-    return hashlib.sha256(data_str.encode('utf-8')).hexdigest()
-
 def setup_logging(debug=False, quiet=False):
     logger = logging.getLogger()
     logger.handlers.clear()
@@ -76,10 +65,14 @@ def setup_logging(debug=False, quiet=False):
 # -------------------------------
 # New: Download Retry Function
 # -------------------------------
-async def download_exploration_pdf(page: Page, button_selector: str, session_id: int, max_retries=3, timeout=10000) -> Optional[str]:
+async def download_exploration_pdf(page: Page, button_selector: str, session_id: int, max_retries=3, timeout=10000, fol_id=None,
+                                   archive=ARCHIVE_DIR) -> Optional[str]:
     """
     Tries to download the exploration PDF up to max_retries times.
     Returns the path to the downloaded file or None if it fails.
+    In archive mode (EXPLORATION_ARCHIVE=1) the file is packed into the protocol
+    archive (the crawl's open ProtocolArchive, or a directory) and the archive
+    reference is returned instead.
     """
     for attempt in range(1, max_retries + 1):
         try:
@@ -93,6 +86,10 @@ async def download_exploration_pdf(page: Page, button_selector: str, session_id:
             destination_path = exploration_folder / pdf_filename
             await download.save_as(str(destination_path))
             logging.info(f"[Session {session_id}] Download succeeded on attempt {attempt} -> {destination_path}")
+            if archive_enabled():
+                archive_ref = archive_downloaded_protocol(destination_path, fol_id, archive)
+                logging.info(f"[Session {session_id}] Archived protocol -> {archive_ref}")
+                return archive_ref
             return str(destination_path)
         except PlaywrightTimeoutError:
             logging.warning(f"[Session {session_id}] Timeout waiting for download on attempt {attempt}. Retrying...")
@@ -203,6 +200,20 @@ class IBTPropertySearchSession:
         self.logger = logging.getLogger(f"Session {self.session_id}")
         self.otp_secret = os.getenv("TELEKOM_OTP_SECRET")
         logging.info(f"Session {self.session_id}: Loaded OTP secret from environment: {self.otp_secret is not None}")
+        # Shared per-run database handles, set by main()
+        self.db_writer: Optional[PropertyDataWriter] = None
+        self.db_readers: Optional[ReadPool] = None
+        self.prior_state: Optional[PriorStateCache] = None
+        self.archive_dir = ARCHIVE_DIR
+        # The crawl's open protocol archive in archive mode, set by main()
+        self.protocol_archive: Optional[ProtocolArchive] = None
+        # Page range being crawled; each property is committed with it (see checkpoints.py)
+        self.cursor: Optional[CrawlCursor] = None
+
+    @property
+    def archive(self):
+        """The crawl's open protocol archive, or the archive directory outside a crawl."""
+        return self.protocol_archive if self.protocol_archive is not None else self.archive_dir
         
     async def init_browser(self):
         self.playwright = await async_playwright().start()
@@ -522,7 +533,7 @@ async def extract_ownership(page):
                 email = (await email_span.inner_text()).strip() if email_span else ""
                 mobile = (await mobile_span.inner_text()).strip() if mobile_span else ""
                 landline = (await landline_span.inner_text()).strip() if landline_span else ""
-                decision_owner = [name, email, mobile, landline]
+                decision_owner = OwnerInfo(name, email, mobile, landline)
             break
     return decision_owner
 
@@ -537,9 +548,16 @@ async def process_property(session, ri, fol_id):
     existing_data = None
     exploration_date_unchanged = False
     try:
-        async with aiosqlite.connect("extraction.db") as db:
-            async with db.execute("SELECT exploration, exploration_pdf FROM property_data WHERE fol_id = ?", (fol_id,)) as cursor:
-                existing_data = await cursor.fetchone()
+        if session.prior_state is not None:
+            prior = session.prior_state.get(fol_id)
+            existing_data = (prior[0], prior[1]) if prior else None
+        elif session.db_readers:
+            existing_data = await session.db_readers.fetchone(
+                "SELECT exploration, exploration_pdf FROM property_data WHERE fol_id = ?", (fol_id,))
+        else:
+            async with aiosqlite.connect("extraction.db") as db:
+                async with db.execute("SELECT exploration, exploration_pdf FROM property_data WHERE fol_id = ?", (fol_id,)) as cursor:
+                    existing_data = await cursor.fetchone()
     except Exception as e:
         logging.warning(f"[Session {session.session_id}] Error checking existing property data: {e}")
     
@@ -557,7 +575,7 @@ async def process_property(session, ri, fol_id):
             if attempt == max_retries - 1:
                 msg = f"Property tab view still did not appear for data-ri {ri} after {max_retries} attempts: {e}"
                 logging.error(f"[Session {session.session_id}] {msg}")
-                return None, msg, "", ""
+                return PropertyDetail(status=msg)
             else:
                 logging.info(f"[Session {session.session_id}] Refreshing page before retrying attempt {attempt + 2}")
                 await session.page.reload()
@@ -571,7 +589,7 @@ async def process_property(session, ri, fol_id):
     except Exception as e:
         msg = f"Owner tab not found for data-ri {ri}: {e}"
         logging.error(f"[Session {session.session_id}] {msg}")
-        return None, msg, "", ""
+        return PropertyDetail(status=msg)
 
     try:
         await session.page.wait_for_selector("#processPageForm\\:propertyTabView\\:propertyOwnerTable_data", timeout=10000)
@@ -613,7 +631,9 @@ async def process_property(session, ri, fol_id):
                     logging.info(f"[Session {session.session_id}] Exploration protocol button is disabled. Skipping download.")
                 else:
                     logging.info(f"[Session {session.session_id}] Exploration protocol button found and enabled. Downloading...")
-                    exploration_pdf_ref = await download_exploration_pdf(session.page, "#processPageForm\\:explorationProtocol", session.session_id)
+                    exploration_pdf_ref = await download_exploration_pdf(
+                        session.page, "#processPageForm\\:explorationProtocol", session.session_id,
+                        fol_id=fol_id, archive=session.archive)
             else:
                 logging.info(f"[Session {session.session_id}] Exploration protocol button not found.")
         except Exception as e:
@@ -628,16 +648,22 @@ async def process_property(session, ri, fol_id):
         page_html = await session.page.content()
         with open(f"debug_page_{session.session_id}_data-ri_{ri}.html", "w", encoding="utf-8") as f:
             f.write(page_html)
-        return None, f"Close button not found for data-ri {ri}", "", ""
+        return PropertyDetail(status=f"Close button not found for data-ri {ri}")
     await close_button.click()
     logging.info(f"[Session {session.session_id}] Closed detail page (data-ri {ri})")
     await session.page.wait_for_selector("#searchResultForm\\:propertySearchSRT_data", timeout=10000)
-    return owner_data, status_msg, exploration_date, exploration_pdf_ref
+    return PropertyDetail(owner_data, status_msg, exploration_date, exploration_pdf_ref)
 
 # -------------------------------
 # Page Extraction and Navigation Helpers
 # -------------------------------
-async def extract_search_results(session):
+async def extract_search_results(session, page_number=None, after_ri=None):
+    """
+    Extracts every row of the current result page, opening its detail page.
+    Rows up to and including data-ri after_ri were captured before a restart
+    and are skipped. With a session cursor each property is committed as
+    soon as it is extracted (see checkpoint_property).
+    """
     try:
         await session.page.wait_for_selector("#searchResultForm\\:propertySearchSRT_data", timeout=10000)
     except Exception as e:
@@ -651,6 +677,8 @@ async def extract_search_results(session):
     # First, gather basic property information
     for row in rows:
         ri = await row.get_attribute("data-ri")
+        if after_ri is not None and row_index(ri) is not None and row_index(ri) <= after_ri:
+            continue
         fol_elem = await row.query_selector("span[title='FoL-Id']")
         street_elem = await row.query_selector("span[title='Street']")
         house_elem = await row.query_selector("span[title='House number']")
@@ -676,7 +704,7 @@ async def extract_search_results(session):
     # Now process each property with retry mechanism for failed owner extractions
     for ri, fol_id, street, house_number, house_appendix, au, bu, nvt_area in row_data_cache:
         # Process the property
-        owner_info, status_msg, exploration_date, exploration_pdf_ref = await process_property(session, ri, fol_id)
+        detail = await process_property(session, ri, fol_id)
         
         # If owner extraction failed, retry up to 2 more times
         retry_count = 0
@@ -684,10 +712,10 @@ async def extract_search_results(session):
         
         # Check if owner info extraction failed but not because of a missing owner table
         # (We don't want to retry if the property legitimately has no owner information)
-        while (owner_info is None and 
+        while (detail.owner is None and 
                retry_count < max_retries and 
-               "not found" not in status_msg.lower() and
-               "table not found" not in status_msg.lower()):
+               "not found" not in detail.status.lower() and
+               "table not found" not in detail.status.lower()):
             
             logging.warning(f"[Session {session.session_id}] Owner extraction failed for FoL-ID {fol_id}. "
                           f"Retrying ({retry_count + 1}/{max_retries})...")
@@ -712,12 +740,12 @@ async def extract_search_results(session):
                 # Retry owner extraction
                 try:
                     await session.page.wait_for_selector("#processPageForm\\:propertyTabView\\:propertyOwnerTable_data", timeout=10000)
-                    owner_info = await extract_ownership(session.page)
-                    if owner_info is not None:
-                        status_msg = "Recovered owner info on retry"
+                    detail.owner = await extract_ownership(session.page)
+                    if detail.owner is not None:
+                        detail.status = "Recovered owner info on retry"
                         logging.info(f"[Session {session.session_id}] Successfully recovered owner info for FoL-ID {fol_id} on retry {retry_count + 1}")
                 except Exception as e:
-                    status_msg = f"Owner table not found on retry {retry_count + 1}: {e}"
+                    detail.status = f"Owner table not found on retry {retry_count + 1}: {e}"
                 
                 # Close the property detail page
                 close_selector = "#page-header-form\\:closePropertyDetailsPage"
@@ -726,90 +754,45 @@ async def extract_search_results(session):
                 await session.page.wait_for_selector("#searchResultForm\\:propertySearchSRT_data", timeout=10000)
                 
             except Exception as e:
-                status_msg = f"Retry {retry_count + 1} failed: {e}"
-                logging.error(f"[Session {session.session_id}] {status_msg}")
+                detail.status = f"Retry {retry_count + 1} failed: {e}"
+                logging.error(f"[Session {session.session_id}] {detail.status}")
             
             retry_count += 1
         
         # Add the retry information to the status message if retries were performed
-        if retry_count > 0 and "Recovered" not in status_msg:
-            status_msg += f" (After {retry_count} retries)"
+        if retry_count > 0 and "Recovered" not in detail.status:
+            detail.status += f" (After {retry_count} retries)"
         
         # Create the final data row
-        if owner_info:
-            combined = [fol_id, street, house_number, house_appendix] + owner_info + [status_msg, exploration_date, exploration_pdf_ref, au, bu, nvt_area]
-        else:
-            combined = [fol_id, street, house_number, house_appendix, "", "", "", "", status_msg, "", "", au, bu, nvt_area]
-        
-        extracted_data.append(combined)
+        record = PropertyRecord.from_listing(fol_id, street, house_number, house_appendix, au, bu, nvt_area, detail)
+        extracted_data.append(record)
+        if session.cursor is not None:
+            await checkpoint_property(session, page_number, ri, record)
     
+    if after_ri is not None:
+        logging.info(f"[Session {session.session_id}] Resumed page {page_number} after data-ri {after_ri}: "
+                     f"{len(rows) - len(row_data_cache)} rows already captured")
     return extracted_data
 
-async def save_page_data_to_db(session_id, page_number, data):
-    async with aiosqlite.connect("extraction.db") as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS property_data (
-                fol_id TEXT PRIMARY KEY,
-                session_id INTEGER,
-                page INTEGER,
-                street TEXT,
-                house_number TEXT,
-                house_appendix TEXT,
-                owner_name TEXT,
-                owner_email TEXT,
-                owner_mobile TEXT,
-                owner_landline TEXT,
-                status TEXT,
-                exploration TEXT,
-                exploration_pdf TEXT,
-                au TEXT,
-                bu TEXT,
-                nvt_area TEXT,
-                data_hash TEXT,
-                changed_flag INTEGER DEFAULT 0,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.commit()
-        async with db.execute("PRAGMA table_info(property_data)") as cursor:
-            columns = await cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        if "exploration" not in column_names:
-            await db.execute("ALTER TABLE property_data ADD COLUMN exploration TEXT")
-        if "exploration_pdf" not in column_names:
-            await db.execute("ALTER TABLE property_data ADD COLUMN exploration_pdf TEXT")
-        if "au" not in column_names:
-            await db.execute("ALTER TABLE property_data ADD COLUMN au TEXT")
-        if "bu" not in column_names:
-            await db.execute("ALTER TABLE property_data ADD COLUMN bu TEXT")
-        if "nvt_area" not in column_names:
-            await db.execute("ALTER TABLE property_data ADD COLUMN nvt_area TEXT")
-        await db.commit()
-        for row in data:
-            new_hash = calculate_hash(row)
-            await db.execute("""
-                INSERT INTO property_data 
-                (fol_id, session_id, page, street, house_number, house_appendix, owner_name, owner_email, owner_mobile, owner_landline, status, exploration, exploration_pdf, au, bu, nvt_area, data_hash, changed_flag)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-                ON CONFLICT(fol_id) DO UPDATE SET
-                    street = excluded.street,
-                    house_number = excluded.house_number,
-                    house_appendix = excluded.house_appendix,
-                    owner_name = excluded.owner_name,
-                    owner_email = excluded.owner_email,
-                    owner_mobile = excluded.owner_mobile,
-                    owner_landline = excluded.owner_landline,
-                    status = excluded.status,
-                    exploration = excluded.exploration,
-                    exploration_pdf = excluded.exploration_pdf,
-                    au = excluded.au,
-                    bu = excluded.bu,
-                    nvt_area = excluded.nvt_area,
-                    data_hash = CASE WHEN property_data.data_hash <> excluded.data_hash THEN excluded.data_hash ELSE property_data.data_hash END,
-                    changed_flag = CASE WHEN property_data.data_hash <> excluded.data_hash THEN 1 ELSE 0 END,
-                    last_updated = CURRENT_TIMESTAMP
-            """, (row[0], session_id, page_number, row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12], row[13], new_hash))
-        await db.commit()
+async def checkpoint_property(session, page_number, ri, record):
+    """
+    Commits one extracted property together with the session's cursor and
+    waits for the commit, so a crash loses at most the property in progress.
+    """
+    session.cursor.advance(page_number, ri)
+    await (await session.db_writer.submit(session.session_id, page_number, [record], cursor=session.cursor.params()))
+
+async def save_page_data_to_db(session_id, page_number, data, writer: Optional[PropertyDataWriter] = None):
+    """
+    Upserts one page of extracted rows. With a writer the rows are handed to the
+    shared writer task and this waits until they are committed; without one a
+    short-lived writer is used (for one-off scripts).
+    """
+    if writer is not None:
+        await (await writer.submit(session_id, page_number, data))
+        return
+    async with PropertyDataWriter("extraction.db") as one_off_writer:
+        await (await one_off_writer.submit(session_id, page_number, data))
 
 async def click_next_page(session):
     next_selector = "#searchResultForm\\:propertySearchSRT_paginator_top > a.ui-paginator-next > span"
@@ -838,7 +821,7 @@ async def go_to_page_by_clicking_number(session, page_number):
             await click_next_page(session)
             current_page += 1
 
-async def process_page_range(session, start_page, end_page):
+async def process_page_range(session, start_page, end_page, after_ri=None):
     # Stats for download optimization
     skipped_downloads = 0
     new_downloads = 0
@@ -853,14 +836,14 @@ async def process_page_range(session, start_page, end_page):
         prev_new = new_downloads
         
         # Extract and process the page
-        page_data = await extract_search_results(session)
+        page_data = await extract_search_results(session, page_number, after_ri if page_number == start_page else None)
         
         # Update download stats by checking which properties had unchanged dates
-        for row in page_data:
-            if row[9]:  # If exploration date exists
-                if row[10]:  # If PDF exists
+        for record in page_data:
+            if record.exploration:
+                if record.exploration_pdf:
                     # Check if it's an existing PDF path that was reused
-                    if Path(row[10]).exists() and "downloads in progress" not in row[8].lower():
+                    if protocol_exists(record.exploration_pdf, session.archive) and "downloads in progress" not in record.status.lower():
                         skipped_downloads += 1
                 else:
                     new_downloads += 1
@@ -871,7 +854,8 @@ async def process_page_range(session, start_page, end_page):
                          f"Skipped {skipped_downloads - prev_skipped} downloads, " +
                          f"Downloaded {new_downloads - prev_new} new PDFs")
         
-        await save_page_data_to_db(session.session_id, page_number, page_data)
+        if session.cursor is None:
+            await save_page_data_to_db(session.session_id, page_number, page_data, session.db_writer)
         logging.info(f"[Session {session.session_id}] Saved data for page {page_number}")
         
         if page_number < end_page:
@@ -882,6 +866,18 @@ async def process_page_range(session, start_page, end_page):
                  f"Skipped {skipped_downloads} downloads, " +
                  f"Downloaded {new_downloads} new PDFs")
 
+async def process_cursors(session, cursors):
+    """Crawls the page ranges of cursors one after another, resuming each at its position."""
+    for cursor in cursors:
+        cursor.session_id = session.session_id
+        session.cursor = cursor
+        logging.info(f"[Session {session.session_id}] Assigned pages {cursor.page} to {cursor.end_page}"
+                     + (f" (resuming after data-ri {cursor.ri})" if cursor.ri is not None else ""))
+        await process_page_range(session, cursor.page, cursor.end_page, cursor.ri)
+        cursor.complete()
+        await (await session.db_writer.submit(session.session_id, cursor.end_page, [], cursor=cursor.params()))
+    session.cursor = None
+
 # -------------------------------
 # Main & Multi-Session
 # -------------------------------
@@ -889,7 +885,6 @@ async def main():
     setup_logging(debug=True)
     total_pages = 49
     num_sessions = 4
-    pages_per_session = total_pages // num_sessions
     sessions = []
     for i in range(num_sessions):
         s = RobustIBTPropertySearchSession(
@@ -908,8 +903,42 @@ async def main():
     if not sessions:
         logging.error("No sessions available. Exiting.")
         return
+    area = "Bad Sooden-Allendorf, Stadt"
+    ensure_migrated("extraction.db")
+    # Run ids come from the main database; with sharding the area's rows go to its own file
+    run_id = start_run("extraction.db", area)
+    logging.info(f"Started crawl run {run_id} for area: {area}")
+    db_path = "extraction.db"
+    archive_dir = ARCHIVE_DIR
+    if sharding_enabled():
+        router = ShardRouter("extraction.db")
+        db_path = router.register(area)
+        archive_dir = router.archive_dir_for_area(area)
+        logging.info(f"Writing area {area} to shard {db_path}")
+    # Only the crawled area; the download-skip check never looks up other areas
+    prior_state = PriorStateCache.load(db_path, area=area)
+    # Unfinished page ranges of an interrupted crawl of this area are resumed
+    cursors, resumed = plan_ranges(db_path, area, total_pages, num_sessions, run_id)
+    # A resumed crawl continues the generation of the run that started it
+    generation = min(cursor.run_id for cursor in cursors)
+    if resumed:
+        set_run_generation("extraction.db", run_id, generation)
+        logging.info(f"Resuming interrupted crawl of {area} (generation {generation}): "
+                     f"{len(cursors)} unfinished page ranges")
+    # Optional streaming of changes to Airtable during the crawl (AIRTABLE_STREAM=1)
+    streamer = AirtableStreamer("extraction.db", run_id=run_id).start() if streaming_enabled() else None
+    writer = await PropertyDataWriter(db_path, prior_state=prior_state, run_id=run_id, area=area,
+                                      generation=generation, change_listener=streamer).start()
+    readers = await ReadPool(db_path, size=len(sessions)).start()
+    # One archive for the whole crawl; its index is written at checkpoints and on close
+    protocol_archive = ProtocolArchive(archive_dir) if archive_enabled() else None
+    for s in sessions:
+        s.db_writer = writer
+        s.db_readers = readers
+        s.prior_state = prior_state
+        s.archive_dir = archive_dir
+        s.protocol_archive = protocol_archive
     for s in sessions:
-        area = "Bad Sooden-Allendorf, Stadt"
         logging.info(f"[Session {s.session_id}] Setting search criteria for area: {area}")
         try:
             area_input = await s.page.wait_for_selector("[id='searchCriteriaForm:vvmArea_input']", timeout=10000)
@@ -939,22 +968,33 @@ async def main():
             logging.error(f"[Session {s.session_id}] Could not click search: {e}")
     tasks = []
     for i, s in enumerate(sessions):
-        start_page = i * pages_per_session + 1
-        if i == num_sessions - 1:
-            end_page = total_pages
-        else:
-            end_page = (i + 1) * pages_per_session
-        logging.info(f"[Session {s.session_id}] Assigned pages {start_page} to {end_page}")
-        tasks.append(process_page_range(s, start_page, end_page))
-    await asyncio.gather(*tasks)
-    async with aiosqlite.connect("extraction.db") as db:
+        # Ranges of sessions that failed to log in go to the others
+        tasks.append(process_cursors(s, cursors[i::len(sessions)]))
+    # Optional online snapshots during long runs (EXTRACTION_BACKUP_INTERVAL seconds)
+    backup_task = None
+    backup_interval = int(os.getenv("EXTRACTION_BACKUP_INTERVAL", "0") or 0)
+    if backup_interval > 0:
+        backup_task = asyncio.create_task(periodic_backups("extraction.db", backup_interval))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if backup_task is not None:
+            backup_task.cancel()
+        await readers.close()
+        await writer.close()
+        if protocol_archive is not None:
+            protocol_archive.close()
+        if streamer is not None:
+            await streamer.close()
+        finish_run("extraction.db", run_id)
+        logging.info(prior_state.report())
+    # Complete crawl of the area: properties it did not see are gone from the portal
+    if all(cursor.completed for cursor in cursors):
+        tombstone_unseen(db_path, area, generation, run_id)
+    async with aiosqlite.connect(db_path) as db:
         async with db.execute("SELECT * FROM property_data") as cursor:
             all_rows = await cursor.fetchall()
-            headers = [
-                "session_id", "page", "fol_id", "street", "house_number",
-                "house_appendix", "owner_name", "owner_email", "owner_mobile", "owner_landline",
-                "status", "exploration", "exploration_pdf", "au", "bu", "nvt_area"
-            ]
+            headers = [column[0] for column in cursor.description]
             print(tabulate(all_rows, headers=headers, tablefmt="pretty"))
     for s in sessions:
         await s.close()
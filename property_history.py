@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+property_history.py
+
+Append-only change history for property_data.
+
+Every crawl is registered in crawl_runs and gets an increasing run_id. When the
+writer stores a row whose data_hash differs from what is in property_data (or
+a property seen for the first time) it appends a version to property_history
+holding only the fields that changed, as {field: [old, new]}. Rows are never
+updated, so a change stays visible even if the next crawl re-saves the
+property unchanged and changed_flag drops back to 0.
+
+Both run_id and recorded_at are indexed, so "what changed since run N" or
+"since yesterday" is an index range scan rather than a table scan.
+
+Every run also has a generation: its own run_id, or for a run that resumes an
+interrupted crawl, the run_id of the run that started it. The writer stamps
+each saved row with the generation (property_data.seen_generation). After a
+complete crawl of an area, tombstone_unseen() marks the area's rows with an
+older generation as gone from the portal (tombstoned_at, tombstoned_run).
+Saving a tombstoned property again clears its tombstone.
+"""
+import json
+import sqlite3
+import logging
+from datetime import datetime, timezone
+
+from record_hash import HASHED_FIELDS
+
+logger = logging.getLogger("property_history")
+
+# property_data columns that are tracked in the history (the hashed fields).
+HISTORY_FIELDS = HASHED_FIELDS
+
+HISTORY_INSERT_SQL = """
+    INSERT INTO property_history (fol_id, version, run_id, data_hash, changes)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def field_deltas(old_values, new_values, fields=None):
+    """
+    Compares two {field: value} dicts over fields (default HISTORY_FIELDS) and
+    returns {field: [old, new]} for the fields that differ. old_values may be
+    None for a property seen for the first time.
+    """
+    deltas = {}
+    for field in fields or HISTORY_FIELDS:
+        old = old_values.get(field) if old_values else None
+        new = new_values.get(field)
+        if (old or "") != (new or ""):
+            deltas[field] = [old, new]
+    return deltas
+
+
+# -------------------------------
+# Crawl runs
+# -------------------------------
+def start_run(db_path="extraction.db", area=None):
+    """Registers a new crawl and returns its run_id. The run is its own generation."""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute("INSERT INTO crawl_runs (area) VALUES (?)", (area,))
+        conn.execute("UPDATE crawl_runs SET generation = run_id WHERE run_id = ?", (cursor.lastrowid,))
+        conn.commit()
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def set_run_generation(db_path, run_id, generation):
+    """Records that run_id continues the crawl started by run `generation`."""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("UPDATE crawl_runs SET generation = ? WHERE run_id = ?", (generation, run_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def finish_run(db_path, run_id):
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("UPDATE crawl_runs SET finished_at = CURRENT_TIMESTAMP WHERE run_id = ?", (run_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def tombstone_unseen(db_path, area, generation, run_id=None, max_fraction=0.2, force=False):
+    """
+    Marks the area's live properties that the crawl of `generation` did not
+    see as tombstoned, in one UPDATE over the partial (area, seen_generation)
+    index. Call it only after a complete crawl of the area.
+
+    If more than max_fraction of the area's live rows would be tombstoned the
+    crawl most likely missed pages, so nothing is marked unless force is set.
+    Returns the number of tombstoned rows, or None if the guard stopped it.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA busy_timeout = 10000")
+        conn.execute("BEGIN IMMEDIATE")
+        live, unseen = conn.execute("""
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE seen_generation < ?)
+            FROM property_data WHERE area = ? AND tombstoned_at IS NULL
+        """, (generation, area)).fetchone()
+        if unseen and not force and unseen > live * max_fraction:
+            conn.execute("ROLLBACK")
+            logger.warning(f"Not tombstoning {unseen} of {live} properties in {area}: more than "
+                           f"{max_fraction:.0%} unseen, the crawl was probably incomplete (use force)")
+            return None
+        tombstoned = conn.execute("""
+            UPDATE property_data SET tombstoned_at = CURRENT_TIMESTAMP, tombstoned_run = ?
+            WHERE area = ? AND seen_generation < ? AND tombstoned_at IS NULL
+        """, (run_id if run_id is not None else generation, area, generation)).rowcount
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    logger.info(f"Tombstoned {tombstoned} properties of {area} not seen by generation {generation}")
+    return tombstoned
+
+
+def tombstoned_properties(conn, area=None):
+    """(fol_id, area, street, house_number, house_appendix, tombstoned_at, tombstoned_run) of gone properties."""
+    where, params = ("AND area = ?", (area,)) if area else ("", ())
+    return conn.execute(f"""
+        SELECT fol_id, area, street, house_number, house_appendix, tombstoned_at, tombstoned_run
+        FROM property_data WHERE tombstoned_at IS NOT NULL {where}
+        ORDER BY tombstoned_at DESC, street, house_number
+    """, params).fetchall()
+
+
+def nth_latest_run(conn, n):
+    """run_id of the n-th most recent crawl (1 = latest), or None."""
+    row = conn.execute("SELECT run_id FROM crawl_runs ORDER BY run_id DESC LIMIT 1 OFFSET ?", (n - 1,)).fetchone()
+    return row[0] if row else None
+
+
+# -------------------------------
+# Queries
+# -------------------------------
+def changes_since_run(conn, run_id):
+    """
+    History versions recorded after run_id (exclusive), oldest first, as
+    (fol_id, version, run_id, changes dict, recorded_at) tuples.
+    """
+    cursor = conn.execute("""
+        SELECT fol_id, version, run_id, changes, recorded_at
+        FROM property_history
+        WHERE run_id > ?
+        ORDER BY run_id, id
+    """, (run_id,))
+    for fol_id, version, row_run_id, changes, recorded_at in cursor:
+        yield fol_id, version, row_run_id, json.loads(changes), recorded_at
+
+
+def changes_since_time(conn, since):
+    """
+    History versions recorded at or after the given datetime (naive means
+    local time) or UTC 'YYYY-MM-DD HH:MM:SS' string. recorded_at is UTC.
+    """
+    if isinstance(since, datetime):
+        since = since.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    cursor = conn.execute("""
+        SELECT fol_id, version, run_id, changes, recorded_at
+        FROM property_history
+        WHERE recorded_at >= ?
+        ORDER BY recorded_at, id
+    """, (since,))
+    for fol_id, version, run_id, changes, recorded_at in cursor:
+        yield fol_id, version, run_id, json.loads(changes), recorded_at
+
+
+def changed_fol_ids_since_run(conn, run_id):
+    """Set of FoL-IDs with at least one recorded change after run_id."""
+    return {row[0] for row in conn.execute(
+        "SELECT DISTINCT fol_id FROM property_history WHERE run_id > ?", (run_id,))}
+
+
+def property_versions(conn, fol_id):
+    """Full history of one property, oldest first."""
+    cursor = conn.execute("""
+        SELECT fol_id, version, run_id, changes, recorded_at
+        FROM property_history
+        WHERE fol_id = ?
+        ORDER BY version
+    """, (fol_id,))
+    for row_fol_id, version, run_id, changes, recorded_at in cursor:
+        yield row_fol_id, version, run_id, json.loads(changes), recorded_at
+
+
+if __name__ == "__main__":
+    import argparse
+    from tabulate import tabulate
+    from migrations import migrate
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Query the property change history')
+    parser.add_argument('--db-path', default='extraction.db', help='Path to the SQLite database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('runs', help='List crawl runs')
+
+    changes_parser = subparsers.add_parser('changes', help='List changes')
+    group = changes_parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--since-run', type=int, help='Changes recorded after this run id')
+    group.add_argument('--last-runs', type=int, help='Changes recorded in the last N runs')
+    group.add_argument('--since', help="Changes recorded since a UTC timestamp ('YYYY-MM-DD HH:MM:SS')")
+
+    show_parser = subparsers.add_parser('show', help='Show all versions of one property')
+    show_parser.add_argument('fol_id', help='FoL-ID of the property')
+
+    tombstones_parser = subparsers.add_parser('tombstones', help='List properties that are gone from the portal')
+    tombstones_parser.add_argument('--area', help='Only this area')
+
+    tombstone_parser = subparsers.add_parser('tombstone', help='Tombstone the rows of an area older than a generation')
+    tombstone_parser.add_argument('area', help='Area name')
+    tombstone_parser.add_argument('generation', type=int, help='Generation (run id) of the last complete crawl')
+    tombstone_parser.add_argument('--force', action='store_true', help='Skip the incomplete-crawl guard')
+
+    args = parser.parse_args()
+    migrate(args.db_path)
+    conn = sqlite3.connect(args.db_path)
+
+    if args.command == 'runs':
+        rows = conn.execute("""
+            SELECT r.run_id, r.generation, r.area, r.started_at, r.finished_at,
+                   (SELECT COUNT(*) FROM property_history h WHERE h.run_id = r.run_id)
+            FROM crawl_runs r ORDER BY r.run_id
+        """).fetchall()
+        print(tabulate(rows, headers=["run_id", "generation", "area", "started_at", "finished_at", "changes"],
+                       tablefmt="pretty"))
+    elif args.command == 'changes':
+        if args.since_run is not None:
+            changes = changes_since_run(conn, args.since_run)
+        elif args.last_runs is not None:
+            oldest = nth_latest_run(conn, args.last_runs + 1) or 0
+            changes = changes_since_run(conn, oldest)
+        else:
+            changes = changes_since_time(conn, args.since)
+        rows = [
+            (fol_id, version, run_id, recorded_at,
+             "; ".join(f"{field}: {old!r} -> {new!r}" for field, (old, new) in deltas.items()))
+            for fol_id, version, run_id, deltas, recorded_at in changes
+        ]
+        print(tabulate(rows, headers=["fol_id", "version", "run_id", "recorded_at", "changes"], tablefmt="pretty"))
+        logger.info(f"{len(rows)} changes")
+    elif args.command == 'show':
+        for fol_id, version, run_id, deltas, recorded_at in property_versions(conn, args.fol_id):
+            print(f"v{version} (run {run_id}, {recorded_at})")
+            for field, (old, new) in deltas.items():
+                print(f"  {field}: {old!r} -> {new!r}")
+        tombstone = conn.execute("SELECT tombstoned_at, tombstoned_run FROM property_data WHERE fol_id = ?",
+                                 (args.fol_id,)).fetchone()
+        if tombstone and tombstone[0]:
+            print(f"gone from the portal since {tombstone[0]} (run {tombstone[1]})")
+    elif args.command == 'tombstones':
+        rows = tombstoned_properties(conn, args.area)
+        print(tabulate(rows, headers=["fol_id", "area", "street", "house_number", "appendix", "tombstoned_at", "run"],
+                       tablefmt="pretty"))
+        logger.info(f"{len(rows)} tombstoned properties")
+    elif args.command == 'tombstone':
+        tombstone_unseen(args.db_path, args.area, args.generation, force=args.force)
+
+    conn.close()
@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+"""
+protocol_archive.py
+
+Packed archive for exploration protocol PDFs.
+
+Instead of one loose file per protocol in exploration_protocols/, protocols are
+appended to a small number of shard files (shard-00000.pack, ...) and located
+through a sorted, fixed-width index (index.idx) that is read via mmap, so a
+single PDF can be fetched by FoL-ID without unpacking anything.
+
+Shard record layout (little endian):
+    magic (4s) | name length (H) | data length (I) | crc32 (I) | name | data
+
+Index entry layout (little endian), sorted by FoL-ID:
+    fol_id (Q) | shard number (I) | record offset (Q) | data length (I)
+
+Shards are append-only. When a protocol is archived again for the same FoL-ID
+the new record is appended and the index entry is repointed to it, so the
+archive holds the newest protocol of every property.
+
+A crawl keeps one ProtocolArchive open and writes the index at checkpoints
+(every CHECKPOINT_EVERY protocols) and on close, not per PDF. Several
+processes may share an archive directory: appends and index swaps take an
+exclusive flock on archive.lock, and an index swap merges into the index
+currently on disk, so no process drops another's entries.
+"""
+import os
+import re
+import mmap
+import fcntl
+import struct
+import zlib
+import sqlite3
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+ARCHIVE_DIR = Path("exploration_protocols") / "archive"
+ARCHIVE_REF_PREFIX = "archive://"
+MAX_SHARD_SIZE = 256 * 1024 * 1024
+CHECKPOINT_EVERY = 100
+
+RECORD_MAGIC = b"EPR1"
+RECORD_HEADER = struct.Struct("<4sHII")
+INDEX_MAGIC = b"EPIX"
+INDEX_HEADER = struct.Struct("<4sI")
+INDEX_ENTRY = struct.Struct("<QIQI")
+
+FOL_ID_PATTERN = re.compile(r"Auskundungsprotokoll_(\d+)_")
+
+logger = logging.getLogger("protocol_archive")
+
+
+def archive_enabled():
+    """Archive mode is switched on with EXPLORATION_ARCHIVE=1 in the environment/.env."""
+    return os.getenv("EXPLORATION_ARCHIVE", "").lower() in ("1", "true", "yes")
+
+
+def fol_id_from_filename(filename):
+    """
+    Extracts the FoL-ID from a protocol filename like
+    'Auskundungsprotokoll_1000004314816_2024-11-19_08-32.pdf'.
+    Returns None if the name does not follow that pattern.
+    """
+    match = FOL_ID_PATTERN.search(Path(filename).name)
+    return match.group(1) if match else None
+
+
+def make_archive_ref(fol_id, filename):
+    """Reference stored in property_data.exploration_pdf for archived protocols."""
+    return f"{ARCHIVE_REF_PREFIX}{fol_id}/{Path(filename).name}"
+
+
+def parse_archive_ref(ref):
+    """Returns (fol_id, filename) for an archive reference, or None for a plain path."""
+    if not ref or not ref.startswith(ARCHIVE_REF_PREFIX):
+        return None
+    fol_id, _, filename = ref[len(ARCHIVE_REF_PREFIX):].partition("/")
+    return fol_id, filename
+
+
+def protocol_exists(ref, archive=ARCHIVE_DIR):
+    """
+    True if an exploration_pdf reference (loose path or archive ref) points to
+    a stored protocol. archive is an open ProtocolArchive or its directory.
+    """
+    if not ref:
+        return False
+    parsed = parse_archive_ref(ref)
+    if parsed is None:
+        return Path(ref).exists()
+    if isinstance(archive, ProtocolArchive):
+        return archive.contains(parsed[0])
+    with ProtocolArchive(archive) as opened:
+        return opened.contains(parsed[0])
+
+
+class ProtocolArchive:
+    """
+    Append-only sharded store for exploration protocols.
+
+    Lookups binary-search the mmap'ed index; entries added since the index was
+    last written are held in a small in-memory overlay until a checkpoint,
+    flush() or close() rewrites the index atomically.
+    """
+
+    def __init__(self, archive_dir=ARCHIVE_DIR, max_shard_size=MAX_SHARD_SIZE, checkpoint_every=CHECKPOINT_EVERY):
+        self.archive_dir = Path(archive_dir)
+        self.max_shard_size = max_shard_size
+        self.checkpoint_every = checkpoint_every
+        self.index_path = self.archive_dir / "index.idx"
+        self.lock_path = self.archive_dir / "archive.lock"
+        self._lock_file = None
+        self._lock_depth = 0
+        self._index_file = None
+        self._index_map = None
+        self._index_count = 0
+        self._pending = {}
+        self._write_shard = None
+        self._write_file = None
+        self._read_files = {}
+        self._open_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive flock on the archive directory (reentrant within this object)."""
+        if self._lock_depth == 0:
+            if self._lock_file is None:
+                self.archive_dir.mkdir(parents=True, exist_ok=True)
+                self._lock_file = open(self.lock_path, "ab")
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    # -------------------------------
+    # Index
+    # -------------------------------
+    def _open_index(self):
+        if not self.index_path.exists() or self.index_path.stat().st_size <= INDEX_HEADER.size:
+            return
+        self._index_file = open(self.index_path, "rb")
+        self._index_map = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = INDEX_HEADER.unpack_from(self._index_map, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{self.index_path} is not a protocol archive index")
+        self._index_count = count
+
+    def _close_index(self):
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+        self._index_count = 0
+
+    def _index_entry(self, position):
+        return INDEX_ENTRY.unpack_from(self._index_map, INDEX_HEADER.size + position * INDEX_ENTRY.size)
+
+    def _search_index(self, fol_id):
+        """Binary search over the mmap'ed index. Returns (shard, offset, length) or None."""
+        low, high = 0, self._index_count - 1
+        while low <= high:
+            mid = (low + high) // 2
+            entry_id, shard, offset, length = self._index_entry(mid)
+            if entry_id == fol_id:
+                return shard, offset, length
+            if entry_id < fol_id:
+                low = mid + 1
+            else:
+                high = mid - 1
+        return None
+
+    def _lookup(self, fol_id):
+        key = int(fol_id)
+        if key in self._pending:
+            return self._pending[key]
+        if self._index_map is None:
+            return None
+        return self._search_index(key)
+
+    def _iter_index(self):
+        for position in range(self._index_count):
+            yield self._index_entry(position)
+
+    def flush(self):
+        """Merges pending entries into a new sorted index and swaps it in atomically."""
+        if self._write_file is not None:
+            self._write_file.flush()
+            os.fsync(self._write_file.fileno())
+        if not self._pending:
+            return
+        with self._locked():
+            # Merge into the index on disk, which another process may have swapped since we opened it
+            self._close_index()
+            self._open_index()
+            entries = {fol_id: (shard, offset, length) for fol_id, shard, offset, length in self._iter_index()}
+            entries.update(self._pending)
+            tmp_path = self.index_path.with_suffix(".idx.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(entries)))
+                for fol_id in sorted(entries):
+                    f.write(INDEX_ENTRY.pack(fol_id, *entries[fol_id]))
+                f.flush()
+                os.fsync(f.fileno())
+            self._close_index()
+            os.replace(tmp_path, self.index_path)
+            self._pending.clear()
+            self._open_index()
+
+    def close(self):
+        self.flush()
+        self._close_index()
+        if self._write_file is not None:
+            self._write_file.close()
+            self._write_file = None
+        for f in self._read_files.values():
+            f.close()
+        self._read_files.clear()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # -------------------------------
+    # Shards
+    # -------------------------------
+    def _shard_path(self, shard):
+        return self.archive_dir / f"shard-{shard:05d}.pack"
+
+    def _existing_shards(self):
+        return sorted(int(p.stem.split("-")[1]) for p in self.archive_dir.glob("shard-*.pack"))
+
+    def _writer_for(self, record_size):
+        """Shard file to append to. Called with the lock held."""
+        shards = self._existing_shards()
+        newest = shards[-1] if shards else 0
+        if self._write_file is None or newest > self._write_shard:
+            # First write, or another process has started a newer shard
+            if self._write_file is not None:
+                self._write_file.close()
+            self.archive_dir.mkdir(parents=True, exist_ok=True)
+            self._write_shard = newest
+            self._write_file = open(self._shard_path(self._write_shard), "ab")
+        # The end of the file, including what other processes appended
+        position = self._write_file.seek(0, os.SEEK_END)
+        if position > 0 and position + record_size > self.max_shard_size:
+            self._write_file.close()
+            self._write_shard += 1
+            self._write_file = open(self._shard_path(self._write_shard), "ab")
+        return self._write_shard, self._write_file
+
+    def _reader_for(self, shard):
+        f = self._read_files.get(shard)
+        if f is None:
+            f = open(self._shard_path(shard), "rb")
+            self._read_files[shard] = f
+        return f
+
+    def _read_record(self, shard, offset, verify=True):
+        if self._write_file is not None and shard == self._write_shard:
+            self._write_file.flush()
+        f = self._reader_for(shard)
+        f.seek(offset)
+        magic, name_len, data_len, crc = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        if magic != RECORD_MAGIC:
+            raise ValueError(f"Corrupt record in {self._shard_path(shard)} at offset {offset}")
+        name = f.read(name_len).decode("utf-8")
+        data = f.read(data_len)
+        if verify and zlib.crc32(data) != crc:
+            raise ValueError(f"CRC mismatch for {name} in {self._shard_path(shard)}")
+        return name, data
+
+    def _read_name(self, shard, offset):
+        if self._write_file is not None and shard == self._write_shard:
+            self._write_file.flush()
+        f = self._reader_for(shard)
+        f.seek(offset)
+        magic, name_len, _, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        if magic != RECORD_MAGIC:
+            raise ValueError(f"Corrupt record in {self._shard_path(shard)} at offset {offset}")
+        return f.read(name_len).decode("utf-8")
+
+    # -------------------------------
+    # Public API
+    # -------------------------------
+    def add(self, fol_id, filename, data):
+        """Appends a protocol to the current shard and returns its archive reference."""
+        name = Path(filename).name.encode("utf-8")
+        header = RECORD_HEADER.pack(RECORD_MAGIC, len(name), len(data), zlib.crc32(data))
+        with self._locked():
+            shard, f = self._writer_for(len(header) + len(name) + len(data))
+            offset = f.tell()
+            f.write(header)
+            f.write(name)
+            f.write(data)
+            # On disk before the lock is released, so the next writer appends after it
+            f.flush()
+        self._pending[int(fol_id)] = (shard, offset, len(data))
+        if len(self._pending) >= self.checkpoint_every:
+            self.flush()
+        return make_archive_ref(fol_id, filename)
+
+    def add_file(self, path, fol_id=None):
+        """Archives a loose protocol file. The FoL-ID is taken from the filename unless given."""
+        path = Path(path)
+        fol_id = fol_id or fol_id_from_filename(path.name)
+        if not fol_id:
+            raise ValueError(f"Cannot determine FoL-ID for {path}")
+        return self.add(fol_id, path.name, path.read_bytes())
+
+    def contains(self, fol_id):
+        return self._lookup(fol_id) is not None
+
+    def location(self, fol_id):
+        """(shard, offset, length) of the protocol indexed for fol_id, or None."""
+        return self._lookup(fol_id)
+
+    def name_of(self, fol_id):
+        """Filename of the protocol indexed for fol_id, or None (reads only the record header)."""
+        location = self._lookup(fol_id)
+        return None if location is None else self._read_name(location[0], location[1])
+
+    def get(self, fol_id):
+        """Returns (filename, pdf_bytes) for a FoL-ID, or None if it is not archived."""
+        location = self._lookup(fol_id)
+        if location is None:
+            return None
+        shard, offset, _ = location
+        return self._read_record(shard, offset)
+
+    def extract(self, fol_id, destination) -> Optional[Path]:
+        """Writes the archived protocol for fol_id into a directory (or to a file path)."""
+        result = self.get(fol_id)
+        if result is None:
+            return None
+        filename, data = result
+        destination = Path(destination)
+        target = destination / filename if destination.is_dir() else destination
+        target.write_bytes(data)
+        return target
+
+    def __len__(self):
+        return len(set(self._pending) | {entry[0] for entry in self._iter_index()})
+
+    def entries(self):
+        """Yields (fol_id, shard, offset, length) for every indexed protocol, sorted by FoL-ID."""
+        merged = {fol_id: (shard, offset, length) for fol_id, shard, offset, length in self._iter_index()}
+        merged.update(self._pending)
+        for fol_id in sorted(merged):
+            yield (str(fol_id), *merged[fol_id])
+
+    def verify(self):
+        """Re-reads every indexed record and checks its CRC. Returns a list of error strings."""
+        errors = []
+        for fol_id, shard, offset, _ in self.entries():
+            try:
+                self._read_record(shard, offset)
+            except (OSError, ValueError, struct.error) as e:
+                errors.append(f"{fol_id}: {e}")
+        return errors
+
+    def rebuild_index(self):
+        """
+        Rebuilds the index by scanning all shards in order. Later records win,
+        which matches the append-only semantics used by add().
+        """
+        with self._locked():
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._close_index()
+        self._pending.clear()
+        for shard in self._existing_shards():
+            with open(self._shard_path(shard), "rb") as f:
+                offset = 0
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    magic, name_len, data_len, _ = RECORD_HEADER.unpack(header)
+                    if magic != RECORD_MAGIC:
+                        logger.warning(f"Stopping scan of shard {shard} at offset {offset}: bad magic")
+                        break
+                    name = f.read(name_len).decode("utf-8")
+                    f.seek(data_len, os.SEEK_CUR)
+                    fol_id = fol_id_from_filename(name)
+                    if fol_id:
+                        self._pending[int(fol_id)] = (shard, offset, data_len)
+                    offset += RECORD_HEADER.size + name_len + data_len
+        if self.index_path.exists():
+            self.index_path.unlink()
+        self.flush()
+
+
+def archive_downloaded_protocol(path, fol_id=None, archive=ARCHIVE_DIR):
+    """
+    Moves a freshly downloaded protocol into the archive and returns the archive
+    reference to store in property_data. The loose file is removed afterwards.
+    A crawl passes its open ProtocolArchive; a directory opens (and flushes) one
+    for this protocol only.
+    """
+    path = Path(path)
+    if isinstance(archive, ProtocolArchive):
+        ref = archive.add_file(path, fol_id)
+    else:
+        with ProtocolArchive(archive) as opened:
+            ref = opened.add_file(path, fol_id)
+    path.unlink()
+    return ref
+
+
+def migrate_loose_protocols(source_dir="exploration_protocols", archive_dir=ARCHIVE_DIR,
+                            db_path="extraction.db", keep_files=False):
+    """
+    Packs the loose *.pdf protocols from source_dir into the archive, verifies
+    each record, repoints property_data.exploration_pdf to the archive reference
+    and (unless keep_files) deletes the loose files.
+
+    The index holds one protocol per FoL-ID, so of several files for a FoL-ID
+    only the newest (by the date in the filename) is archived; the older ones
+    are left in source_dir and their database references are repointed too.
+    Files already in the archive (a rerun) are not appended again.
+    """
+    source_dir = Path(source_dir)
+    stats = {'archived': 0, 'already_archived': 0, 'superseded': 0, 'skipped': 0, 'db_updated': 0}
+    by_fol_id = {}
+    for path in sorted(source_dir.glob("*.pdf")):
+        fol_id = fol_id_from_filename(path.name)
+        if not fol_id:
+            logger.warning(f"Skipping {path}: no FoL-ID in filename")
+            stats['skipped'] += 1
+            continue
+        by_fol_id.setdefault(fol_id, []).append(path)
+
+    refs = {}  # loose path -> archive reference
+    archived = []  # (path, ref, location) of the newest file per FoL-ID
+    with ProtocolArchive(archive_dir) as archive:
+        for fol_id, paths in by_fol_id.items():
+            newest = max(paths, key=lambda path: path.name)
+            stored_name = archive.name_of(fol_id)
+            if stored_name is not None and stored_name >= newest.name:
+                # The archive already holds this protocol (or a newer one)
+                ref = make_archive_ref(fol_id, stored_name)
+                if stored_name == newest.name:
+                    archived.append((newest, ref, archive.location(fol_id)))
+                    stats['already_archived'] += 1
+                    paths = [path for path in paths if path != newest]
+            else:
+                ref = archive.add_file(newest, fol_id)
+                archived.append((newest, ref, archive.location(fol_id)))
+                stats['archived'] += 1
+                paths = [path for path in paths if path != newest]
+            for path in paths:
+                refs[str(path)] = ref
+            stats['superseded'] += len(paths)
+        archive.flush()
+
+        for path, ref, (shard, offset, _) in archived:
+            name, data = archive._read_record(shard, offset)
+            if name != path.name or data != path.read_bytes():
+                raise ValueError(f"Archived copy of {path} does not match the original")
+            refs[str(path)] = ref
+
+    if Path(db_path).exists():
+        conn = sqlite3.connect(db_path)
+        try:
+            for path_str, ref in refs.items():
+                cursor = conn.execute(
+                    "UPDATE property_data SET exploration_pdf = ? WHERE exploration_pdf IN (?, ?)",
+                    (ref, path_str, str(Path(path_str).resolve())),
+                )
+                stats['db_updated'] += cursor.rowcount
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Could not update exploration_pdf references: {e}")
+        finally:
+            conn.close()
+
+    if not keep_files:
+        for path, _, _ in archived:
+            path.unlink()
+    if stats['superseded']:
+        logger.info(f"{stats['superseded']} older protocols of already archived FoL-IDs were left in {source_dir}")
+
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Packed archive for exploration protocol PDFs')
+    parser.add_argument('--archive-dir', default=str(ARCHIVE_DIR), help='Directory holding shards and index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='Pack loose protocol files into the archive')
+    migrate_parser.add_argument('--source-dir', default='exploration_protocols', help='Directory with loose PDFs')
+    migrate_parser.add_argument('--db-path', default='extraction.db', help='Path to the SQLite database')
+    migrate_parser.add_argument('--keep-files', action='store_true', help='Do not delete loose files after packing')
+
+    get_parser = subparsers.add_parser('get', help='Extract a single protocol by FoL-ID')
+    get_parser.add_argument('fol_id', help='FoL-ID of the protocol')
+    get_parser.add_argument('--output', default='.', help='Output directory or file path')
+
+    subparsers.add_parser('list', help='List archived protocols')
+    subparsers.add_parser('verify', help='Check CRCs of all archived protocols')
+    subparsers.add_parser('reindex', help='Rebuild the index by scanning the shards')
+
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        stats = migrate_loose_protocols(args.source_dir, args.archive_dir, args.db_path, args.keep_files)
+        logger.info(f"Archived {stats['archived']} protocols ({stats['already_archived']} were already archived, "
+                    f"{stats['superseded']} superseded), skipped {stats['skipped']}, "
+                    f"updated {stats['db_updated']} database references")
+    else:
+        with ProtocolArchive(args.archive_dir) as archive:
+            if args.command == 'get':
+                target = archive.extract(args.fol_id, args.output)
+                if target:
+                    logger.info(f"Extracted protocol for FoL-ID {args.fol_id} to {target}")
+                else:
+                    logger.error(f"No archived protocol for FoL-ID {args.fol_id}")
+            elif args.command == 'list':
+                for fol_id, shard, offset, length in archive.entries():
+                    print(f"{fol_id}\tshard-{shard:05d}\t{offset}\t{length}")
+            elif args.command == 'verify':
+                errors = archive.verify()
+                for error in errors:
+                    logger.error(error)
+                logger.info(f"Verified {len(archive)} protocols, {len(errors)} errors")
+            elif args.command == 'reindex':
+                archive.rebuild_index()
+                logger.info(f"Rebuilt index with {len(archive)} protocols")
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+record_hash.py
+
+Field-aware hashing of property rows.
+
+A row is hashed by field name, never by position, so reordering columns
+cannot silently change what gets hashed. status and exploration_pdf are
+deliberately not hashed.
+
+Two things are stored per row:
+- data_hash: a keyed 128-bit BLAKE2b over the NUL-separated field values.
+  This is what decides whether a row changed.
+- field_digests: a vector with one 4-byte CRC32 per field (seeded with the
+  field name). Comparing two vectors slice by slice tells which fields
+  changed without loading the rows. The vector only locates a change; if
+  the row digests differ but no slice does (a CRC collision), every field is
+  reported as changed.
+
+The values are joined and encoded once and the per-field CRCs run over the
+split bytes, so most of the per-row work happens in C. A BLAKE2b per field
+was measured at roughly twice the cost of the old JSON + SHA-256 hash; this
+layout is slightly faster than it (see `python record_hash.py bench`).
+"""
+import hashlib
+import json
+import zlib
+from array import array
+
+# Hashed fields, in digest-vector order. Append new fields at the end only:
+# the position of a field in the vector is part of the stored format.
+HASHED_FIELDS = [
+    "street", "house_number", "house_appendix",
+    "owner_name", "owner_email", "owner_mobile", "owner_landline",
+    "exploration", "au", "bu", "nvt_area",
+]
+
+FIELD_DIGEST_SIZE = 4
+ROW_DIGEST_SIZE = 16
+HASH_KEY = b"extraction.db/property_data"
+SEPARATOR = "\x00"
+
+_ROW_HASHER = hashlib.blake2b(digest_size=ROW_DIGEST_SIZE, key=HASH_KEY, person=b"property_row")
+_FIELD_SEEDS = [zlib.crc32(field.encode("utf-8")) for field in HASHED_FIELDS]
+_OFFSETS = {field: i * FIELD_DIGEST_SIZE for i, field in enumerate(HASHED_FIELDS)}
+
+
+def _text(value):
+    if value is None:
+        return ""
+    return value if isinstance(value, str) else str(value)
+
+
+def hash_record(values):
+    """Returns (data_hash hex, field_digests bytes) for a {field: value} mapping (missing fields hash as empty)."""
+    texts = [_text(value) for value in map(values.get, HASHED_FIELDS)]
+    joined = SEPARATOR.join(texts).encode("utf-8")
+    hasher = _ROW_HASHER.copy()
+    hasher.update(joined)
+    parts = joined.split(SEPARATOR.encode("utf-8"))
+    if len(parts) != len(HASHED_FIELDS):
+        # A value contained the separator itself
+        parts = [text.encode("utf-8") for text in texts]
+    digests = array("I", map(zlib.crc32, parts, _FIELD_SEEDS)).tobytes()
+    return hasher.hexdigest(), digests
+
+
+def field_digests(values):
+    """Per-field digest vector for a {field: value} mapping."""
+    return hash_record(values)[1]
+
+
+def field_digest(digests, field):
+    """The digest of a single field taken from a digest vector."""
+    offset = _OFFSETS[field]
+    return digests[offset:offset + FIELD_DIGEST_SIZE]
+
+
+def changed_fields(old_digests, new_digests, old_hash=None, new_hash=None):
+    """
+    Names of the fields whose digests differ. A missing old vector (new
+    property, or a row written before field digests existed) means all fields.
+    When both row hashes are given and differ but no field digest does, all
+    fields are returned as well.
+    """
+    if not old_digests or len(old_digests) != len(new_digests):
+        return list(HASHED_FIELDS)
+    if old_digests == new_digests:
+        fields = []
+    else:
+        fields = [field for field in HASHED_FIELDS
+                  if field_digest(old_digests, field) != field_digest(new_digests, field)]
+    if not fields and old_hash is not None and old_hash != new_hash:
+        return list(HASHED_FIELDS)
+    return fields
+
+
+def legacy_sha256_hash(property_data):
+    """
+    The positional SHA-256 hash used before field digests (JSON of the list
+    row with status and PDF path blanked). Kept for benchmarking only.
+    """
+    hash_data = list(property_data)
+    if len(hash_data) > 8:
+        hash_data[8] = ""
+    if len(hash_data) > 10:
+        hash_data[10] = ""
+    data_str = json.dumps(hash_data, sort_keys=True)
+    return hashlib.sha256(data_str.encode('utf-8')).hexdigest()
+
+
+def benchmark(rows=1_000_000):
+    """Times legacy_sha256_hash against hash_record over synthetic rows. Returns {name: (seconds, rows)}."""
+    import time
+    import random
+
+    random.seed(42)
+    streets = [f"Street {i}" for i in range(200)]
+    names = [f"Owner {i}" for i in range(5000)]
+    positional = []
+    named = []
+    for i in range(rows):
+        row = [
+            str(1000004300000 + i), random.choice(streets), str(random.randint(1, 120)), random.choice(["", "a", "b"]),
+            random.choice(names), f"owner{i % 5000}@example.de", f"0151{i % 10000000:07d}", "",
+            "", "6/1/2024 01:01AM", "", str(random.randint(1, 30)), str(random.randint(0, 3)), f"NVT {i % 300}",
+        ]
+        positional.append(row)
+        named.append({
+            "street": row[1], "house_number": row[2], "house_appendix": row[3],
+            "owner_name": row[4], "owner_email": row[5], "owner_mobile": row[6], "owner_landline": row[7],
+            "exploration": row[9], "au": row[11], "bu": row[12], "nvt_area": row[13],
+        })
+
+    results = {}
+    started = time.perf_counter()
+    for row in positional:
+        legacy_sha256_hash(row)
+    results['legacy sha256/json'] = (time.perf_counter() - started, rows)
+
+    started = time.perf_counter()
+    for values in named:
+        hash_record(values)
+    results['blake2b row + field crcs'] = (time.perf_counter() - started, rows)
+
+    # Change detection: the legacy hash needs both full rows to say which
+    # field changed; digest vectors are compared slice by slice.
+    vectors = [field_digests(v) for v in named[:rows // 10]]
+    modified = [v[:4] + bytes(4) + v[8:] for v in vectors]
+    started = time.perf_counter()
+    for old, new in zip(vectors, modified):
+        changed_fields(old, new)
+    results['changed_fields'] = (time.perf_counter() - started, len(vectors))
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Field-aware record hashing')
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Number of synthetic rows')
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        for name, (seconds, count) in benchmark(args.rows).items():
+            print(f"{name:<24} {count:>9,} rows {seconds:8.2f}s  {count / seconds:>12,.0f} rows/s")
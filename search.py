@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+search.py
+
+Full-text lookup of properties for dispatchers.
+
+property_search is an FTS5 index over property_data (migration 11), one
+entry per property with the same rowid:
+
+    fol_id     FoL-ID
+    street     street name
+    house      house number, and number plus appendix ("12 12a")
+    owner      owner name
+    contact    email and phone numbers, as entered and in E.164 form;
+               national numbers in a query are also tried in E.164, so
+               "0151 234-567", "0151234567" and "+49151234567" all match
+    nvt_area   NVT area
+
+Triggers on property_data keep the index current on every insert, delete
+and any update that touches an indexed column, so the crawler and the DB
+writer need no extra code. Every search term is matched as a prefix
+("haupt 12" finds Hauptstraße 12a), and results are ranked with bm25,
+weighting street and house number highest.
+
+bm25 has to score every match, which costs about 1.5 µs per matching row.
+Queries matching more than MAX_RANKED_MATCHES rows (a bare "weg" or "nvt")
+return the first rows unranked instead, with a hint to narrow the query,
+so a lookup stays in the millisecond range at any table size.
+
+With EXTRACTION_SHARDS=1 every shard file has its own index over its own
+rows. search_across() queries the main database and each shard file and
+merges the results by score.
+"""
+import re
+import time
+import sqlite3
+import logging
+
+from normalize import canonical_phone
+
+logger = logging.getLogger("search")
+
+# bm25 weights, in column order: fol_id, street, house, owner, contact, nvt_area
+RANK_WEIGHTS = (2.0, 4.0, 4.0, 3.0, 2.0, 1.0)
+
+MAX_RANKED_MATCHES = 5000
+
+PHONE_INPUT = re.compile(r"\+?[\d\s()/-]+")
+
+SEARCH_COLUMNS = ["fol_id", "street", "house", "owner", "contact", "nvt_area"]
+
+# Expressions filling the index from a property_data row (NEW.* in triggers)
+SEARCH_VALUES_SQL = """
+    {row}.fol_id,
+    {row}.street,
+    TRIM(COALESCE({row}.house_number, '') || ' ' || COALESCE({row}.house_number, '') || COALESCE({row}.house_appendix, '')),
+    {row}.owner_name,
+    TRIM(COALESCE({row}.owner_email, '') || ' ' || COALESCE({row}.owner_mobile, '') || ' ' || COALESCE({row}.owner_landline, '')
+         || ' ' || COALESCE({row}.owner_mobile_norm, '') || ' ' || COALESCE({row}.owner_landline_norm, '')),
+    {row}.nvt_area
+"""
+
+# property_data columns the index is built from
+INDEXED_SOURCE_COLUMNS = [
+    "fol_id", "street", "house_number", "house_appendix", "owner_name", "owner_email",
+    "owner_mobile", "owner_landline", "owner_mobile_norm", "owner_landline_norm", "nvt_area",
+]
+
+
+def create_search_index(conn):
+    """
+    Creates property_search and its triggers and indexes all existing rows.
+    Migration 11 keeps a frozen copy; a change here needs a new migration.
+    """
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS property_search USING fts5(
+            {', '.join(SEARCH_COLUMNS)},
+            tokenize = "unicode61 remove_diacritics 2",
+            prefix = '2 3'
+        )
+    """)
+    changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in INDEXED_SOURCE_COLUMNS)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS property_search_insert AFTER INSERT ON property_data BEGIN
+            INSERT INTO property_search (rowid, {', '.join(SEARCH_COLUMNS)})
+            VALUES (NEW.rowid, {SEARCH_VALUES_SQL.format(row='NEW')});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS property_search_update AFTER UPDATE ON property_data
+        WHEN {changed} BEGIN
+            DELETE FROM property_search WHERE rowid = OLD.rowid;
+            INSERT INTO property_search (rowid, {', '.join(SEARCH_COLUMNS)})
+            VALUES (NEW.rowid, {SEARCH_VALUES_SQL.format(row='NEW')});
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS property_search_delete AFTER DELETE ON property_data BEGIN
+            DELETE FROM property_search WHERE rowid = OLD.rowid;
+        END
+    """)
+    rebuild_search_index(conn)
+
+
+def rebuild_search_index(conn):
+    """Re-indexes every property_data row. Returns the number of indexed rows."""
+    conn.execute("DELETE FROM property_search")
+    conn.execute(f"""
+        INSERT INTO property_search (rowid, {', '.join(SEARCH_COLUMNS)})
+        SELECT rowid, {SEARCH_VALUES_SQL.format(row='property_data')} FROM property_data
+    """)
+    conn.execute("INSERT INTO property_search (property_search) VALUES ('optimize')")
+    return conn.execute("SELECT COUNT(*) FROM property_search").fetchone()[0]
+
+
+def build_match_query(text):
+    """
+    Turns free text into an FTS5 query: every word becomes a quoted prefix
+    term and all terms must match. A national phone number ("0151...") also
+    matches its E.164 form. Returns None if there is nothing to search.
+    """
+    if PHONE_INPUT.fullmatch(text.strip()) and sum(c.isdigit() for c in text) >= 6:
+        # A whole phone number ("0151 234-567", "+49 151 234567"): one E.164 prefix term
+        # rather than several short digit prefixes that each match thousands of rows
+        digits = re.sub(r"\D", "", text)
+        return f'"{digits}"* OR "{canonical_phone(text).lstrip("+")}"*'
+    terms = [term.lstrip("+").replace('"', "") for term in re.split(r"[\s,;/]+", text.strip())]
+    parts = []
+    for term in filter(None, terms):
+        if term.isdigit() and term.startswith("0") and len(term) >= 6:
+            parts.append(f'("{term}"* OR "{canonical_phone(term).lstrip("+")}"*)')
+        else:
+            parts.append(f'"{term}"*')
+    return " AND ".join(parts) or None
+
+
+def search_properties(conn, text, limit=20):
+    """
+    (fol_id, street, house_number, house_appendix, owner_name, nvt_area,
+    score) rows for free text, best match first. score is None when the query
+    matched too many rows to rank (see MAX_RANKED_MATCHES).
+    """
+    query = build_match_query(text)
+    if query is None:
+        return []
+    matches = conn.execute("SELECT COUNT(*) FROM (SELECT rowid FROM property_search WHERE property_search MATCH ? LIMIT ?)",
+                           (query, MAX_RANKED_MATCHES + 1)).fetchone()[0]
+    if matches > MAX_RANKED_MATCHES:
+        logger.info(f"More than {MAX_RANKED_MATCHES} matches for {text!r}, showing unranked results; narrow the query")
+        score = "NULL"
+        order = ""
+    else:
+        score = f"bm25(property_search, {', '.join(str(weight) for weight in RANK_WEIGHTS)})"
+        order = "ORDER BY score"
+    return conn.execute(f"""
+        SELECT p.fol_id, p.street, p.house_number, p.house_appendix, p.owner_name, p.nvt_area, {score} AS score
+        FROM property_search
+        JOIN property_data p ON p.rowid = property_search.rowid
+        WHERE property_search MATCH ?
+        {order}
+        LIMIT ?
+    """, (query, limit)).fetchall()
+
+
+def search_across(db_paths, text, limit=20):
+    """search_properties() over several databases, merged best score first (unranked results last)."""
+    rows = []
+    for db_path in db_paths:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows += search_properties(conn, text, limit)
+        finally:
+            conn.close()
+    rows.sort(key=lambda row: (row[6] is None, row[6] or 0.0))
+    return rows[:limit]
+
+
+if __name__ == "__main__":
+    import argparse
+    from tabulate import tabulate
+    from migrations import migrate
+    from shards import ShardRouter
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Full-text property lookup')
+    parser.add_argument('text', nargs='*', help='Street, house number, owner, email, phone, NVT area or FoL-ID')
+    parser.add_argument('--db-path', default='extraction.db', help='Path to the SQLite database')
+    parser.add_argument('--limit', type=int, default=20, help='Maximum number of results')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the search index from property_data')
+    args = parser.parse_args()
+
+    migrate(args.db_path)
+    # Properties and their index live in the shard files with EXTRACTION_SHARDS=1
+    databases = [args.db_path] + ShardRouter(args.db_path).paths()
+    if args.rebuild:
+        for db_path in databases:
+            started = time.perf_counter()
+            conn = sqlite3.connect(db_path)
+            count = rebuild_search_index(conn)
+            conn.commit()
+            conn.close()
+            logger.info(f"{db_path}: indexed {count} properties in {time.perf_counter() - started:.1f}s")
+    if args.text:
+        started = time.perf_counter()
+        rows = search_across(databases, " ".join(args.text), args.limit)
+        elapsed = time.perf_counter() - started
+        print(tabulate([row[:6] + ("" if row[6] is None else f"{row[6]:.2f}",) for row in rows],
+                       headers=["fol_id", "street", "house_number", "appendix", "owner_name", "nvt_area", "score"],
+                       tablefmt="pretty"))
+        logger.info(f"{len(rows)} results from {len(databases)} database(s) in {elapsed * 1000:.1f} ms")
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+shards.py
+
+Per-area sharding of extraction.db.
+
+With EXTRACTION_SHARDS=1 every crawl area gets its own SQLite file in
+shards/ holding that area's property_data and property_history, and its own
+protocol archive next to it. Concurrent crawls of different areas then write
+to different files, and one area can be vacuumed, backed up or dropped
+without touching the others.
+
+SQLite attaches at most 10 databases to one connection (a compile-time
+limit that setlimit() can only lower), so the number of shard files is
+bounded by SHARD_FILES (EXTRACTION_SHARD_FILES, at most MAX_ATTACHED). Once
+that many files exist, a new area shares the file holding the fewest areas;
+its rows are told apart by property_data.area. Shards from before files were
+shared (one per area) are merged down with `python shards.py consolidate`.
+
+extraction.db stays the main database. It holds the Airtable snapshot
+(buildings, airtable_sync), the crawl_runs registry (so run ids stay globally
+increasing across shards) and the shard catalog:
+
+    shards(area, path, created_at)
+
+ShardRouter maps an area or a FoL-ID to its shard file.
+federated_connection() opens extraction.db, ATTACHes every shard and
+creates TEMP views named property_data and property_history that UNION the
+main tables with the shard files' tables. TEMP objects shadow main ones, so the
+existing queries in sync_changes.py and check_missing_records.py run
+unchanged across all areas.
+
+Every shard is migrated to the same schema as the main database, so an
+existing extraction.db can be split into shards (`python shards.py split`)
+and still read through the federation while it is split.
+"""
+import os
+import re
+import sqlite3
+import logging
+from pathlib import Path
+
+from migrations import ensure_migrated
+from owners import link_owners
+
+SHARD_DIR = Path("shards")
+MAIN_DB = "extraction.db"
+
+# SQLite's default SQLITE_MAX_ATTACHED; one slot is left for ad-hoc ATTACHes
+MAX_ATTACHED = 10
+SHARD_FILES = min(int(os.getenv("EXTRACTION_SHARD_FILES", "8") or 8), MAX_ATTACHED - 1)
+
+# Tables that live in the shards and are federated under their own name
+FEDERATED_TABLES = ["property_data", "property_history"]
+
+# Per-area tables of a shard file merged by consolidate_shards(), with the conflict
+# resolution for rows already present (history versions are unique per FoL-ID)
+MERGED_TABLES = [("property_data", "REPLACE"), ("property_history", "IGNORE"), ("crawl_cursors", "REPLACE")]
+
+logger = logging.getLogger("shards")
+
+
+def sharding_enabled():
+    """Sharding is switched on with EXTRACTION_SHARDS=1 in the environment/.env."""
+    return os.getenv("EXTRACTION_SHARDS", "").lower() in ("1", "true", "yes")
+
+
+def area_slug(area):
+    """'Bad Sooden-Allendorf, Stadt' -> 'bad-sooden-allendorf-stadt'."""
+    slug = re.sub(r"[^a-z0-9]+", "-", area.lower()).strip("-")
+    return slug or "area"
+
+
+class ShardRouter:
+    """
+    Maps areas and FoL-IDs to shard files, using the catalog in the main
+    database. FoL-ID lookups are primary-key probes against each shard file
+    and are cached for the lifetime of the router.
+    """
+
+    def __init__(self, main_db=MAIN_DB, shard_dir=SHARD_DIR, max_files=SHARD_FILES):
+        self.main_db = main_db
+        self.shard_dir = Path(shard_dir)
+        self.max_files = max_files
+        self._fol_id_cache = {}
+
+    def _connect_main(self):
+        ensure_migrated(self.main_db)
+        return sqlite3.connect(self.main_db)
+
+    def shards(self):
+        """[(area, path)] for all registered shards, in registration order."""
+        conn = self._connect_main()
+        try:
+            return conn.execute("SELECT area, path FROM shards ORDER BY created_at, area").fetchall()
+        finally:
+            conn.close()
+
+    def paths(self):
+        """Distinct existing shard files, in registration order."""
+        seen = []
+        for _, path in self.shards():
+            if path not in seen and Path(path).exists():
+                seen.append(path)
+        return seen
+
+    def path_for_area(self, area):
+        """Shard file of an area, or None if the area has no shard."""
+        conn = self._connect_main()
+        try:
+            row = conn.execute("SELECT path FROM shards WHERE area = ?", (area,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def register(self, area):
+        """Returns the shard file for area, creating and migrating it on first use."""
+        path = self.path_for_area(area)
+        if path is None:
+            self.shard_dir.mkdir(parents=True, exist_ok=True)
+            conn = self._connect_main()
+            conn.isolation_level = None
+            try:
+                # Picking the file and registering it is one step, so concurrent
+                # registrations cannot open more than max_files files
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT path FROM shards WHERE area = ?", (area,)).fetchone()
+                path = row[0] if row else self._path_for_new_area(conn, area)
+                if row is None:
+                    conn.execute("INSERT INTO shards (area, path) VALUES (?, ?)", (area, path))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.close()
+            logger.info(f"Registered shard {path} for area {area}")
+        ensure_migrated(path)
+        return path
+
+    def _path_for_new_area(self, conn, area):
+        """A file of its own while fewer than max_files exist, else the file holding the fewest areas."""
+        files = conn.execute("""
+            SELECT path, COUNT(*) FROM shards GROUP BY path ORDER BY COUNT(*), MIN(created_at), path
+        """).fetchall()
+        if len(files) >= self.max_files:
+            return files[0][0]
+        used = {path for path, _ in files}
+        path = str(self.shard_dir / f"{area_slug(area)}.db")
+        suffix = 1
+        while path in used:
+            suffix += 1
+            path = str(self.shard_dir / f"{area_slug(area)}-{suffix}.db")
+        return path
+
+    def archive_dir_for_area(self, area):
+        """Protocol archive directory of an area's shard."""
+        return self.shard_dir / area_slug(area) / "archive"
+
+    def path_for_fol_id(self, fol_id):
+        """
+        Database file that holds fol_id: a shard, or the main database for
+        rows that were never sharded. None if the property is unknown.
+        """
+        if fol_id in self._fol_id_cache:
+            return self._fol_id_cache[fol_id]
+        for _, path in self.shards():
+            if self._contains(path, fol_id):
+                self._fol_id_cache[fol_id] = path
+                return path
+        if self._contains(self.main_db, fol_id):
+            self._fol_id_cache[fol_id] = self.main_db
+            return self.main_db
+        return None
+
+    def area_for_fol_id(self, fol_id):
+        path = self.path_for_fol_id(fol_id)
+        areas = [area for area, shard_path in self.shards() if shard_path == path]
+        if len(areas) > 1:
+            # A shared file: the row knows its crawl area
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                row = conn.execute("SELECT area FROM property_data WHERE fol_id = ?", (fol_id,)).fetchone()
+            finally:
+                conn.close()
+            return row[0] if row else None
+        return areas[0] if areas else None
+
+    @staticmethod
+    def _contains(path, fol_id):
+        if not Path(path).exists():
+            return False
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            return conn.execute("SELECT 1 FROM property_data WHERE fol_id = ?", (fol_id,)).fetchone() is not None
+        except sqlite3.OperationalError:
+            return False
+        finally:
+            conn.close()
+
+
+def federated_connection(main_db=MAIN_DB):
+    """
+    Opens main_db with all shard files attached (as shard_0, shard_1, ...)
+    and TEMP views property_data / property_history spanning the main
+    database and every shard. Queries against those names see all areas; use
+    main.<table> to address the main database's own table.
+    """
+    ensure_migrated(main_db)
+    conn = sqlite3.connect(main_db)
+    shards = [row[0] for row in conn.execute("SELECT path FROM shards GROUP BY path ORDER BY MIN(created_at), path")]
+    shards = [path for path in shards if Path(path).exists()]
+
+    limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(conn, "getlimit") else MAX_ATTACHED
+    if len(shards) > limit:
+        conn.close()
+        raise RuntimeError(f"{len(shards)} shard files exceed SQLite's limit of {limit} attached databases; "
+                           f"merge them with `python shards.py consolidate`")
+
+    schemas = ["main"]
+    for i, path in enumerate(shards):
+        ensure_migrated(path)
+        conn.execute(f"ATTACH DATABASE ? AS shard_{i}", (path,))
+        schemas.append(f"shard_{i}")
+
+    for table in FEDERATED_TABLES:
+        columns = ", ".join(row[1] for row in conn.execute(f"PRAGMA main.table_info({table})"))
+        selects = [f"SELECT {columns} FROM {schema}.{table}" for schema in schemas]
+        conn.execute(f"CREATE TEMP VIEW {table} AS {' UNION ALL '.join(selects)}")
+    logger.debug(f"Federated {len(shards)} shard files into {main_db}")
+    return conn
+
+
+def _merge_shard_file(source, target):
+    """Copies the per-area tables of one shard file into another and links their owners there."""
+    ensure_migrated(source)
+    ensure_migrated(target)
+    conn = sqlite3.connect(target, isolation_level=None)
+    conn.execute("ATTACH DATABASE ? AS source", (source,))
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for table, conflict in MERGED_TABLES:
+            columns = [row[1] for row in conn.execute(f"PRAGMA source.table_info({table})")]
+            # Keep the target's own AUTOINCREMENT ids
+            column_list = ", ".join(column for column in columns if column != "id")
+            conn.execute(f"INSERT OR {conflict} INTO main.{table} ({column_list}) SELECT {column_list} FROM source.{table}")
+        # Owner ids are per file, so the moved properties are interned again
+        link_owners(conn, conn.execute("""
+            SELECT fol_id, owner_name, owner_email, owner_mobile, owner_landline,
+                   owner_email_norm, owner_mobile_norm, owner_landline_norm
+            FROM main.property_data WHERE fol_id IN (SELECT fol_id FROM source.property_data)
+        """).fetchall())
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.execute("DETACH DATABASE source")
+        conn.close()
+
+
+def consolidate_shards(main_db=MAIN_DB, shard_dir=SHARD_DIR, max_files=SHARD_FILES):
+    """
+    Merges the shard files beyond max_files (the newest) into the files
+    holding the fewest areas, so federated_connection() can attach them all,
+    and repoints their areas in the catalog. The merged files are left on
+    disk. A rerun after an interruption merges again without duplicating
+    rows. Returns {area: new path}.
+    """
+    router = ShardRouter(main_db, shard_dir, max_files)
+    paths = router.paths()
+    keep, surplus = paths[:max_files], paths[max_files:]
+    catalog = router.shards()
+    load = {path: sum(1 for _, area_path in catalog if area_path == path) for path in keep}
+    moved = {}
+    for source in surplus:
+        areas = [area for area, path in catalog if path == source]
+        target = min(keep, key=lambda path: load[path])
+        _merge_shard_file(source, target)
+        conn = sqlite3.connect(main_db)
+        try:
+            conn.execute("UPDATE shards SET path = ? WHERE path = ?", (target, source))
+            conn.commit()
+        finally:
+            conn.close()
+        load[target] += len(areas)
+        for area in areas:
+            moved[area] = target
+        logger.info(f"Merged {source} ({', '.join(areas)}) into {target}; {source} can be deleted")
+    return moved
+
+
+def split_main_database(main_db=MAIN_DB, shard_dir=SHARD_DIR):
+    """
+    Moves property_data and property_history rows from main_db into per-area
+    shards. A property's area is the area of the crawl run that first recorded
+    it; properties without history stay in the main database. Returns
+    {area: moved properties}.
+    """
+    router = ShardRouter(main_db, shard_dir)
+    conn = sqlite3.connect(main_db, isolation_level=None)
+    moved = {}
+    try:
+        areas = conn.execute("""
+            SELECT h.fol_id, r.area
+            FROM property_history h JOIN crawl_runs r ON r.run_id = h.run_id
+            WHERE h.version = 1 AND r.area IS NOT NULL
+        """).fetchall()
+        by_area = {}
+        for fol_id, area in areas:
+            by_area.setdefault(area, []).append(fol_id)
+
+        for area, fol_ids in by_area.items():
+            path = router.register(area)
+            conn.execute("ATTACH DATABASE ? AS shard", (path,))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("CREATE TEMP TABLE move_ids (fol_id TEXT PRIMARY KEY)")
+                conn.executemany("INSERT INTO move_ids VALUES (?)", [(fol_id,) for fol_id in fol_ids])
+                for table in FEDERATED_TABLES:
+                    columns = [row[1] for row in conn.execute(f"PRAGMA shard.table_info({table})")]
+                    if table == "property_history":
+                        # Keep the shard's own AUTOINCREMENT ids
+                        columns = [column for column in columns if column != "id"]
+                    column_list = ", ".join(columns)
+                    conn.execute(f"""
+                        INSERT OR REPLACE INTO shard.{table} ({column_list})
+                        SELECT {column_list} FROM main.{table} WHERE fol_id IN (SELECT fol_id FROM move_ids)
+                    """)
+                    conn.execute(f"DELETE FROM main.{table} WHERE fol_id IN (SELECT fol_id FROM move_ids)")
+                conn.execute("DROP TABLE move_ids")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.execute("DETACH DATABASE shard")
+            moved[area] = len(fol_ids)
+            logger.info(f"Moved {len(fol_ids)} properties of {area} to {path}")
+    finally:
+        conn.close()
+    return moved
+
+
+if __name__ == "__main__":
+    import argparse
+    from tabulate import tabulate
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description='Per-area shards of extraction.db')
+    parser.add_argument('--db-path', default=MAIN_DB, help='Path to the main SQLite database')
+    parser.add_argument('--shard-dir', default=str(SHARD_DIR), help='Directory holding the shard files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('list', help='List shards with their row counts')
+    route_parser = subparsers.add_parser('route', help='Show the shard of a FoL-ID or area')
+    route_parser.add_argument('key', help='FoL-ID or area name')
+    query_parser = subparsers.add_parser('query', help='Run an SQL query across the main database and all shards')
+    query_parser.add_argument('sql', help='SQL statement')
+    subparsers.add_parser('split', help='Move existing rows from the main database into per-area shards')
+    subparsers.add_parser('consolidate', help=f'Merge shard files down to EXTRACTION_SHARD_FILES ({SHARD_FILES})')
+
+    args = parser.parse_args()
+    router = ShardRouter(args.db_path, args.shard_dir)
+
+    if args.command == 'list':
+        rows = []
+        for area, path in router.shards():
+            conn = sqlite3.connect(path)
+            count = conn.execute("SELECT COUNT(*) FROM property_data WHERE area = ?", (area,)).fetchone()[0]
+            conn.close()
+            size = Path(path).stat().st_size if Path(path).exists() else 0
+            rows.append((area, path, count, f"{size / 2**20:.1f} MiB"))
+        print(tabulate(rows, headers=["area", "path", "properties", "size"], tablefmt="pretty"))
+    elif args.command == 'route':
+        path = router.path_for_area(args.key) or router.path_for_fol_id(args.key)
+        print(path or f"No shard found for {args.key}")
+    elif args.command == 'query':
+        conn = federated_connection(args.db_path)
+        cursor = conn.execute(args.sql)
+        headers = [column[0] for column in cursor.description or []]
+        print(tabulate(cursor.fetchall(), headers=headers, tablefmt="pretty"))
+        conn.close()
+    elif args.command == 'split':
+        moved = split_main_database(args.db_path, args.shard_dir)
+        logger.info(f"Moved {sum(moved.values())} properties into {len(moved)} shards")
+    elif args.command == 'consolidate':
+        moved = consolidate_shards(args.db_path, args.shard_dir)
+        logger.info(f"Moved {len(moved)} areas; {len(router.paths())} shard files remain")
@@ -5,14 +5,33 @@ sync_changes.py
 Synchronizes changes between the property_data table (Telekom data)
 and the buildings table (Airtable snapshot), pushing only the differences
 to Airtable.
+
+The comparison runs in SQLite (sync_diff.py); only differing fields come
+back to Python. `plan` stores them as a plan and renders the diff report
+from it, `apply` pushes a stored plan after checking it for drift (see
+sync_plan.py); the default command does both. After the first full sync, runs are incremental: only
+properties and buildings that changed since the last sync are compared
+(see sync_state.py). --full compares every record again.
 """
 import os
 import sqlite3
 import logging
 from datetime import datetime
-from pyairtable import Api
+import airtable_client
 from tabulate import tabulate
 from dotenv import load_dotenv
+from migrations import migrate
+from shards import federated_connection
+from property_history import changed_fol_ids_since_run
+from airtable_push import AIRTABLE_REQUESTS_PER_SECOND
+from sync_diff import FIELD_MAPPING, set_scope, iter_differences, count_matches
+from sync_plan import (PLANNED, APPLIED, FAILED, DRIFT, SUPERSEDED, create_plan, get_plan, find_drift,
+                       iter_plan_changes, plan_updates, plan_fol_ids, mark_records, record_applied, finish_plan)
+from sync_state import (load_watermarks, current_watermarks, save_watermarks, candidate_fol_ids,
+                        record_synced, mark_pending)
+from sync_create import create_missing
+from sync_outbox import (DEAD, enqueue, enqueued_fol_ids, cancel, cancel_superseded, drain, plan_results, retry_dead,
+                         status_counts)
 
 # Load environment variables
 load_dotenv()
@@ -30,336 +49,234 @@ logging.getLogger().addHandler(console)
 logger = logging.getLogger("airtable_sync")
 
 # Airtable configuration
-AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
-BASE_ID = os.getenv("AIRTABLE_BASE_ID")
+# The API key and base are read by airtable_client.py
 TABLE_NAME = os.getenv("AIRTABLE_TABLE_NAME")
 
-import re
-
-# Field mapping between property_data and buildings tables
-FIELD_MAPPING = {
-    'fol_id': 'extra_field_1',
-    'exploration': 'extra_field_3',  # Corrected from extra_field_4 to extra_field_3
-    'owner_name': 'first_name',
-    'owner_email': 'email',
-    'owner_mobile': 'phone_1',
-    'owner_landline': 'phone_2',
-    'au': 'homes', 
-    'bu': 'offices',
-    'nvt_area': 'nvt',
-    'calculated_box': 'extra_field_2'  # Special calculated field for box type
-}
-
-# Reverse mapping (Airtable field names to their API field names)
-AIRTABLE_FIELD_NAMES = {
-    'extra_field_1': 'Extra field 1',
-    'extra_field_2': 'Extra field 2',
-    'extra_field_3': 'Extra field 3',
-    'first_name': 'First name',
-    'email': 'Email',
-    'phone_1': 'Phone 1',
-    'phone_2': 'Phone 2',
-    'homes': 'HOMES',
-    'offices': 'OFFICES',
-    'nvt': 'NVT'
-}
-
-# Box type mapping based on the number of units (WE)
-BOX_TYPE_MAPPING = [
-    (1, "Box: G-AP OneBox XS (1WE), 10er Pack | Material Nr.:47122083"),
-    (3, "Box: GI-AP OneBox  1 - 3 WE | Material Nr.:47100635"),
-    (8, "Box: GI-AP OneBox  4 - 8 WE | Material Nr.:47100636"),
-    (12, "Box: GI-AP OneBox  9 -12 WE | Material Nr.:47100637"),
-    (20, "Box: GI-AP OneBox 13 - 20 WE | Material Nr.:47100638"),
-    (32, "Box: GI-AP OneBox 21 - 32 WE | Material Nr.:47100639"),
-    (float('inf'), None)  # For any value above 32
-]
-
-def extract_exploration_date(value):
+def prepare_scope(conn, full=False, changed_since_run=None):
     """
-    Extract just the date portion from a string like "Exploration done: 6/1/2024 01:01AM"
-    Returns the original value if no pattern match is found.
+    Restricts the comparison to what changed: properties with history after
+    changed_since_run, or records changed since the last completed sync
+    (temp.sync_scope). Returns False if every record is compared (first
+    sync or --full).
     """
-    if not value:
-        return value
-        
-    match = re.search(r"Exploration done:\s*(.*)", str(value))
-    if match:
-        return match.group(1).strip()
-    return value
+    if changed_since_run is not None:
+        fol_ids = changed_fol_ids_since_run(conn, changed_since_run)
+        logger.info(f"{len(fol_ids)} properties changed since run {changed_since_run}")
+    elif full:
+        return False
+    else:
+        watermarks = load_watermarks(conn)
+        if not watermarks:
+            logger.info("No previous sync recorded, comparing all records")
+            return False
+        fol_ids = candidate_fol_ids(conn, watermarks)
+        logger.info(f"{len(fol_ids)} records changed since the last sync "
+                    f"(properties since {watermarks.get('property_data')}, buildings since {watermarks.get('buildings')})")
+    set_scope(conn, fol_ids)
+    return True
 
-def get_box_type_for_units(total_units):
-    """
-    Determine the appropriate box type based on the total number of units (au + bu).
-    Returns the full box description string for the given number of units.
+def plan_changes(max_records=None, changed_since_run=None, full=False, db_path="extraction.db"):
     """
-    if total_units is None or total_units == 0:
-        return None
-        
-    # Convert to int to ensure proper comparison
-    try:
-        total_units = int(total_units)
-    except (ValueError, TypeError):
-        logger.warning(f"Invalid unit count for box type calculation: {total_units}")
-        return None
-    
-    # Find the appropriate box type based on the total units
-    for max_units, box_description in BOX_TYPE_MAPPING:
-        if total_units <= max_units:
-            return box_description
+    Compares property_data with the Airtable snapshot once and stores the
+    differences as a plan (see sync_plan.py); nothing is pushed. Planned and
+    deferred records stay pending in sync_state until the plan is applied.
+    Returns (plan_id, stats).
     
-    # Should never reach here due to the float('inf') entry, but just in case
-    return None
-
-def load_data_from_sqlite(db_path="extraction.db"):
-    """
-    Load data from both tables and return as dictionaries.
+    Args:
+        max_records: Maximum number of records to plan (for testing/debugging)
+        changed_since_run: Only consider properties changed after this crawl run
+        full: Compare every record, not only those changed since the last sync
     """
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row  # This allows accessing columns by name
+    # 1. Scope: the records that changed since the last sync (all of them on the first sync)
+    sync_run = datetime.now().isoformat(timespec='seconds')
+    conn = federated_connection(db_path)  # property_data spans all area shards
+    # Taken before comparing, so anything written during this sync is picked up by the next one
+    watermarks = current_watermarks(conn)
+    scoped = prepare_scope(conn, full, changed_since_run)
     
-    # Load property_data (Telekom data)
-    property_data = {}
-    cursor = conn.execute("SELECT * FROM property_data")
-    for row in cursor:
-        row_dict = dict(row)
-        fol_id = row_dict.get('fol_id')
-        if fol_id:
-            property_data[fol_id] = row_dict
+    properties, matched = count_matches(conn, scoped)
+    if properties > matched:
+        logger.warning(f"{properties - matched} properties have no matching Airtable record "
+                       f"(the create command or --create-missing creates them)")
+    mode = 'incremental' if scoped else 'full'
     
-    # Load buildings (Airtable snapshot)
-    buildings = {}
-    cursor = conn.execute("SELECT * FROM buildings")
-    for row in cursor:
-        row_dict = dict(row)
-        fol_id = row_dict.get('extra_field_1')
-        if fol_id:
-            buildings[fol_id] = row_dict
+    # 2. Compare in SQL; only records with differences come back and go into the plan
+    logger.info("Comparing records and preparing the plan...")
+    plan_id, deferred = create_plan(conn, iter_differences(conn, scoped), mode, matched, max_records)
+    cancelled = cancel_superseded(conn)
+    if cancelled:
+        logger.info(f"Cancelled {cancelled} unsent or dead outbox entries of superseded plans")
+    if deferred:
+        logger.info(f"Reached maximum number of records to update ({max_records}), {len(deferred)} deferred")
     
+    # 3. Remember what was compared; planned and deferred records stay pending until pushed
+    record_synced(conn, sync_run, scoped)
+    mark_pending(conn, plan_fol_ids(conn, plan_id) + deferred)
+    if changed_since_run is None:
+        save_watermarks(conn, watermarks)
+    conn.commit()
+    planned = get_plan(conn, plan_id)[4]
     conn.close()
     
-    logger.info(f"Loaded {len(property_data)} records from property_data")
-    logger.info(f"Loaded {len(buildings)} records from buildings")
-    
-    return property_data, buildings
+    logger.info(f"Plan {plan_id} ({mode}): {planned} of {matched} records to update, {len(deferred)} deferred")
+    return plan_id, {'plan_id': plan_id, 'mode': mode, 'matched': matched, 'updated': planned,
+                     'unchanged': matched - planned - len(deferred), 'deferred': len(deferred)}
 
-def compare_records(telekom_record, airtable_record):
-    """
-    Compare fields between Telekom and Airtable records, return differences.
+def apply_plan(plan_id=None, batch_size=10, concurrency=4, rate=AIRTABLE_REQUESTS_PER_SECOND, db_path="extraction.db"):
     """
-    differences = {}
-    
-    # Process normal fields first to collect numeric values for calculated fields
-    au_value = 0
-    bu_value = 0
-    
-    for telekom_field, airtable_field in FIELD_MAPPING.items():
-        # Skip the special calculated field for now
-        if telekom_field == 'calculated_box':
-            continue
-            
-        # Skip if the field doesn't exist in either record
-        if telekom_field not in telekom_record or airtable_field not in airtable_record:
-            continue
-        
-        telekom_value = telekom_record.get(telekom_field)
-        airtable_value = airtable_record.get(airtable_field)
-        
-        # Normalize None/NULL values for all fields
-        if telekom_value is None:
-            telekom_value = ""
-        if airtable_value is None:
-            airtable_value = ""
-            
-        # Skip empty → empty updates for all fields
-        if (not telekom_value and not airtable_value) and telekom_field != 'au' and telekom_field != 'bu':
-            continue
-        
-        # Store values for calculated fields (keep numeric handling)
-        if telekom_field == 'au':
-            try:
-                au_value = int(telekom_value) if telekom_value else 0
-            except (ValueError, TypeError):
-                au_value = 0
-                
-        if telekom_field == 'bu':
-            try:
-                bu_value = int(telekom_value) if telekom_value else 0
-            except (ValueError, TypeError):
-                bu_value = 0
-        
-        # Special case for numeric fields
-        if airtable_field in ['homes', 'offices']:
-            try:
-                if telekom_value:
-                    telekom_value = int(telekom_value)
-                else:
-                    telekom_value = 0
-                    
-                if airtable_value:
-                    airtable_value = int(airtable_value)
-                else:
-                    airtable_value = 0
-            except (ValueError, TypeError):
-                # If conversion fails, we'll just compare as strings
-                pass
-        
-        # Special handling for exploration date in extra_field_3
-        if airtable_field == 'extra_field_3':
-            airtable_value = extract_exploration_date(airtable_value)
-            # Prepare the formatted value for Airtable if we have a telekom value
-            if telekom_value:
-                telekom_value_for_airtable = f"Exploration done: {telekom_value}"
-            else:
-                telekom_value_for_airtable = None
-            
-        # For string type values, ensure comparison is done as strings 
-        # and ignore whitespace-only differences
-        if (isinstance(telekom_value, str) and isinstance(airtable_value, str) and 
-            telekom_value.strip() == airtable_value.strip()):
-            continue
-            
-        # Compare values - account for type differences (e.g., int vs str)
-        if str(telekom_value) != str(airtable_value):
-            # Map to Airtable API field names
-            airtable_api_field = AIRTABLE_FIELD_NAMES.get(airtable_field, airtable_field)
-            
-            # Handle special case for exploration date formatting
-            if airtable_field == 'extra_field_3':
-                if telekom_value:
-                    differences[airtable_api_field] = f"Exploration done: {telekom_value}"
-                else:
-                    # Only update if we're changing from a value to empty, not None to empty
-                    if airtable_value:
-                        differences[airtable_api_field] = None
-            else:
-                # Only update when there's a meaningful change
-                # Don't update empty string to None or vice versa
-                if not (not telekom_value and not airtable_value):
-                    differences[airtable_api_field] = telekom_value
-                
-            logger.debug(f"Field {airtable_field} differs: {airtable_value} -> {telekom_value}")
-    
-    # Now handle the calculated box type based on au + bu
-    total_units = au_value + bu_value
-    calculated_box = get_box_type_for_units(total_units)
-    
-    if calculated_box:
-        airtable_field = 'extra_field_2'
-        airtable_value = airtable_record.get(airtable_field)
-        
-        # Only update if different
-        if calculated_box != airtable_value:
-            airtable_api_field = AIRTABLE_FIELD_NAMES.get(airtable_field, airtable_field)
-            differences[airtable_api_field] = calculated_box
-            logger.debug(f"Calculated box type differs for {total_units} units: {airtable_value} -> {calculated_box}")
-    
-    return differences
-
-def sync_changes_to_airtable(batch_size=10, max_records=None):
-    """
-    Main function to sync changes from Telekom to Airtable.
+    Pushes a plan (default: the latest) to Airtable. Records whose base
+    values or property changed since the plan was made are not pushed
+    (drift). Returns stats.
     
     Args:
-        batch_size: Number of records to update in a single API call
-        max_records: Maximum number of records to update (for testing/debugging)
+        plan_id: Plan to apply
+        batch_size: Number of records to update in a single API call (at most 10)
+        concurrency: Number of batches in flight (see airtable_push.py)
+        rate: Requests per second to the base
     """
-    # 1. Load data from both tables
-    telekom_data, airtable_data = load_data_from_sqlite()
+    conn = federated_connection(db_path)
+    plan = get_plan(conn, plan_id)
+    if plan is None:
+        conn.close()
+        raise ValueError(f"No sync plan {plan_id}" if plan_id is not None else "No sync plan, run 'plan' first")
+    plan_id, status = plan[0], plan[6]
+    if status == SUPERSEDED:
+        conn.close()
+        raise ValueError(f"Plan {plan_id} has been superseded by a newer plan")
+    stats = {'plan_id': plan_id, 'mode': plan[2], 'matched': plan[3], 'updated': 0, 'unchanged': plan[3] - plan[4] - plan[5],
+             'drift': 0, 'errors': 0, 'batches': 0}
     
-    # 2. Initialize Airtable connection
-    api = Api(AIRTABLE_API_KEY)
-    table = api.table(BASE_ID, TABLE_NAME)
+    # 1. Records an interrupted apply already got confirmed (see sync_outbox.py)
+    mark_records(conn, plan_id, APPLIED, [(fol_id, None) for fol_id in plan_results(conn, plan_id)[0]])
     
-    # 3. Prepare for batching and statistics
-    updates_batch = []
-    stats = {'matched': 0, 'updated': 0, 'unchanged': 0, 'errors': 0, 'batches': 0}
+    # 2. Drift: the snapshot or the property changed since the plan was made
+    drift = find_drift(conn, plan_id)
+    for fol_id, reason in drift:
+        logger.warning(f"Not pushing FOL-ID {fol_id}: {reason} since plan {plan_id}")
+    mark_records(conn, plan_id, DRIFT, drift)
+    cancel(conn, plan_id, [fol_id for fol_id, _ in drift])
+    stats['drift'] = len(drift)
     
-    # 4. Create a lookup from FOL-ID to Airtable record ID
-    fol_to_record_id = {
-        fol_id: record.get('record_id') 
-        for fol_id, record in airtable_data.items() 
-        if record.get('record_id')
-    }
+    # 3. Write the plan's updates to the outbox first; records already in it are replayed, not added again
+    enqueued = enqueued_fol_ids(conn, plan_id)
+    stats['enqueued'] = enqueue(conn, [(fol_id, update) for fol_id, update in plan_updates(conn, plan_id)
+                                       if fol_id not in enqueued], plan_id)
+    conn.commit()
     
-    # 5. Process each Telekom record
-    logger.info("Comparing records and preparing updates...")
-    for fol_id, telekom_record in telekom_data.items():
-        # Find matching Airtable record
-        if fol_id not in airtable_data:
-            logger.warning(f"No matching Airtable record for FOL-ID: {fol_id}")
-            continue
-        
-        stats['matched'] += 1
-        airtable_record = airtable_data[fol_id]
-        record_id = fol_to_record_id.get(fol_id)
-        
-        if not record_id:
-            logger.warning(f"No Airtable record ID for FOL-ID: {fol_id}")
-            continue
-        
-        # Compare and find differences
-        differences = compare_records(telekom_record, airtable_record)
-        
-        # If differences exist, queue update
-        if differences:
-            updates_batch.append({
-                'id': record_id,
-                'fields': differences
-            })
-            stats['updated'] += 1
-            logger.info(f"Found changes for FOL-ID {fol_id}: {', '.join(differences.keys())}")
-            
-            # Check if we've reached the maximum number of records to update
-            if max_records is not None and stats['updated'] >= max_records:
-                logger.info(f"Reached maximum number of records to update ({max_records})")
-                break
-        else:
-            stats['unchanged'] += 1
-        
-        # Process updates in batches
-        if len(updates_batch) >= batch_size:
-            try:
-                if updates_batch:
-                    logger.info(f"Pushing batch of {len(updates_batch)} updates to Airtable...")
-                    table.batch_update(updates_batch)
-                    stats['batches'] += 1
-                    updates_batch = []
-            except Exception as e:
-                logger.error(f"Error updating batch: {str(e)}")
-                stats['errors'] += 1
+    # 4. Drain the outbox: several batches in flight, rate-limited, every confirmed batch acked at once
+    table = airtable_client.table(TABLE_NAME)
+    logger.info(f"Pushing the outbox to Airtable ({stats['enqueued']} new updates of plan {plan_id}, "
+                f"{concurrency} batches in flight)...")
+    stats['outbox'], push_stats = drain(table, db_path, batch_size=batch_size, concurrency=concurrency, rate=rate)
+    if push_stats is not None:
+        stats['batches'] = push_stats.batches
+        stats['push'] = push_stats.as_dict()
+        for update, error in push_stats.failed:
+            logger.error(f"Update of record {update['id']} failed: {error}")
     
-    # 6. Process any remaining updates
-    if updates_batch:
-        try:
-            logger.info(f"Pushing final batch of {len(updates_batch)} updates to Airtable...")
-            table.batch_update(updates_batch)
-            stats['batches'] += 1
-        except Exception as e:
-            logger.error(f"Error updating final batch: {str(e)}")
-            stats['errors'] += 1
+    # 5. Remember what Airtable confirmed; failed and drifted records stay pending
+    acked, failed = plan_results(conn, plan_id)
+    mark_records(conn, plan_id, APPLIED, [(fol_id, None) for fol_id in acked])
+    mark_records(conn, plan_id, FAILED, failed)
+    stats['updated'] = len(acked)
+    stats['errors'] = len(failed)
+    record_applied(conn, plan_id, datetime.now().isoformat(timespec='seconds'))
+    stats['records'] = finish_plan(conn, plan_id)
+    conn.commit()
+    conn.close()
     
-    # 7. Log summary
+    log_summary(stats)
+    return stats
+
+def sync_changes_to_airtable(batch_size=10, max_records=None, changed_since_run=None, concurrency=4,
+                             rate=AIRTABLE_REQUESTS_PER_SECOND, full=False, db_path="extraction.db"):
+    """
+    Main function to sync changes from Telekom to Airtable: plans and
+    immediately applies the plan (see plan_changes and apply_plan).
+    """
+    plan_id, plan_stats = plan_changes(max_records, changed_since_run, full, db_path)
+    stats = apply_plan(plan_id, batch_size, concurrency, rate, db_path)
+    stats['deferred'] = plan_stats['deferred']
+    return stats
+
+def create_missing_buildings(max_records=None, concurrency=4, rate=AIRTABLE_REQUESTS_PER_SECOND, dry_run=False,
+                             db_path="extraction.db"):
+    """
+    Creates the Airtable buildings of live properties that have none (see
+    sync_create.py) and records their ids locally. Returns stats.
+    """
+    conn = federated_connection(db_path)
+    try:
+        stats = create_missing(conn, db_path, TABLE_NAME, limit=max_records, concurrency=concurrency, rate=rate,
+                               dry_run=dry_run)
+    finally:
+        conn.close()
+    created = f"Would create {stats['to_create']}" if dry_run else f"Created {stats['created']}"
+    logger.info(f"{created} of {stats['missing']} missing buildings ({stats['unknown_area']} in areas unknown to Airtable, "
+                f"{stats['failed']} failed, {stats['unrecorded']} not recorded locally) in {stats['seconds']}s")
+    logger.info(airtable_client.report())
+    return stats
+
+def show_outbox(retry=False, db_path="extraction.db"):
+    """Prints the outbox entries per status and the dead ones; retry=True makes dead entries pending again."""
+    conn = sqlite3.connect(db_path)
+    if retry:
+        logger.info(f"{retry_dead(conn)} dead outbox entries are pending again")
+        conn.commit()
+    print(tabulate(sorted(status_counts(conn).items()), headers=["status", "entries"], tablefmt="pretty"))
+    dead = conn.execute("SELECT entry_id, record_id, fol_id, plan_id, attempts, last_error FROM airtable_outbox WHERE status = ?", (DEAD,)).fetchall()
+    if dead:
+        print(tabulate(dead, headers=["entry", "record_id", "fol_id", "plan", "attempts", "last error"], tablefmt="pretty"))
+    conn.close()
+
+def log_summary(stats):
     logger.info("\n" + "="*50)
-    logger.info("SYNC COMPLETED")
+    logger.info(f"SYNC COMPLETED (plan {stats['plan_id']}, {stats['mode']})")
     logger.info(f"Matched records: {stats['matched']}")
     logger.info(f"Updated records: {stats['updated']}")
     logger.info(f"Unchanged records: {stats['unchanged']}")
+    logger.info(f"Drifted since plan: {stats['drift']}")
     logger.info(f"Error count: {stats['errors']}")
     logger.info(f"Total batches: {stats['batches']}")
+    if 'outbox' in stats:
+        outbox = stats['outbox']
+        logger.info(f"Outbox: {outbox['entries']} entries sent ({outbox['coalesced']} coalesced), {outbox['acked']} acked, "
+                    f"{outbox['failed']} pending for the next run, {outbox['dead']} dead")
+    if 'push' in stats:
+        push = stats['push']
+        logger.info(f"Throughput: {push['records_per_second']} records/s, batch latency "
+                    f"p50 {push['latency_p50_ms']} ms, p95 {push['latency_p95_ms']} ms, {push['retries']} retries")
+    logger.info(airtable_client.report())
     logger.info("="*50)
-    
-    return stats
 
-def generate_diff_report(output_path="sync_diff_report.txt"):
+def load_tombstoned(db_path="extraction.db"):
+    """{fol_id: tombstoned_at} of properties gone from the portal that still have an Airtable record."""
+    conn = federated_connection(db_path)
+    try:
+        return dict(conn.execute("""
+            SELECT p.fol_id, p.tombstoned_at FROM property_data p
+            JOIN buildings b ON b.extra_field_1 = p.fol_id
+            WHERE p.tombstoned_at IS NOT NULL
+        """).fetchall())
+    finally:
+        conn.close()
+
+def generate_diff_report(output_path="sync_diff_report.txt", plan_id=None, db_path="extraction.db"):
     """
-    Generate a detailed report of all differences found between the two tables.
+    Generate a detailed report of a sync plan (default: the latest), with
+    the Airtable value and the planned value of every differing field.
     """
-    telekom_data, airtable_data = load_data_from_sqlite()
+    conn = federated_connection(db_path)
+    plan = get_plan(conn, plan_id)
+    if plan is None:
+        conn.close()
+        raise ValueError(f"No sync plan {plan_id}" if plan_id is not None else "No sync plan, run 'plan' first")
+    plan_id, created_at, mode, compared, records, deferred, status, applied_at = plan
     
     report_lines = [
         "="*80,
-        f"SYNC DIFF REPORT - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        f"SYNC DIFF REPORT - plan {plan_id} ({mode}, {status}) created {created_at}"
+        + (f", applied {applied_at}" if applied_at else ""),
         "="*80,
         ""
     ]
@@ -367,33 +284,20 @@ def generate_diff_report(output_path="sync_diff_report.txt"):
     total_diffs = 0
     field_diff_counts = {field: 0 for field in FIELD_MAPPING.values()}
     
-    for fol_id, telekom_record in telekom_data.items():
-        if fol_id in airtable_data:
-            airtable_record = airtable_data[fol_id]
-            differences = compare_records(telekom_record, airtable_record)
-            
-            if differences:
-                total_diffs += 1
-                report_lines.append(f"FOL-ID: {fol_id}")
-                report_lines.append("-"*40)
-                
-                for api_field, new_value in differences.items():
-                    # Map back to local field name
-                    for local_field, api_name in AIRTABLE_FIELD_NAMES.items():
-                        if api_name == api_field:
-                            airtable_field = local_field
-                            telekom_field = next((t for t, a in FIELD_MAPPING.items() if a == airtable_field), None)
-                            
-                            old_value = airtable_record.get(airtable_field)
-                            report_lines.append(f"  {airtable_field}: {old_value} -> {new_value}")
-                            field_diff_counts[airtable_field] += 1
-                            break
-                            
-                report_lines.append("")
+    for fol_id, record_id, record_status, changes in iter_plan_changes(conn, plan_id):
+        total_diffs += 1
+        report_lines.append(f"FOL-ID: {fol_id}" + (f" [{record_status}]" if record_status != PLANNED else ""))
+        report_lines.append("-"*40)
+        for airtable_field, old_value, new_value in changes:
+            report_lines.append(f"  {airtable_field}: {old_value} -> {new_value}")
+            field_diff_counts[airtable_field] += 1
+        report_lines.append("")
+    conn.close()
     
     # Add summary statistics
     report_lines.append("="*80)
-    report_lines.append(f"SUMMARY: {total_diffs} records with differences")
+    report_lines.append(f"SUMMARY: {total_diffs} records with differences of {compared} compared"
+                        + (f", {deferred} deferred to the next plan" if deferred else ""))
     report_lines.append("-"*40)
     report_lines.append("Field-level differences:")
     for field, count in sorted(field_diff_counts.items(), key=lambda x: x[1], reverse=True):
@@ -401,6 +305,15 @@ def generate_diff_report(output_path="sync_diff_report.txt"):
             report_lines.append(f"  {field}: {count}")
     report_lines.append("="*80)
     
+    # Properties no longer in the portal are not synced; list them for review in Airtable
+    tombstoned = load_tombstoned(db_path)
+    if tombstoned:
+        report_lines.append(f"GONE FROM PORTAL: {len(tombstoned)} Airtable records (not synced)")
+        report_lines.append("-"*40)
+        for fol_id, tombstoned_at in sorted(tombstoned.items()):
+            report_lines.append(f"  {fol_id}: gone since {tombstoned_at}")
+        report_lines.append("="*80)
+    
     # Write to file
     with open(output_path, 'w') as f:
         f.write('\n'.join(report_lines))
@@ -412,34 +325,51 @@ if __name__ == "__main__":
     import argparse
     
     parser = argparse.ArgumentParser(description='Sync changes from property_data to Airtable')
-    parser.add_argument('--report-only', action='store_true', help='Generate diff report without syncing')
-    parser.add_argument('--batch-size', type=int, default=10, help='Batch size for Airtable updates')
+    parser.add_argument('command', nargs='?', default='sync', choices=['sync', 'plan', 'apply', 'report', 'create', 'outbox'],
+                        help='sync: plan and apply (default); plan: compute and store a plan and its report; '
+                             'apply: push a stored plan; report: render the report of a stored plan; '
+                             'create: create Airtable buildings for properties that have none; '
+                             'outbox: show the outbox of unsent updates')
+    parser.add_argument('--plan-id', type=int, help='Plan to apply or report (default: the latest)')
+    parser.add_argument('--report-only', action='store_true', help='Same as the plan command')
+    parser.add_argument('--batch-size', type=int, default=10, help='Batch size for Airtable updates (at most 10)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of batches in flight')
+    parser.add_argument('--rate', type=float, default=AIRTABLE_REQUESTS_PER_SECOND, help='Requests per second to the base')
     parser.add_argument('--max-records', type=int, help='Maximum number of records to update (for testing/debugging)')
+    parser.add_argument('--changed-since-run', type=int, help='Only sync properties changed after this crawl run (see property_history.py runs)')
+    parser.add_argument('--full', action='store_true', help='Compare all records, not only those changed since the last sync')
+    parser.add_argument('--create-missing', action='store_true',
+                        help='With sync: also create Airtable buildings for properties that have none')
+    parser.add_argument('--dry-run', action='store_true', help='With create: only count the buildings to create')
+    parser.add_argument('--retry-dead', action='store_true', help='With outbox: make dead entries pending again (unless their record has a newer update)')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
     
     args = parser.parse_args()
+    command = 'plan' if args.report_only else args.command
     
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
     
     try:
-        if args.report_only:
-            logger.info("Generating diff report only (no syncing)...")
-            total_diffs = generate_diff_report()
-            logger.info(f"Found {total_diffs} records with differences. See report for details.")
-        else:
-            logger.info("Beginning sync process...")
-            generate_diff_report()  # Always generate a report for reference
-            
+        migrate()
+        plan_id = args.plan_id
+        if command in ('sync', 'plan'):
             if args.max_records:
                 logger.info(f"Limited to maximum {args.max_records} records for testing/debugging")
-                
-            stats = sync_changes_to_airtable(
-                batch_size=args.batch_size,
-                max_records=args.max_records
-            )
-            
+            plan_id, plan_stats = plan_changes(max_records=args.max_records, changed_since_run=args.changed_since_run,
+                                               full=args.full)
+        if command in ('sync', 'plan', 'report'):
+            total_diffs = generate_diff_report(plan_id=plan_id)  # Always generate a report for reference
+            logger.info(f"Found {total_diffs} records with differences. See report for details.")
+        if command in ('sync', 'apply'):
+            logger.info("Applying plan...")
+            stats = apply_plan(plan_id, batch_size=args.batch_size, concurrency=args.concurrency, rate=args.rate)
             logger.info(f"Sync completed. Updated {stats['updated']} records in {stats['batches']} batches.")
+        if command == 'outbox':
+            show_outbox(retry=args.retry_dead)
+        if command == 'create' or (command == 'sync' and args.create_missing):
+            create_missing_buildings(max_records=args.max_records, concurrency=args.concurrency, rate=args.rate,
+                                     dry_run=args.dry_run)
     except Exception as e:
         logger.error(f"Sync process failed with error: {str(e)}")
         raise
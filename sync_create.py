@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+sync_create.py
+
+Creates the Airtable buildings that are missing for Telekom properties.
+
+The Airtable sync only updates existing records; a property without a
+building in Airtable (no buildings row with its FoL-ID) used to be logged
+and skipped. create_missing() collects those properties in one anti-join
+(sync_diff.unmatched_sql()) and creates them with batch_create through the
+concurrent, rate-limited pipeline of airtable_push.py, with typecast on:
+
+    Name            street, house number and appendix
+    Type            Building
+    Area            link to the Areas record of the property's crawl area
+    Extra field 1   "FoL-ID: <fol_id>"
+    ...             every mapped field that has a value (sync_diff)
+
+Properties whose crawl area has no Areas record are skipped and counted.
+Every created batch is written back right away: the records Airtable
+returns go into buildings (as a snapshot refresh would store them) and the
+FoL-ID -> record id mapping into airtable_sync, so the next sync matches
+them by primary key and idx_buildings_extra_field_1 instead of creating
+them again.
+
+A batch whose request timed out may have been created anyway; the retry
+then creates it twice. The next full snapshot refresh shows such
+duplicates (two buildings with one FoL-ID).
+
+A failed write-back (the database locked by a crawler, say) must not reach
+the push pipeline's retry, which would create the batch again. send()
+keeps such batches and writes them once more after the push; what still
+fails is logged as FoL-ID -> record id, so the mapping is not lost.
+"""
+import time
+import sqlite3
+import logging
+import threading
+
+import airtable_client
+from airtable_push import push_updates_sync, AIRTABLE_REQUESTS_PER_SECOND
+from airtable_snapshot import BUILDING_UPSERT_SQL, building_row
+from sync_diff import iter_unmatched, airtable_fields
+
+logger = logging.getLogger("sync_create")
+
+BUILDING_TYPE = "Building"
+
+AIRTABLE_SYNC_UPSERT_SQL = """
+    INSERT INTO airtable_sync (fol_id, airtable_record_id, area, building)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(fol_id) DO UPDATE SET
+        airtable_record_id=excluded.airtable_record_id,
+        area=excluded.area,
+        building=excluded.building,
+        last_updated=CURRENT_TIMESTAMP
+"""
+
+
+def new_building(fol_id, area_record_id, name, changes):
+    """Airtable fields of a new building for an unmatched property (iter_unmatched())."""
+    fields = airtable_fields(changes)
+    fields.update({
+        "Name": name or f"FoL-ID {fol_id}",
+        "Type": BUILDING_TYPE,
+        "Area": [area_record_id],
+        "Extra field 1": f"FoL-ID: {fol_id}",
+    })
+    return fields
+
+
+def collect_missing(conn, limit=None):
+    """
+    ([{'id': fol_id, 'fields': {...}, 'area': area name}] to create,
+    {area name: skipped properties} for areas unknown in Airtable).
+    """
+    creates = []
+    unknown_areas = {}
+    area_record_ids = {}
+    for fol_id, area, name, changes in iter_unmatched(conn):
+        if limit is not None and len(creates) >= limit:
+            break
+        if area not in area_record_ids:
+            area_record_ids[area] = airtable_client.area_record_id(area) if area else None
+        area_record_id = area_record_ids[area]
+        if not area_record_id:
+            unknown_areas[area] = unknown_areas.get(area, 0) + 1
+            continue
+        creates.append({'id': fol_id, 'fields': new_building(fol_id, area_record_id, name, changes), 'area': area})
+    return creates, unknown_areas
+
+
+def create_missing(conn, db_path="extraction.db", table_name=None, limit=None, concurrency=4,
+                   rate=AIRTABLE_REQUESTS_PER_SECOND, dry_run=False):
+    """
+    Creates Airtable buildings for the live properties on conn (a federated
+    connection) that have none, at most `limit`, and records the new record
+    ids in db_path's buildings and airtable_sync tables. Returns stats.
+    """
+    started = time.perf_counter()
+    creates, unknown_areas = collect_missing(conn, limit)
+    for area, count in unknown_areas.items():
+        logger.warning(f"{count} properties without an Airtable record in area {area!r}, which is not in Airtable; not created")
+    stats = {'missing': len(creates) + sum(unknown_areas.values()), 'to_create': len(creates), 'created': 0,
+             'failed': 0, 'unrecorded': 0, 'unknown_area': sum(unknown_areas.values())}
+    if dry_run or not creates:
+        stats['seconds'] = round(time.perf_counter() - started, 2)
+        return stats
+
+    table = airtable_client.table(table_name)
+    write_conn = sqlite3.connect(db_path, check_same_thread=False)
+    write_conn.execute("PRAGMA busy_timeout = 10000")
+    write_lock = threading.Lock()
+    unwritten = []  # (rows, links) of created batches whose write-back failed
+
+    def write_back(rows, links):
+        with write_lock:
+            try:
+                write_conn.executemany(BUILDING_UPSERT_SQL, rows)
+                write_conn.executemany(AIRTABLE_SYNC_UPSERT_SQL, links)
+                write_conn.commit()
+            except sqlite3.Error:
+                write_conn.rollback()
+                raise
+
+    def send(batch):
+        records = table.batch_create([update['fields'] for update in batch], typecast=True)
+        # Written back per batch, so an interrupted run does not create these again
+        rows = [row for row in (building_row(record, update['fields']['Area'][0])
+                                for update, record in zip(batch, records)) if row is not None]
+        links = [(update['id'], record['id'], update['area'], update['fields']['Name'])
+                 for update, record in zip(batch, records)]
+        try:
+            write_back(rows, links)
+        except sqlite3.Error as e:
+            # Created in Airtable: only API errors may reach the push retry
+            logger.warning(f"Could not record {len(links)} created buildings yet: {e}")
+            with write_lock:
+                unwritten.append((rows, links))
+        logger.debug(f"Created {len(records)} buildings")
+
+    try:
+        logger.info(f"Creating {len(creates)} missing buildings in Airtable ({concurrency} batches in flight)...")
+        push_stats = push_updates_sync(table, creates, concurrency=concurrency, rate=rate, send=send)
+        for rows, links in unwritten:
+            try:
+                write_back(rows, links)
+            except sqlite3.Error as e:
+                stats['unrecorded'] += len(links)
+                for fol_id, record_id, _, _ in links:
+                    logger.error(f"Created building {record_id} for FoL-ID {fol_id} could not be recorded ({e}); "
+                                 f"a snapshot refresh picks it up")
+    finally:
+        write_conn.close()
+    for update, error in push_stats.failed:
+        logger.error(f"Creating the building of FOL-ID {update['id']} failed: {error}")
+    stats['created'] = push_stats.records
+    stats['failed'] = len(push_stats.failed)
+    stats['push'] = push_stats.as_dict()
+    stats['seconds'] = round(time.perf_counter() - started, 2)
+    return stats
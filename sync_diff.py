@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+sync_diff.py
+
+Differences between property_data (Telekom data) and buildings (Airtable
+snapshot), computed in SQLite.
+
+The field mapping and its normalization rules are turned into one query
+joining property_data to buildings on the FoL-ID (the property_data
+primary key and idx_buildings_extra_field_1). Only records with at least
+one differing field come back to Python, so a sync or diff report over a
+million properties costs one indexed join plus the changed rows.
+
+The rules, per Airtable column:
+
+    text fields           NULL and '' are equal; values are compared
+                          as text, ignoring leading/trailing whitespace
+    homes / offices       au_count / bu_count (NULL = 0) against the
+                          number in Airtable (NULL or '' = 0)
+    extra_field_3         equal if both exploration_at timestamps match;
+                          otherwise exploration against the date of the
+                          "Exploration done: ..." value (exploration_date);
+                          pushed as "Exploration done: <date>", or cleared
+    extra_field_2         OneBox type for au_count + bu_count (see
+                          planning.BOX_TYPE_MAPPING); nothing is pushed
+                          for 0 units or more than 32
+
+unmatched_sql() gives the same values for properties that have no Airtable
+record yet, for creating them (see sync_create.py).
+
+With a scope (scoped=True) only the FoL-IDs in temp.sync_scope are
+compared; see set_scope().
+"""
+import logging
+
+from planning import BOX_TYPE_MAPPING
+
+logger = logging.getLogger("sync_diff")
+
+# Field mapping between property_data and buildings tables
+FIELD_MAPPING = {
+    'fol_id': 'extra_field_1',
+    'exploration': 'extra_field_3',  # Corrected from extra_field_4 to extra_field_3
+    'owner_name': 'first_name',
+    'owner_email': 'email',
+    'owner_mobile': 'phone_1',
+    'owner_landline': 'phone_2',
+    'au': 'homes',
+    'bu': 'offices',
+    'nvt_area': 'nvt',
+    'calculated_box': 'extra_field_2'  # Special calculated field for box type
+}
+
+# Reverse mapping (Airtable field names to their API field names)
+AIRTABLE_FIELD_NAMES = {
+    'extra_field_1': 'Extra field 1',
+    'extra_field_2': 'Extra field 2',
+    'extra_field_3': 'Extra field 3',
+    'first_name': 'First name',
+    'email': 'Email',
+    'phone_1': 'Phone 1',
+    'phone_2': 'Phone 2',
+    'homes': 'HOMES',
+    'offices': 'OFFICES',
+    'nvt': 'NVT'
+}
+
+# buildings columns the comparison reads (digested in sync_state)
+SNAPSHOT_FIELDS = list(FIELD_MAPPING.values()) + ['exploration_date', 'exploration_at']
+
+# The join key; equal by definition
+JOIN_FIELD = 'extra_field_1'
+
+# Python's str.strip() for the whitespace that occurs in portal and Airtable values
+WHITESPACE = "' ' || char(9, 10, 11, 12, 13)"
+
+EXPLORATION_PREFIX = "Exploration done: "
+
+
+def _quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _stripped(expression):
+    return f"TRIM(CAST({expression} AS TEXT), {WHITESPACE})"
+
+
+def _box_sql():
+    """get_box_type_for_units() of p.au_count + p.bu_count; NULL where it returns None."""
+    units = "(COALESCE(p.au_count, 0) + COALESCE(p.bu_count, 0))"
+    whens = " ".join(f"WHEN {units} <= {max_units} THEN {_quote(description)}"
+                     for max_units, description in BOX_TYPE_MAPPING if description)
+    return f"CASE WHEN {units} = 0 THEN NULL {whens} END"
+
+
+def field_sql(telekom_field, airtable_field):
+    """(changed, new value) SQL expressions for one mapped field, over property_data p and buildings b."""
+    if airtable_field == 'extra_field_2':
+        box = _box_sql()
+        return f"({box}) IS NOT NULL AND ({box}) IS NOT b.extra_field_2", box
+    if airtable_field in ('homes', 'offices'):
+        new = f"COALESCE(p.{telekom_field}_count, 0)"
+        return f"CAST({new} AS TEXT) <> CAST(COALESCE(NULLIF(b.{airtable_field}, ''), 0) AS TEXT)", new
+    telekom_value = f"COALESCE(p.{telekom_field}, '')"
+    if airtable_field == 'extra_field_3':
+        airtable_date = "COALESCE(b.exploration_date, '')"
+        changed = (f"NOT (COALESCE(p.exploration_at, '') <> '' AND p.exploration_at IS b.exploration_at)"
+                   f" AND NOT ({telekom_value} = '' AND COALESCE(b.extra_field_3, '') = '')"
+                   f" AND {_stripped(telekom_value)} <> {_stripped(airtable_date)}")
+        return changed, f"CASE WHEN {telekom_value} <> '' THEN {_quote(EXPLORATION_PREFIX)} || {telekom_value} END"
+    airtable_value = f"COALESCE(b.{airtable_field}, '')"
+    return f"{_stripped(telekom_value)} <> {_stripped(airtable_value)}", telekom_value
+
+
+# Compared (telekom field, airtable field) pairs, in push order
+COMPARED_FIELDS = [(telekom_field, airtable_field) for telekom_field, airtable_field in FIELD_MAPPING.items()
+                   if airtable_field != JOIN_FIELD]
+
+
+def source_sql(scoped=False):
+    """FROM/WHERE of the live properties joined to their Airtable record (aliases p and b)."""
+    scope = " AND p.fol_id IN (SELECT fol_id FROM temp.sync_scope)" if scoped else ""
+    return f"""
+        FROM property_data p
+        JOIN buildings b ON b.extra_field_1 = p.fol_id
+        WHERE p.tombstoned_at IS NULL{scope}
+    """
+
+
+def diff_sql(scoped=False):
+    columns = []
+    conditions = []
+    for telekom_field, airtable_field in COMPARED_FIELDS:
+        changed, new = field_sql(telekom_field, airtable_field)
+        columns.append(f"({changed}), {new}, b.{airtable_field}")
+        conditions.append(f"({changed})")
+    return f"""
+        SELECT p.fol_id, b.record_id, COALESCE(p.data_hash, ''), {', '.join(columns)}
+        {source_sql(scoped)}
+          AND ({' OR '.join(conditions)})
+    """
+
+
+def set_scope(conn, fol_ids):
+    """Restricts scoped queries to the given FoL-IDs (temp.sync_scope)."""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS sync_scope (fol_id TEXT PRIMARY KEY) WITHOUT ROWID")
+    conn.execute("DELETE FROM temp.sync_scope")
+    conn.executemany("INSERT OR IGNORE INTO temp.sync_scope (fol_id) VALUES (?)", ((fol_id,) for fol_id in fol_ids))
+
+
+def iter_differences(conn, scoped=False):
+    """
+    Yields (fol_id, record_id, data_hash, changes) for every property whose
+    Airtable record differs, with changes a list of (airtable field,
+    Airtable value, new value).
+    """
+    for row in conn.execute(diff_sql(scoped)):
+        changes = []
+        for i, (_, airtable_field) in enumerate(COMPARED_FIELDS):
+            changed, new, old = row[3 + 3 * i:6 + 3 * i]
+            if changed:
+                changes.append((airtable_field, old, new))
+        yield row[0], row[1], row[2], changes
+
+
+def count_matches(conn, scoped=False):
+    """(live properties, properties with an Airtable record) in scope."""
+    scope = " AND p.fol_id IN (SELECT fol_id FROM temp.sync_scope)" if scoped else ""
+    return conn.execute(f"""
+        SELECT COUNT(*), COUNT(b.record_id) FROM property_data p
+        LEFT JOIN buildings b ON b.extra_field_1 = p.fol_id
+        WHERE p.tombstoned_at IS NULL{scope}
+    """).fetchone()
+
+
+def unmatched_sql():
+    """Live properties without an Airtable record: FoL-ID, crawl area, building name and the value of every compared field."""
+    name = "TRIM(COALESCE(p.street, '') || ' ' || COALESCE(p.house_number, '') || COALESCE(p.house_appendix, ''))"
+    values = ", ".join(field_sql(telekom_field, airtable_field)[1] for telekom_field, airtable_field in COMPARED_FIELDS)
+    return f"""
+        SELECT p.fol_id, p.area, {name}, {values}
+        FROM property_data p
+        WHERE p.tombstoned_at IS NULL
+          AND NOT EXISTS (SELECT 1 FROM buildings b WHERE b.extra_field_1 = p.fol_id)
+        ORDER BY p.fol_id
+    """
+
+
+def iter_unmatched(conn):
+    """
+    Yields (fol_id, area, building name, changes) for every live property
+    without an Airtable record, with changes as in iter_differences() (no
+    Airtable value) for the fields that have a value.
+    """
+    for row in conn.execute(unmatched_sql()):
+        changes = [(airtable_field, None, new) for (_, airtable_field), new in zip(COMPARED_FIELDS, row[3:])
+                   if new not in (None, '')]
+        yield row[0], row[1], row[2], changes
+
+
+def airtable_fields(changes):
+    """{Airtable API field name: new value} for a change list of iter_differences()."""
+    return {AIRTABLE_FIELD_NAMES.get(field, field): new for field, _, new in changes}
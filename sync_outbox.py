@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+sync_outbox.py
+
+Durable outbox for Airtable updates.
+
+Every Airtable update is written to airtable_outbox (migration 18) and
+committed before it is sent:
+
+    airtable_outbox(entry_id, record_id, fol_id, plan_id, fields, status,
+                    attempts, last_error, created_at, acked_at)
+
+fields is the JSON {Airtable field: value} of the update. drain() sends
+the pending entries through airtable_push.py and marks them acked batch by
+batch, as soon as Airtable has confirmed the batch. A push that fails
+midway, or a process that is killed, loses nothing: the entries that were
+not confirmed are still pending and the next drain replays exactly those.
+Updates set absolute field values, so replaying an entry whose request did
+reach Airtable is harmless.
+
+Pending entries for the same Airtable record are coalesced into one update
+(later entries win field by field) and acked together. An entry that keeps
+failing (a 422 for an invalid value, for example) is parked as dead after
+MAX_ATTEMPTS drains; retry_dead() makes dead entries pending again, unless
+a newer entry for their record is acked or pending (replaying the old
+fields would overwrite the newer ones).
+
+Entries without a plan_id come from the streaming sync (sync_stream.py);
+apply drains them together with the plan's.
+
+Status moves from pending to acked, dead or cancelled. Pending and dead
+entries of a superseded sync plan are cancelled, because the newer plan recomputes
+their records (see cancel_superseded()). Acked and cancelled entries are
+pruned after KEEP_DAYS.
+"""
+import json
+import sqlite3
+import logging
+import threading
+
+from airtable_push import push_updates_sync, AIRTABLE_REQUESTS_PER_SECOND
+
+logger = logging.getLogger("sync_outbox")
+
+PENDING, ACKED, DEAD, CANCELLED = "pending", "acked", "dead", "cancelled"
+MAX_ATTEMPTS = 5
+KEEP_DAYS = 7
+
+
+def enqueue(conn, updates, plan_id=None):
+    """Adds [(fol_id, {'id': record_id, 'fields': {...}})] updates as pending entries (not committed)."""
+    conn.executemany("INSERT INTO airtable_outbox (record_id, fol_id, plan_id, fields) VALUES (?, ?, ?, ?)",
+                     ((update['id'], fol_id, plan_id, json.dumps(update['fields'])) for fol_id, update in updates))
+    return len(updates)
+
+
+def enqueued_fol_ids(conn, plan_id):
+    """FoL-IDs of the plan that are already in the outbox."""
+    return {row[0] for row in conn.execute("SELECT fol_id FROM airtable_outbox WHERE plan_id = ?", (plan_id,))}
+
+
+def cancel(conn, plan_id, fol_ids):
+    """Cancels the pending entries of the given FoL-IDs of a plan (drifted records)."""
+    conn.executemany(f"UPDATE airtable_outbox SET status = '{CANCELLED}' WHERE plan_id = ? AND fol_id = ? AND status = '{PENDING}'",
+                     ((plan_id, fol_id) for fol_id in fol_ids))
+
+
+def cancel_superseded(conn):
+    """Cancels the pending and dead entries of superseded plans; their records are pending in sync_state and planned again."""
+    return conn.execute(f"""
+        UPDATE airtable_outbox SET status = '{CANCELLED}'
+        WHERE status IN ('{PENDING}', '{DEAD}') AND plan_id IN (SELECT plan_id FROM sync_plans WHERE status = 'superseded')
+    """).rowcount
+
+
+def pending_updates(conn, streamed_only=False):
+    """
+    [(entry_ids, {'id': record_id, 'fields': {...}})]: the pending entries
+    (only those without a plan with streamed_only), coalesced per record in
+    entry order.
+    """
+    coalesced = []
+    streamed = " AND plan_id IS NULL" if streamed_only else ""
+    for entry_id, record_id, fields in conn.execute(f"""
+        SELECT entry_id, record_id, fields FROM airtable_outbox
+        WHERE status = '{PENDING}'{streamed} ORDER BY record_id, entry_id
+    """):
+        if not coalesced or coalesced[-1][1]['id'] != record_id:
+            coalesced.append(([], {'id': record_id, 'fields': {}}))
+        coalesced[-1][0].append(entry_id)
+        coalesced[-1][1]['fields'].update(json.loads(fields))
+    return coalesced
+
+
+def drain(table, db_path="extraction.db", batch_size=10, concurrency=4, rate=AIRTABLE_REQUESTS_PER_SECOND,
+          streamed_only=False):
+    """
+    Pushes the pending outbox entries of db_path to an Airtable table,
+    acking every confirmed batch right away. streamed_only leaves the
+    entries of sync plans alone (see sync_stream.py). Returns (stats,
+    PushStats or None if nothing was pending).
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout = 10000")
+    lock = threading.Lock()
+    try:
+        pending = pending_updates(conn, streamed_only)
+        entries = sum(len(entry_ids) for entry_ids, _ in pending)
+        stats = {'entries': entries, 'coalesced': entries - len(pending), 'acked': 0, 'failed': 0, 'dead': 0}
+        if not pending:
+            return stats, None
+        entry_ids = {update['id']: ids for ids, update in pending}
+        updates = [update for _, update in pending]
+
+        def send(batch):
+            table.batch_update(batch)
+            acked = [(entry_id,) for update in batch for entry_id in entry_ids[update['id']]]
+            with lock:
+                conn.executemany(f"""
+                    UPDATE airtable_outbox SET status = '{ACKED}', attempts = attempts + 1, acked_at = CURRENT_TIMESTAMP
+                    WHERE entry_id = ?
+                """, acked)
+                conn.commit()
+                stats['acked'] += len(acked)
+
+        if stats['coalesced']:
+            logger.info(f"Coalesced {entries} outbox entries into {len(updates)} updates")
+        push_stats = push_updates_sync(table, updates, batch_size=batch_size, concurrency=concurrency, rate=rate,
+                                       send=send)
+        failed = [(str(error), entry_id) for update, error in push_stats.failed for entry_id in entry_ids[update['id']]]
+        conn.executemany(f"""
+            UPDATE airtable_outbox SET attempts = attempts + 1, last_error = ?,
+                status = CASE WHEN attempts + 1 >= {MAX_ATTEMPTS} THEN '{DEAD}' ELSE status END
+            WHERE entry_id = ?
+        """, failed)
+        stats['failed'] = len(failed)
+        stats['dead'] = conn.execute(f"SELECT COUNT(*) FROM airtable_outbox WHERE status = '{DEAD}'").fetchone()[0]
+        prune(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    if stats['dead']:
+        logger.warning(f"{stats['dead']} outbox entries failed {MAX_ATTEMPTS} times and are parked as dead "
+                       f"(see sync_changes.py outbox --retry-dead)")
+    return stats, push_stats
+
+
+def plan_results(conn, plan_id):
+    """(acked FoL-IDs, [(fol_id, last error)] still pending or dead) of a plan's outbox entries."""
+    acked = set()
+    failed = {}
+    for fol_id, status, error in conn.execute("SELECT fol_id, status, last_error FROM airtable_outbox WHERE plan_id = ?",
+                                              (plan_id,)):
+        if status == ACKED:
+            acked.add(fol_id)
+        elif status in (PENDING, DEAD):
+            failed[fol_id] = error or "not confirmed"
+    return acked - set(failed), list(failed.items())
+
+
+def retry_dead(conn):
+    """Makes dead entries pending again, except those whose record has a newer acked or pending entry."""
+    return conn.execute(f"""
+        UPDATE airtable_outbox SET status = '{PENDING}', attempts = 0
+        WHERE status = '{DEAD}' AND NOT EXISTS (
+            SELECT 1 FROM airtable_outbox newer
+            WHERE newer.record_id = airtable_outbox.record_id AND newer.entry_id > airtable_outbox.entry_id
+              AND newer.status IN ('{ACKED}', '{PENDING}'))
+    """).rowcount
+
+
+def status_counts(conn):
+    return dict(conn.execute("SELECT status, COUNT(*) FROM airtable_outbox GROUP BY status").fetchall())
+
+
+def prune(conn, keep_days=KEEP_DAYS):
+    conn.execute(f"""
+        DELETE FROM airtable_outbox
+        WHERE status IN ('{ACKED}', '{CANCELLED}') AND created_at < datetime('now', ?)
+    """, (f"-{keep_days} days",))
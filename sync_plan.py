@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+sync_plan.py
+
+Persisted Airtable sync plans.
+
+`sync_changes.py plan` compares property_data with the buildings snapshot
+once and stores the result as a plan (migration 16):
+
+    sync_plans(plan_id, created_at, mode, compared, records, deferred,
+               status, applied_at)
+    sync_plan_records(plan_id, fol_id, record_id, data_hash, status, error)
+    sync_plan_changes(plan_id, fol_id, field, base_value, new_value)
+
+base_value is the buildings value the change was computed against and
+data_hash the property's hash at that time. `sync_changes.py apply` pushes
+exactly these changes, through the outbox (sync_outbox.py), so an
+interrupted apply resumes with the unconfirmed ones. Before pushing, it
+checks every record for drift:
+
+- the Airtable record's base value of a planned field changed in the
+  snapshot (refresh it with airtable_connector.py to see edits made in
+  Airtable since the plan),
+- the property changed (data_hash) or is gone from the portal, or
+- the Airtable record no longer exists in the snapshot.
+
+Drifted records are not pushed and stay pending in sync_state, so the next
+plan picks them up with current values. Record status moves from planned
+to applied, failed or drift; applying a plan again replays its unconfirmed
+outbox entries. Creating a plan supersedes older ones, which can no longer be
+applied; only the last KEEP_PLANS plans are kept.
+
+The diff report is rendered from the plan (see generate_diff_report).
+"""
+import logging
+
+from sync_diff import COMPARED_FIELDS, airtable_fields
+
+logger = logging.getLogger("sync_plan")
+
+KEEP_PLANS = 10
+
+PLANNED, APPLIED, FAILED, DRIFT = "planned", "applied", "failed", "drift"
+PARTIAL, SUPERSEDED = "partial", "superseded"
+
+
+def create_plan(conn, differences, mode, compared, max_records=None):
+    """
+    Stores the differences (sync_diff.iter_differences()) as a new plan,
+    at most max_records records. Returns (plan_id, deferred FoL-IDs).
+    """
+    conn.execute(f"UPDATE sync_plans SET status = '{SUPERSEDED}' WHERE status IN ('{PLANNED}', '{PARTIAL}')")
+    plan_id = conn.execute("INSERT INTO sync_plans (mode, compared) VALUES (?, ?)", (mode, compared)).lastrowid
+    records = []
+    changes = []
+    deferred = []
+    for fol_id, record_id, data_hash, record_changes in differences:
+        if max_records is not None and len(records) >= max_records:
+            deferred.append(fol_id)
+            continue
+        records.append((plan_id, fol_id, record_id, data_hash))
+        changes.extend((plan_id, fol_id, field, base, new) for field, base, new in record_changes)
+    conn.executemany("INSERT OR REPLACE INTO sync_plan_records (plan_id, fol_id, record_id, data_hash) VALUES (?, ?, ?, ?)",
+                     records)
+    conn.executemany("INSERT OR REPLACE INTO sync_plan_changes (plan_id, fol_id, field, base_value, new_value) VALUES (?, ?, ?, ?, ?)",
+                     changes)
+    conn.execute("UPDATE sync_plans SET records = ?, deferred = ? WHERE plan_id = ?", (len(records), len(deferred), plan_id))
+    prune_plans(conn)
+    return plan_id, deferred
+
+
+def prune_plans(conn, keep=KEEP_PLANS):
+    old = [row[0] for row in conn.execute("SELECT plan_id FROM sync_plans ORDER BY plan_id DESC LIMIT -1 OFFSET ?", (keep,))]
+    for table in ("sync_plan_changes", "sync_plan_records", "sync_plans"):
+        conn.executemany(f"DELETE FROM {table} WHERE plan_id = ?", ((plan_id,) for plan_id in old))
+
+
+def get_plan(conn, plan_id=None):
+    """(plan_id, created_at, mode, compared, records, deferred, status, applied_at) of a plan (default: the latest), or None."""
+    if plan_id is None:
+        return conn.execute("SELECT * FROM sync_plans ORDER BY plan_id DESC LIMIT 1").fetchone()
+    return conn.execute("SELECT * FROM sync_plans WHERE plan_id = ?", (plan_id,)).fetchone()
+
+
+def _base_column_sql():
+    """The snapshot's current value of sync_plan_changes.field for buildings row b."""
+    whens = " ".join(f"WHEN '{field}' THEN b.{field}" for _, field in COMPARED_FIELDS)
+    return f"CASE c.field {whens} END"
+
+
+def find_drift(conn, plan_id):
+    """
+    [(fol_id, reason)] for the plan's unapplied records whose base values or
+    property changed since the plan was made.
+    """
+    return conn.execute(f"""
+        SELECT r.fol_id,
+               CASE
+                   WHEN NOT EXISTS (SELECT 1 FROM buildings b WHERE b.record_id = r.record_id) THEN 'record gone'
+                   WHEN (SELECT tombstoned_at FROM property_data p WHERE p.fol_id = r.fol_id) IS NOT NULL THEN 'gone from portal'
+                   WHEN (SELECT COALESCE(data_hash, '') FROM property_data p WHERE p.fol_id = r.fol_id) IS NOT r.data_hash
+                       THEN 'property changed'
+                   ELSE 'Airtable value changed: ' || (
+                       SELECT GROUP_CONCAT(c.field, ', ') FROM sync_plan_changes c JOIN buildings b ON b.record_id = r.record_id
+                       WHERE c.plan_id = r.plan_id AND c.fol_id = r.fol_id AND c.base_value IS NOT {_base_column_sql()})
+               END AS reason
+        FROM sync_plan_records r
+        WHERE r.plan_id = ? AND r.status IN ('{PLANNED}', '{FAILED}')
+          AND (NOT EXISTS (SELECT 1 FROM buildings b WHERE b.record_id = r.record_id)
+               OR (SELECT tombstoned_at FROM property_data p WHERE p.fol_id = r.fol_id) IS NOT NULL
+               OR (SELECT COALESCE(data_hash, '') FROM property_data p WHERE p.fol_id = r.fol_id) IS NOT r.data_hash
+               OR EXISTS (SELECT 1 FROM sync_plan_changes c JOIN buildings b ON b.record_id = r.record_id
+                          WHERE c.plan_id = r.plan_id AND c.fol_id = r.fol_id AND c.base_value IS NOT {_base_column_sql()}))
+    """, (plan_id,)).fetchall()
+
+
+def iter_plan_changes(conn, plan_id, statuses=None):
+    """Yields (fol_id, record_id, status, [(field, base value, new value)]) per record of a plan."""
+    where = ""
+    params = [plan_id]
+    if statuses:
+        where = f" AND r.status IN ({', '.join('?' for _ in statuses)})"
+        params.extend(statuses)
+    current = None
+    for fol_id, record_id, status, field, base, new in conn.execute(f"""
+        SELECT r.fol_id, r.record_id, r.status, c.field, c.base_value, c.new_value
+        FROM sync_plan_records r
+        JOIN sync_plan_changes c ON c.plan_id = r.plan_id AND c.fol_id = r.fol_id
+        WHERE r.plan_id = ?{where}
+        ORDER BY r.fol_id, c.field
+    """, params):
+        if current is None or current[0] != fol_id:
+            if current is not None:
+                yield current
+            current = (fol_id, record_id, status, [])
+        current[3].append((field, base, new))
+    if current is not None:
+        yield current
+
+
+def plan_updates(conn, plan_id):
+    """[(fol_id, {'id': record_id, 'fields': {...}})] for the plan's records that still need a push."""
+    return [(fol_id, {'id': record_id, 'fields': airtable_fields(changes)})
+            for fol_id, record_id, _, changes in iter_plan_changes(conn, plan_id, (PLANNED, FAILED))]
+
+
+def plan_fol_ids(conn, plan_id):
+    return [row[0] for row in conn.execute("SELECT fol_id FROM sync_plan_records WHERE plan_id = ?", (plan_id,))]
+
+
+def mark_records(conn, plan_id, status, rows):
+    """Sets the status of (fol_id, error) rows of a plan."""
+    conn.executemany("UPDATE sync_plan_records SET status = ?, error = ? WHERE plan_id = ? AND fol_id = ?",
+                     ((status, error, plan_id, fol_id) for fol_id, error in rows))
+
+
+def record_applied(conn, plan_id, sync_run):
+    """Marks the plan's applied records synced (with the planned data_hash) in sync_state."""
+    conn.execute(f"""
+        UPDATE sync_state SET data_hash = r.data_hash, sync_run = ?, synced_at = CURRENT_TIMESTAMP
+        FROM sync_plan_records r
+        WHERE r.plan_id = ? AND r.status = '{APPLIED}' AND sync_state.fol_id = r.fol_id
+    """, (sync_run, plan_id))
+
+
+def finish_plan(conn, plan_id):
+    """Sets the plan's status to applied, or partial while records are failed or drifted. Returns the status counts."""
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM sync_plan_records WHERE plan_id = ? GROUP BY status",
+                               (plan_id,)).fetchall())
+    status = APPLIED if set(counts) <= {APPLIED} else PARTIAL
+    conn.execute("UPDATE sync_plans SET status = ?, applied_at = CURRENT_TIMESTAMP WHERE plan_id = ?", (status, plan_id))
+    return counts
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+sync_state.py
+
+What the Airtable sync last pushed, so the next sync only looks at what
+moved since then.
+
+sync_state (migration 15) holds one row per FoL-ID:
+
+    fol_id, record_id, data_hash, snapshot_digest, synced_at, sync_run
+
+data_hash is property_data.data_hash at the last sync and snapshot_digest a
+digest of the compared buildings fields at that time. data_hash NULL marks
+a record that is planned but not pushed yet, or whose push failed, drifted or
+was deferred; the next plan includes it again.
+
+sync_watermarks holds, per source table, the highest last_updated seen by
+the last completed sync. property_data.last_updated moves on every save and
+buildings.last_updated whenever the Airtable snapshot changes a value, both
+indexed. A sync therefore reads only:
+
+- properties saved since the watermark whose data_hash differs from the
+  synced one,
+- buildings changed since the watermark whose digest differs from the
+  synced one,
+- records whose last push failed.
+
+Watermarks compare with >=, because CURRENT_TIMESTAMP has one-second
+resolution. Rows from the watermark's second are read again and dropped by
+the hash and digest comparison. The candidates are then compared in SQL
+(sync_diff.py), scoped to temp.sync_scope.
+"""
+import hashlib
+import logging
+
+from sync_diff import SNAPSHOT_FIELDS, source_sql
+
+logger = logging.getLogger("sync_state")
+
+SOURCES = ("property_data", "buildings")
+
+STATE_UPSERT_SQL = """
+    INSERT INTO sync_state (fol_id, record_id, data_hash, snapshot_digest, sync_run)
+    SELECT p.fol_id, b.record_id, COALESCE(p.data_hash, ''), {digest}, ?
+    {source}
+    ON CONFLICT(fol_id) DO UPDATE SET
+        record_id = excluded.record_id,
+        data_hash = excluded.data_hash,
+        snapshot_digest = excluded.snapshot_digest,
+        sync_run = excluded.sync_run,
+        synced_at = CURRENT_TIMESTAMP
+"""
+
+
+def snapshot_digest(*values):
+    """Digest of the compared fields (SNAPSHOT_FIELDS) of a buildings row."""
+    hasher = hashlib.blake2b(digest_size=16, person=b"airtable_snap")
+    for value in values:
+        hasher.update(("" if value is None else str(value)).encode("utf-8"))
+        hasher.update(b"\x00")
+    return hasher.hexdigest()
+
+
+def register_functions(conn):
+    """Makes snapshot_digest() available to SQL on conn."""
+    conn.create_function("snapshot_digest", len(SNAPSHOT_FIELDS), snapshot_digest, deterministic=True)
+
+
+def digest_sql(row="b"):
+    return f"snapshot_digest({', '.join(f'{row}.{field}' for field in SNAPSHOT_FIELDS)})"
+
+
+def load_watermarks(conn):
+    """{source table: last_updated watermark} of the last completed sync (empty before the first one)."""
+    return dict(conn.execute("SELECT source, value FROM sync_watermarks").fetchall())
+
+
+def current_watermarks(conn):
+    """Highest last_updated per source table right now (index lookups)."""
+    return {source: conn.execute(f"SELECT MAX(last_updated) FROM {source}").fetchone()[0] for source in SOURCES}
+
+
+def save_watermarks(conn, watermarks):
+    conn.executemany("""
+        INSERT INTO sync_watermarks (source, value) VALUES (?, ?)
+        ON CONFLICT(source) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+    """, [(source, value) for source, value in watermarks.items() if value is not None])
+
+
+def candidate_fol_ids(conn, watermarks):
+    """
+    FoL-IDs that may need a push since the given watermarks: changed
+    properties, changed buildings and failed pushes. Works on a federated
+    connection (property_data across all shards).
+    """
+    register_functions(conn)
+    candidates = set()
+    if watermarks.get("property_data") is not None:
+        candidates.update(row[0] for row in conn.execute("""
+            SELECT p.fol_id FROM property_data p
+            LEFT JOIN sync_state s ON s.fol_id = p.fol_id
+            WHERE p.last_updated >= ? AND p.tombstoned_at IS NULL AND COALESCE(p.data_hash, '') IS NOT s.data_hash
+        """, (watermarks["property_data"],)))
+    if watermarks.get("buildings") is not None:
+        candidates.update(row[0] for row in conn.execute(f"""
+            SELECT b.extra_field_1 FROM buildings b
+            LEFT JOIN sync_state s ON s.fol_id = b.extra_field_1
+            WHERE b.last_updated >= ? AND b.extra_field_1 IS NOT NULL AND {digest_sql()} IS NOT s.snapshot_digest
+        """, (watermarks["buildings"],)))
+    candidates.update(row[0] for row in conn.execute("SELECT fol_id FROM sync_state WHERE data_hash IS NULL"))
+    return candidates
+
+
+def record_synced(conn, sync_run, scoped=False):
+    """
+    Records every compared property (all live properties with an Airtable
+    record, or those in temp.sync_scope) as synced by sync_run. Returns the
+    number of records.
+    """
+    register_functions(conn)
+    return conn.execute(STATE_UPSERT_SQL.format(digest=digest_sql(), source=source_sql(scoped)), (sync_run,)).rowcount
+
+
+def mark_pending(conn, fol_ids):
+    """Keeps records whose update was not written pending (data_hash NULL), so the next sync retries them."""
+    conn.executemany("UPDATE sync_state SET data_hash = NULL WHERE fol_id = ?", ((fol_id,) for fol_id in fol_ids))
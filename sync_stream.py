@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+sync_stream.py
+
+Optional streaming Airtable sync during a crawl (AIRTABLE_STREAM=1).
+
+Without it, changes found early in a multi-hour crawl reach Airtable only
+when sync_changes.py runs after the crawl. With it, the crawl's
+PropertyDataWriter offers the FoL-IDs of every committed row whose
+data_hash changed to an AirtableStreamer, which every `interval` seconds
+(or as soon as `batch` FoL-IDs are waiting):
+
+1. compares just those FoL-IDs with the Airtable snapshot in SQL
+   (sync_diff.iter_differences over temp.sync_scope),
+2. records them in sync_state as synced and writes their updates to the
+   outbox in one transaction (sync_outbox.py), and
+3. drains the streamed outbox entries through the rate-limited push
+   pipeline.
+
+Steps 1-3 run in a worker thread, one cycle at a time, so the crawler
+never waits for the database reads or the Airtable API. offer() only adds
+to a bounded set. While a slow cycle is running, new FoL-IDs collect there
+and the next cycle takes them all; once max_pending are waiting, further
+FoL-IDs are not streamed. They are not lost: their rows are committed with
+a new last_updated and data_hash, so the next batch sync
+(sync_changes.py) picks them up. The same holds for a cycle that fails.
+
+Delivery of streamed updates is tracked by the outbox, not sync_state: an
+update that could not be pushed stays pending in the outbox and goes out
+with the next streamed cycle or the next `sync_changes.py apply`.
+Properties without an Airtable record are not streamed (see
+sync_create.py).
+"""
+import os
+import time
+import asyncio
+import logging
+
+import airtable_client
+from shards import MAIN_DB, federated_connection
+from sync_diff import set_scope, iter_differences, airtable_fields
+from sync_state import record_synced
+from sync_outbox import enqueue, drain
+
+logger = logging.getLogger("sync_stream")
+
+STREAM_INTERVAL = 5.0
+STREAM_BATCH = 200
+MAX_PENDING = 5000
+# Leaves part of the base's 5 requests per second to other clients
+STREAM_RATE = 3
+
+
+def streaming_enabled():
+    """Streaming sync is switched on with AIRTABLE_STREAM=1 in the environment/.env."""
+    return os.getenv("AIRTABLE_STREAM", "").lower() in ("1", "true", "yes")
+
+
+class AirtableStreamer:
+    """
+    Background pusher of a crawl's changes to Airtable (see the module
+    docstring). start() it in the crawl's event loop, hand it to the
+    PropertyDataWriter as change_listener and close() it after the writer.
+    """
+
+    def __init__(self, db_path=MAIN_DB, table_name=None, run_id=None, interval=STREAM_INTERVAL, batch=STREAM_BATCH,
+                 max_pending=MAX_PENDING, concurrency=2, rate=STREAM_RATE):
+        self.db_path = db_path
+        self.table_name = table_name or os.getenv("AIRTABLE_TABLE_NAME")
+        self.sync_run = f"stream {run_id}" if run_id is not None else "stream"
+        self.interval = interval
+        self.batch = batch
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+        self.rate = rate
+        self.pending = {}  # insertion-ordered set of FoL-IDs
+        self._wake = None
+        self._closing = False
+        self._task = None
+        self.stats = {'offered': 0, 'overflow': 0, 'cycles': 0, 'compared': 0, 'queued': 0, 'acked': 0, 'failed': 0,
+                      'errors': 0, 'seconds': 0.0}
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Streaming Airtable sync started (every {self.interval}s, {self.rate} requests/s)")
+        return self
+
+    def offer(self, fol_ids):
+        """Queues FoL-IDs whose data_hash changed; never blocks. Beyond max_pending they are left to the batch sync."""
+        for fol_id in fol_ids:
+            self.stats['offered'] += 1
+            if fol_id in self.pending:
+                continue
+            if len(self.pending) >= self.max_pending:
+                self.stats['overflow'] += 1
+                continue
+            self.pending[fol_id] = None
+        if len(self.pending) >= self.batch:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self.pending:
+                fol_ids = list(self.pending)
+                self.pending.clear()
+                started = time.perf_counter()
+                try:
+                    await asyncio.to_thread(self._cycle, fol_ids)
+                except Exception as e:
+                    # The rows are committed; the next batch sync picks them up
+                    self.stats['errors'] += 1
+                    logger.error(f"Streaming sync of {len(fol_ids)} properties failed: {e}")
+                self.stats['cycles'] += 1
+                self.stats['seconds'] += time.perf_counter() - started
+            if self._closing and not self.pending:
+                return
+
+    def _cycle(self, fol_ids):
+        """Compares, records and pushes one set of FoL-IDs (runs in a worker thread)."""
+        conn = federated_connection(self.db_path)
+        try:
+            conn.execute("PRAGMA busy_timeout = 10000")
+            set_scope(conn, fol_ids)
+            updates = [(fol_id, {'id': record_id, 'fields': airtable_fields(changes)})
+                       for fol_id, record_id, _, changes in iter_differences(conn, scoped=True)]
+            record_synced(conn, self.sync_run, scoped=True)
+            enqueue(conn, updates)
+            conn.commit()
+        finally:
+            conn.close()
+        self.stats['compared'] += len(fol_ids)
+        self.stats['queued'] += len(updates)
+        if not updates:
+            return
+        outbox, _ = drain(airtable_client.table(self.table_name), self.db_path, concurrency=self.concurrency,
+                          rate=self.rate, streamed_only=True)
+        self.stats['acked'] += outbox['acked']
+        self.stats['failed'] += outbox['failed']
+        logger.debug(f"Streamed {len(fol_ids)} changed properties: {len(updates)} updates, {outbox['acked']} acked")
+
+    async def close(self):
+        """Streams what is still waiting, then stops."""
+        if self._task is not None:
+            self._closing = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        logger.info(self.report())
+
+    def report(self):
+        return (f"Streaming Airtable sync: {self.stats['offered']} changed properties, {self.stats['compared']} compared "
+                f"in {self.stats['cycles']} cycles ({self.stats['seconds']:.1f}s), {self.stats['queued']} updates queued, "
+                f"{self.stats['acked']} acked, {self.stats['failed']} pending in the outbox, "
+                f"{self.stats['overflow']} left to the batch sync, {self.stats['errors']} failed cycles")